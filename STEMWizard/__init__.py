@@ -1,18 +1,29 @@
 import os
+import queue
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pprint import pprint
 
 import pandas as pd
 import requests
-import yaml
-from bs4 import BeautifulSoup
 from tqdm import tqdm
 
+from .blobs import BlobStore
 from .categories import categories
+from .downloads import DownloadEngine, DownloadRecords
+from .delta import read_snapshot, write_snapshot, diff_snapshot, update_snapshot
 from .fileutils import read_json_cache, write_json_cache
 from .google_sync import NCSEFGoogleDrive
+from .hashing import HashingEngine
+from .httpcache import ResponseCache, CachedSession
 from .logstuff import get_logger
-from .utils import headers
+from .milestones import milestone_request, milestone_path, file_detail_path, order_by_category, iter_page_rows, \
+    more_pages, parse_student_info_ids, parse_student_file_detail
+from .pipeline import PhaseScheduler
+from .session import SessionStore, Throttle, ThrottledAdapter, cookies_changed, login_required, refreshed_request
+from .store import StudentStore
 
 pd.set_option('display.max_columns', None)
 
@@ -22,41 +33,85 @@ class STEMWizardAPI(object):
     #     download_files_locally, DownloadFileFromS3Bucket, DownloadFileFromSTEMWizard, _download_to_local_file_path, \
     #     analyze_student_data, student_file_info, getFormInfo, process_student_data_row, student_file_detail
     # from .fileutils import read_config
-    from .utils import get_region_info, get_csrf_token  # , _getStudentData, _extractStudentID
+    from .utils import read_config, get_region_info, set_region_info, get_csrf_token, \
+        request_headers  # , _getStudentData, _extractStudentID
 
-    def __init__(self, configfile='stemwizardapi.yaml', login_stemwizard=True, login_google=True):
+    def __init__(self, configfile='stemwizardapi.yaml', login_stemwizard=True, login_google=True, max_workers=None,
+                 http_cache=False, store_file='caches/students.sqlite', session_file='caches/stemwizard_session.json'):
         '''
         initiates a session using credentials in the specified configuration file
         Note that this user must be an administrator on the STEM Wizard site.
-        :param configfile: configfile: (default to stemwizardapi.yaml)
+        :param configfile: configfile: (default to stemwizardapi.yaml), which may also set, defaults in
+                           utils.config_options:
+            max_workers: categories fetched concurrently by the milestone scrapers
+            per_page: rows per milestone page request
+            fetch_mode: category fetches each category separately, bulk the whole fair in one paged pass
+            download_limits: concurrent downloads per host, s3 and stemwizard, see DownloadEngine
+            check_freshness: see download_em
+            dedupe_files: see download_em
+            hash_local_files: see analyze_local_files
+            upload_workers: concurrent uploads to Google Drive
+            google_root: Drive folder cached and synced to, empty for the whole drive
+            session_ttl: seconds a saved login is reused for
+            rate_limit: requests started per second on STEM Wizard, 0 for no throttling, see Throttle
+            max_concurrency: most STEM Wizard requests in flight, see Throttle
+            cache_codec, cache_compress: format of the files under caches/, see set_cache_codec
+        :param max_workers: overrides max_workers from the configfile
+        :param http_cache: keep milestone and file detail responses, and what was parsed from them, in caches/http.
+                           Off by default: cached pages are read whole before they are parsed, so pages aren't
+                           streamed or overlapped, and answers from the cache don't run response hooks
+        :param store_file: SQLite file studentSync stores its results in, see StudentStore.  None keeps them in
+                           caches/student_data.json and the other student_*.json files instead
+        :param session_file: where the authenticated session is kept between runs, see SessionStore.  None logs in
+                             every time
         '''
         self.authenticated = None
-        self.session = requests.Session()  # shared session, maintains cookies throughout
-        # self.session = requests_cache.CachedSession('caches/STEMWizardAPI_http_cache')
+        self.http_cache = ResponseCache() if http_cache else None
+        self.auth_lock = threading.Lock()
+        self.auth_local = threading.local()  # marks threads logging in, whose requests are never retried
+        self.clones = weakref.WeakSet()  # sessions cloned from the shared one, given its cookies on each login
+        self.throttle = None  # shared by every session, see _throttle_session
+        self.session = self._new_session()  # shared session, maintains cookies throughout
+        self.sessions = None  # pool of cloned sessions for concurrent scraping, see _session_pool
+        self.pool_lock = threading.Lock()  # the tab phases of studentSync ask for the pool at the same time
+        self.download_records = None  # DownloadRecords, while download_em runs
+        self.blob_store = None  # BlobStore, while download_em runs
+        self.hasher = HashingEngine()  # digests of the files under files/, shared by the blob store and Drive sync
+        self.phase_timings = {}
         self.region_domain = 'unknown'
         self.parent_file_dir = 'files'
         self.region_id = None
         self.csrf = None
         self.username = None
         self.password = None
+        self.store = StudentStore(store_file) if store_file is not None else None
+        self.read_config(configfile)
+        self.session_store = SessionStore(session_file, max_age=self.session_ttl) \
+            if session_file is not None and self.session_ttl > 0 else None
         if login_google:
-            self.googleapi = NCSEFGoogleDrive()
+            self.googleapi = NCSEFGoogleDrive(root=self.google_root, hasher=self.hasher)
         else:
             self.googleapi = None
-        self.read_config(configfile)
+        if max_workers is not None:
+            self.max_workers = max_workers
         self.logger = get_logger(self.domain)
         if self.username is None or len(self.username) < 6:
             raise ValueError(f'did not find a valid username in {configfile}')
         if self.password is None or len(self.password) < 6:
             raise ValueError(f'did not find a valid password in {configfile}')
         self.url_base = f'https://{self.domain}.stemwizard.com'
+        if self.rate_limit > 0:
+            self.throttle = Throttle(rate=self.rate_limit, max_concurrency=self.max_concurrency)
+            self._throttle_session(self.session)
 
-        self.get_region_info()
-
-        if login_stemwizard:
-            self.authenticated = self.login()
+        if login_stemwizard and self._restore_session():
+            self.authenticated = True
         else:
-            self.authenticated = None
+            self.get_region_info()
+            if login_stemwizard:
+                self.authenticated = self.login()
+            else:
+                self.authenticated = None
 
         if self.region_domain != self.domain:
             raise ValueError(
@@ -64,21 +119,13 @@ class STEMWizardAPI(object):
 
     def __del__(self):
         self.session.close()
+        if self.sessions is not None:
+            while not self.sessions.empty():
+                self.sessions.get().close()
+        if self.store is not None:
+            self.store.close()
         self.logger.info(f"destroyed session with {self.domain}")
 
-    def read_config(self, configfile):
-        """
-        reads named yaml configuration file
-        :param configfile: (defaulted to stemwizardapi.yaml above)
-        :return: nothing, updates username, password and token attribuates on the object
-        """
-        fp = open(configfile, 'r')
-        data_loaded = yaml.safe_load(fp)
-        self.domain = data_loaded['domain']
-        self.username = data_loaded['username']
-        self.password = data_loaded['password']
-        fp.close()
-
     def login(self):
         '''
         authenticates
@@ -96,31 +143,106 @@ class STEMWizardAPI(object):
 
         url_login = f'{self.url_base}/admin/authenticate'
 
-        rp = self.session.post(url_login, data=payload, headers=headers,
-                               allow_redirects=True)  # , cookies=session_cookies)
-        if rp.status_code >= 300:
-            self.logger.error(f"status code {rp.status_code} on post to {url_login}")
-            return
-
-        # self.token = token
-        # self.region_id = payload['region_id']
-        authenticated = rp.status_code == 200
+        self.auth_local.active = True
+        try:
+            rp = self.session.post(url_login, data=payload, headers=self.request_headers(),
+                                   allow_redirects=True)  # , cookies=session_cookies)
+            if rp.status_code >= 300:
+                self.logger.error(f"status code {rp.status_code} on post to {url_login}")
+                return
+
+            # self.token = token
+            # self.region_id = payload['region_id']
+            authenticated = rp.status_code == 200
+            if authenticated:
+                self.logger.info(f"authenticated to {self.domain}")
+            else:
+                self.logger.error(f"failed to authenticate to {self.domain}")
+
+            self.get_csrf_token()
+        finally:
+            self.auth_local.active = False
         if authenticated:
-            self.logger.info(f"authenticated to {self.domain}")
-        else:
-            self.logger.error(f"failed to authenticate to {self.domain}")
-
-        self.get_csrf_token()
+            self._save_session()
 
         return authenticated
 
-    def studentSync(self, cache_file_name='caches/student_data.json', download=True, upload=True):
+    def _restore_session(self):
+        '''
+        picks up the session saved by an earlier run, if there is one still young enough to try.  Should it have
+        expired on the server after all, the first request to notice logs in again, see _reauthenticate
+        :return: True if a session was restored
+        '''
+        if self.session_store is None:
+            return False
+        state = self.session_store.load(self.domain, self.username)
+        if state is None:
+            return False
+        SessionStore.restore_cookies(self.session.cookies, state['cookies'])
+        self.token = state['token']
+        self.csrf = state['csrf']
+        self.region_id = state['region_id']
+        self.region_domain = state['region_domain']
+        self.logger.info(f"reusing saved session with {self.domain}")
+        return True
+
+    def _save_session(self):
+        if self.session_store is not None:
+            self.session_store.save(self.domain, self.username, self.session.cookies, token=self.token,
+                                    csrf=self.csrf, region_id=self.region_id, region_domain=self.region_domain)
+
+    def _relogin(self):
+        '''
+        logs in again from scratch, then hands the new cookies to every cloned session
+        :return: True if authenticated
+        '''
+        self.session.cookies.clear()
+        self.csrf = None
+        self.get_region_info()
+        self.authenticated = self.login()
+        for session in list(self.clones):
+            session.cookies.update(self.session.cookies)
+        return self.authenticated
+
+    def _reauthenticate(self, session, r, **kwargs):
+        '''
+        response hook of every STEM Wizard session.  A response showing the session has expired (see login_required)
+        leads to one login, shared by all the threads that noticed, and the request is sent again with the new
+        session.  A request is only ever retried once
+        :return: the retried response, None to keep r
+        '''
+        if getattr(self.auth_local, 'active', False) or getattr(r.request, 'reauthenticated', False) or \
+                not login_required(r):
+            return None
+        with self.auth_lock:
+            if not cookies_changed(r.request, session.cookies):
+                # nobody has logged in since this request was sent
+                self.logger.warning(f"session expired ({r.status_code} from {r.request.url}), logging in again")
+                if not self._relogin():
+                    return None
+            if session is not self.session:
+                session.cookies.update(self.session.cookies)
+        r.close()
+        retry = refreshed_request(r.request, session.cookies, self.token, self.csrf)
+        retry.reauthenticated = True
+        return session.send(retry, **kwargs)
+
+    def studentSync(self, cache_file_name='caches/student_data.json', download=True, upload=True, delta=False,
+                    snapshot_file_name='caches/student_snapshot.json'):
         '''
         sync student files from STEM Wizard to local filesystem and then up to Google Drive
+        phases run on a PhaseScheduler, the three milestone tabs are fetched at the same time and each later
+        phase starts as soon as its inputs are ready.  Wall time per phase is kept in self.phase_timings
 
         :param cache_file_name: filename
         :param download:
         :param upload:
+        :param delta: only students whose merged row changed since the last completed sync are team patched,
+                      (re)downloaded, uploaded and stored, everyone else is carried over from the store, or the
+                      snapshot when there is no store
+        :param snapshot_file_name: per student row hashes, and patched rows when there is no store, saved after each
+                                   complete delta sync, with or without download.  Files of students a delta sync
+                                   without download saw are only fetched by a later full sync
         :return:
         '''
         threads = {
@@ -135,40 +257,140 @@ class STEMWizardAPI(object):
                      'max_cache_age': 9000,
                      'function': lambda: self.getJudgesMaterials()},
         }
+        if not self.authenticated:
+            self.authenticated = self.login()  # once, before the tab phases race to do it
+        scheduler = PhaseScheduler()
+
+        def write_student_json(data, filename):
+            if self.store is None:  # the store holds the same, and is what is read back
+                write_json_cache(data, filename)
 
         # fetch data from project, forms and files, and files for judges tabs on milestones page,
         # by div/category for performance
-        data = {}
+        def fetch(thread):
+            result = read_json_cache(thread['cachefile'], max_cache_age=thread['max_cache_age'])
+            if len(result) == 0:
+                result = thread['function']()
+                write_json_cache(result, thread['cachefile'])
+            return result
+
         for k, v in threads.items():
-            data[k] = read_json_cache(v['cachefile'], max_cache_age=v['max_cache_age'])
-            if len(data[k]) == 0:
-                data[k] = v['function']()
-                write_json_cache(data[k], v['cachefile'])
+            scheduler.add(k, lambda results, v=v: fetch(v))
 
         # combine dictionaries into a single view of student metadata
-        data = self._merge_dicts(data)
-        write_json_cache(data['all'], 'caches/student_data.json')
+        def merge(results):
+            data = self._merge_dicts({k: results[k] for k in threads.keys()})
+            write_student_json(data['all'], 'caches/student_data.json')
+            return data['all']
 
-        # code around bug on milestones page which fails to differentiate files uploaded by separate team members.
-        data['fixed'] = read_json_cache('caches/student_data_fixed.json', max_cache_age=9000)
-        if len(data['fixed']) == 0:
-            data['fixed'] = self._patch_team_filepaths(data['all'])
-            write_json_cache(data['fixed'], 'caches/student_fixed.json')
-        write_json_cache(data['all'], 'caches/student_data_unpatched.json')
-        data['all'] = data['fixed']
+        scheduler.add('all', merge, depends=threads.keys())
 
+        # compare with the last completed sync before patching alters the merged rows
+        if delta:
+            def compare(results):
+                snapshot = read_snapshot(snapshot_file_name)
+                stored = self.store.studentids() if self.store is not None else set()
+                hashes, changed, removed = diff_snapshot(results['all'], snapshot, stored=stored)
+                return {'snapshot': snapshot, 'hashes': hashes, 'changed': changed, 'stored': stored}
 
-        # generate local names for the files and forms
-        data['localized'] = self.analyze_local_files(data['all'])
-        write_json_cache(data['localized'], 'caches/student_data.json')
+            scheduler.add('changed', compare, depends=['all'])
+        new_snapshot = {}
 
-        if download:
-            self.download_em(data['localized'])
-            data['localized'] = self.sync_to_google(data['all'])
+        # code around bug on milestones page which fails to differentiate files uploaded by separate team members.
+        def fix(results):
+            if delta:
+                changed = results['changed']
+                patched = self._patch_team_filepaths({k: results['all'][k] for k in changed['changed']})
+                carried = self._carry_over(changed['snapshot'], [k for k in results['all'].keys() if k not in patched])
+                fixed = {k: patched[k] if k in patched else carried[k] for k in results['all'].keys()}
+                new_snapshot.update(update_snapshot(changed['hashes'], fixed if self.store is None else None))
+                write_student_json(fixed, 'caches/student_fixed.json')
+                return fixed
+            fixed = read_json_cache('caches/student_data_fixed.json', max_cache_age=9000)
+            if len(fixed) == 0:
+                fixed = self._patch_team_filepaths(results['all'])
+                write_student_json(fixed, 'caches/student_fixed.json')
+            write_student_json(results['all'], 'caches/student_data_unpatched.json')
+            return fixed
+
+        scheduler.add('fixed', fix, depends=['changed' if delta else 'all'])
+
+        # generate local names for the files and forms
+        def localize(results):
+            localized = self.analyze_local_files(results['fixed'])
+            write_student_json(localized, 'caches/student_data.json')
+            return localized
+
+        scheduler.add('localized', localize, depends=['fixed'])
+
+        if download and delta:
+            def upload_changed(results):
+                return self._upload_to_google({k: results['fixed'][k] for k in results['changed']['changed']})
+
+            # only the changed students are downloaded, and uploaded, so nobody else's files are checked
+            scheduler.add('download',
+                          lambda results: self.download_em(results['localized'], refresh=results['changed']['changed'],
+                                                           check_freshness=False),
+                          depends=['localized'])
+            scheduler.add('google', upload_changed, depends=['download'])
+        elif download:
+            scheduler.add('download', lambda results: self.download_em(results['localized']), depends=['localized'])
+            scheduler.add('google', lambda results: self._upload_to_google(results['fixed']), depends=['download'])
+
+        results = scheduler.run()
+        self.phase_timings = scheduler.timings
+        if delta:
+            # only once everything changed has been handled.  Students whose files failed are left out, so the
+            # next delta sync sees them as changed and tries them again
+            failed = set()
+            if download:
+                uploads_failed = [os.path.relpath(path, 'files/ncsef') for path in results['google']['failed']]
+                failed = self._students_of(results['localized'], results['download']['failed'] + uploads_failed)
+            if failed:
+                self.logger.warning(f"{len(failed)} students will be synced again on the next run, "
+                                    f"their files failed to download or upload")
+            write_snapshot({k: v for k, v in new_snapshot.items() if k not in failed}, snapshot_file_name)
+        data = results['localized']
         if upload:
-            write_json_cache(data['localized'], 'caches/student_data.json')
+            write_student_json(data, 'caches/student_data.json')
+        if self.store is not None and delta:
+            # the students changed since the last sync, and any the store doesn't hold yet
+            upserts = [k for k in data.keys() if k in set(results['changed']['changed']) or
+                       k not in results['changed']['stored']]
+            self.store.upsert_many({k: data[k] for k in upserts}, prune=True, keep=data.keys())
+        elif self.store is not None:
+            self.store.upsert_many(data, prune=True)
 
-        return data['localized']
+        return data
+
+    def _carry_over(self, snapshot, studentids):
+        '''
+        the team patched rows of unchanged students, as of the last sync
+        :param snapshot: previous delta snapshot
+        :return: rows keyed by student id, from the snapshot where it holds them, otherwise read back from the store
+                 with their local file names cleared for analyze_local_files to fill in again
+        '''
+        rows = {k: snapshot[k]['patched'] for k in studentids if 'patched' in snapshot[k]}
+        stored = self.store.get_many([k for k in studentids if k not in rows]) if self.store is not None else {}
+        for studentdata in stored.values():
+            for filedata in studentdata.get('files', {}).values():
+                filedata['local_filename'] = []
+                filedata['local_lastmod'] = []
+        rows.update(stored)
+        return rows
+
+    def get_internal_id_from_project_no(self, project_no):
+        '''
+        :return: STEM Wizard student id for a project number, from the results of the last studentSync, None if not
+                 found
+        '''
+        if self.store is not None:
+            return self.store.get_internal_id_from_project_no(project_no)
+        data = read_json_cache('caches/student_data.json', max_cache_age=float('inf'))
+        for studentid, studentdata in data.items():
+            if studentdata.get('Project Number') == project_no:
+                return studentid
+        return None
 
     def _patch_team_filepaths(self, data):
         # gross, but works.  Patches around a bug on the STEM Wizard milestones page which displays the same link for each team member for files
@@ -192,8 +414,16 @@ class STEMWizardAPI(object):
         return data
 
     def analyze_local_files(self, data):
+        '''
+        names the local copy of each student file and notes when those already downloaded were last modified.  When
+        self.hash_local_files is set, the files present are also digested in parallel, so the Drive sync and the blob
+        store find their digests cached rather than reading the files one at a time
+        :param data: student data
+        :return: data, with local_filename and local_lastmod filled in
+        '''
         # dir = f"files/{self.region_domain}"
         dir = ''
+        present = []
         for k, v in data.items():
             project_number = v['Project Number']
             v['participants'] = len(v['Last Name'])
@@ -230,39 +460,134 @@ class STEMWizardAPI(object):
                     fullpath = f"files/ncsef/{filepath}"
                     if os.path.exists(fullpath):
                         filedata['local_lastmod'].append(datetime.fromtimestamp(os.path.getmtime(fullpath)))
+                        present.append(fullpath)
 
                     else:
                         filedata['local_lastmod'].append(None)
+        if self.hash_local_files and present:
+            self.hasher.digest_many(present, algorithms=('md5', 'sha256') if self.dedupe_files else ('md5',))
+            self.hasher.save()
         return data
 
+    @staticmethod
+    def _students_of(data, local_filenames):
+        '''
+        :param data: localized student data
+        :param local_filenames: file names relative to the fair's directory under files/
+        :return: set of the ids of the students those files belong to
+        '''
+        local_filenames = set(local_filenames)
+        return {k for k, v in data.items() for filedata in v['files'].values()
+                if local_filenames.intersection(filedata['local_filename'])}
+
     def sync_to_google(self, data):
+        '''
+        uploads the students' files to Google Drive, self.upload_workers at a time
+        :param data: downloaded student data
+        :return: data, unchanged
+        '''
+        self._upload_to_google(data)
+        return data
+
+    def _upload_to_google(self, data):
+        '''
+        :return: upload summary from NCSEFGoogleDrive.upload_files
+        '''
+        jobs = []
         for k, v in data.items():
             for filetype, filedata in v['files'].items():
                 for (local_filename, local_lastmod) in zip(filedata['local_filename'], filedata['local_lastmod']):
                     if filetype in ['Abstract Form', '1C', '7']:  # duplicated on judge screen
                         continue
-                    self.googleapi.create_file(
-                        f"files/ncsef/{local_filename}",
-                        f"/Automation/ncsef/by project/{local_filename}")
-                    # jkl = self.googleapi._find_file(f"/Automation/ncsef/by project/{local_filename}")
-        return data
+                    jobs.append((f"files/ncsef/{local_filename}", f"/Automation/ncsef/by project/{local_filename}"))
+        return self.googleapi.upload_files(jobs, max_workers=self.upload_workers)
 
-    def download_em(self, data):
-        for id, v in tqdm(data.items()):
+    def download_em(self, data, refresh=(), check_freshness=None):
+        '''
+        downloads every file not yet present locally, concurrently on a DownloadEngine
+        :param data: localized student data
+        :param refresh: student ids whose files are downloaded again even if present
+        :param check_freshness: also send a conditional request for each file already present, downloading it again
+                                only if the ETag, Last-Modified or length recorded when it was downloaded has changed.
+                                A response with none of these leaves the local copy alone.  Defaults to
+                                self.check_freshness
+        when self.dedupe_files is set, files are kept once each in a BlobStore, the paths under files/ linking to them.
+        A source listed under several paths is downloaded once and linked to the rest, and a source already in the
+        store is linked without downloading it at all
+        :return: download summary from DownloadEngine.run
+        '''
+        refresh = set(refresh)
+        if check_freshness is None:
+            check_freshness = self.check_freshness
+        jobs = []
+        for id, v in data.items():
             for filetype, filedata in v['files'].items():
                 if filetype in ['Abstract Form', '1C', '7']:  # duplicated on judge screen
                     continue
                 if len(filedata['url']) > 0:
                     for (url, local_filename, local_lastmod) in zip(filedata['url'], filedata['local_filename'],
                                                                     filedata['local_lastmod']):
-                        if 'amazonaws.com' in url and local_lastmod is None:
-                            self.download_from_s3(url, local_filename)
+                        if 'amazonaws.com' in url and (local_lastmod is None or id in refresh or check_freshness):
+                            jobs.append(('s3', url, local_filename, id in refresh))
                 else:
                     for (remote_filename, local_filename, local_lastmod) in zip(filedata['remote_filename'],
                                                                                 filedata['local_filename'],
                                                                                 filedata['local_lastmod']):
-                        if len(remote_filename) > 0 and local_lastmod is None:
-                            self.download_from_stemwizard(remote_filename, local_filename)
+                        if len(remote_filename) > 0 and (local_lastmod is None or id in refresh or check_freshness):
+                            jobs.append(('stemwizard', remote_filename, local_filename, id in refresh))
+        aliases = []
+        if self.dedupe_files:
+            self.blob_store = BlobStore(hasher=self.hasher)
+            jobs, aliases = self._dedupe_jobs(jobs)
+        if any(job[0] == 'stemwizard' for job in jobs):
+            self.get_csrf_token()  # once, before the workers need it
+        self.download_records = DownloadRecords()
+        try:
+            summary = DownloadEngine(self, self.download_limits).run(jobs)
+            for source, local_filename in aliases:
+                blob = self.blob_store.lookup(source)
+                if blob is not None:
+                    self.blob_store.link(blob, f"files/{self.region_domain}/{local_filename}")
+                else:  # the download it shares failed
+                    summary['failed'].append(local_filename)
+            return summary
+        finally:
+            self.download_records.save()
+            self.download_records = None
+            if self.blob_store is not None:
+                self.blob_store.save()
+                self.blob_store = None
+            self.hasher.save()
+
+    def _dedupe_jobs(self, jobs):
+        '''
+        keeps one download job per source, linking files the blob store already holds
+        :param jobs: DownloadEngine jobs
+        :return: tuple of (jobs still to run, list of (blob source, local filename) to link once they have)
+        '''
+        sources = set()
+        remaining = []
+        aliases = []
+        for host, source, local_filename, force in jobs:
+            blob_source = self._blob_source(host, source)
+            if blob_source in sources:
+                aliases.append((blob_source, local_filename))
+                continue
+            sources.add(blob_source)
+            local_path = f"files/{self.region_domain}/{local_filename}"
+            blob = self.blob_store.lookup(blob_source)
+            if blob is not None and not force and not os.path.exists(local_path):
+                self.blob_store.link(blob, local_path)
+                continue
+            remaining.append((host, source, local_filename, force))
+        self.logger.info(f"{len(remaining)} downloads after linking {len(jobs) - len(remaining) - len(aliases)} "
+                         f"stored files and {len(aliases)} duplicates")
+        return remaining, aliases
+
+    @staticmethod
+    def _blob_source(host, source):
+        # the key a downloaded file is indexed under in the blob store
+        return source if host == 's3' else f"{host}:{source}"
 
     def _merge_dicts(self, data):
         '''
@@ -282,274 +607,322 @@ class STEMWizardAPI(object):
                     data['all'][studentid]['files'] = data['all'][studentid]['files'] | studentdata['files']
                 else:
                     data['all'] = data['all'] | studentdata
-        write_json_cache(data['all'], 'caches/student_data.json')
         return data
 
-    def get_files_and_forms(self):
+    def _new_session(self):
+        session = requests.Session() if self.http_cache is None else CachedSession(self.http_cache)
+        api = weakref.ref(self)  # sessions mustn't keep the object alive
+
+        def reauthenticate(r, *args, **kwargs):
+            return api()._reauthenticate(session, r, **kwargs) if api() is not None else None
+
+        session.hooks['response'].append(reauthenticate)
+        if self.throttle is not None:
+            self._throttle_session(session)
+        return session
+
+    def _throttle_session(self, session):
+        # requests to STEM Wizard go through the shared throttle, anything else (S3) doesn't
+        session.mount(self.url_base, ThrottledAdapter(self.throttle))
+
+    def _clone_session(self):
+        # a new session sharing the authenticated session's cookies
+        session = self._new_session()
+        session.cookies.update(self.session.cookies)
+        self.clones.add(session)
+        return session
+
+    def _parsed(self, r, name, parse):
+        '''
+        result of parse(), memoized against the response body when it passed through the http cache so an
+        unchanged page is only parsed once
+        :param r: response parse reads from
+        :param name: distinguishes parsers applied to the same body
+        :param parse: function returning an iterable parsed from r
+        '''
+        content_hash = getattr(r, 'content_hash', None)
+        if content_hash is None:
+            return parse()
+        return self.http_cache.memoize(content_hash, name, lambda: list(parse()))
+
+    def _session_pool(self):
+        '''
+        sessions used by concurrent scrapers, each is a clone of the authenticated session (cookies included)
+        so that every worker has its own connection pool.  Created once, reused for the life of the object.
+        :return: queue of sessions, the shared session is always a member
+        '''
+        with self.pool_lock:
+            if self.sessions is None:
+                sessions = queue.Queue()
+                sessions.put(self.session)
+                for _ in range(self.max_workers - 1):
+                    sessions.put(self._clone_session())
+                self.sessions = sessions
+            return self.sessions
+
+    def _map_categories(self, tab, desc):
+        '''
+        fetches every category of a milestone tab, in parallel across max_workers sessions when configured.
+        Results are merged in the order categories are listed regardless of completion order.
+        :param tab: project, form or file
+        :param desc: progress bar description
+        :return: dictionary of student data, keyed by student id
+        '''
         if not self.authenticated:
             self.authenticated = self.login()
+        if self.fetch_mode == 'bulk':
+            return dict(order_by_category(tqdm(self.iter_students(tab, ''), desc=desc)))
         data = {}
-        headers['X-CSRF-TOKEN'] = self.csrf
-        for category_id, category_title in tqdm(categories.items(), desc='Files and Forms'):
-            payload = {'page': 1,
-                       'per_page': 999,
-                       'st_stmile_id': 1337,
-                       'mileName': 'Files and Forms',
-                       'division': 0,
-                       'category_select': category_id,
-                       'student_activation_status': 1,
-                       }
-            url = f'{self.url_base}/fairadmin/getstudentCustomMilestoneDetailView'
-            r = self.session.post(url, data=payload, headers=headers)
-            soup = BeautifulSoup(r.text, 'lxml')
-            head = soup.find('thead')
-            th_labels = []
-            for th in head.find_all('th'):
-                v = th.text.strip()
-                v = v.replace('2022 NCSEF ', '')
-                if 'Research' in v:
-                    v = 'Research Plan'
-                if len(v) <= 2:
-                    v = f"ISEF-{v.lower()}"
-                th_labels.append(v)
-
-            body = soup.find('tbody')
-            for row in body.find_all('tr'):
-                import uuid
-                studentid = f"unknown_{uuid.uuid4()}"
-                studentdata = {'studentid': None, 'files': {}}
-                for header in th_labels[6:]:
-                    studentdata['files'][header] = {'url': [], 'remote_filename': [], 'local_filename': [],
-                                                    'local_lastmod': []}
-                for n, td in enumerate(row.find_all('td')):
-                    if n < 5:
-                        studentdata[th_labels[n]] = td.text.strip().replace(" \n\n", ', ')
-                        a = td.find('a')
-                        if a:
-                            l = a['href']
-                            atoms = l.split('/')
-                            studentid = atoms[-2]
-                            studentdata['studentid'] = studentid
-                    else:
-                        a = td.find_all('a')
-                        if a:
-                            # studentdata['files'][th_labels[n]] = {'url': []}
-                            for link in a:
-                                atoms = link['href'].split('/')
-                                studentdata['files'][th_labels[n]]['url'].append(link['href'])
-                                studentdata['files'][th_labels[n]]['remote_filename'].append(atoms[-1])
-                data[studentid] = studentdata
+        if self.max_workers <= 1:
+            for category_id in tqdm(categories.keys(), desc=desc):
+                data.update(self.iter_students(tab, category_id))
+            return data
+
+        pool = self._session_pool()
+
+        def worker(category_id):
+            session = pool.get()
+            try:
+                return dict(self.iter_students(tab, category_id, session=session))
+            finally:
+                pool.put(session)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(worker, category_id) for category_id in categories.keys()]
+            for future in tqdm(futures, desc=desc):
+                data.update(future.result())
         return data
 
+    def get_files_and_forms(self):
+        return self._map_categories('form', 'Files and Forms')
+
     def getJudgesMaterials(self):
-        if not self.authenticated:
-            self.authenticated = self.login()
-        data = {}
-        headers['X-CSRF-TOKEN'] = self.csrf
-        for category_id, category_title in tqdm(categories.items(), desc='judges materials'):
-
-            url = f'{self.url_base}/fairadmin/getstudentCustomMilestoneDetailView'
-            params = f'page=1&category_select={category_id}&per_page=999&st_stmile_id=3153&student_activation_status=1'
-            r = self.session.post(f"{url}?{params}", headers=headers)
-            soup = BeautifulSoup(r.text, 'lxml')
-            head = soup.find('thead')
-            th_labels = []
-            for th in head.find_all('th'):
-                hasp = th.find('p')
-                if hasp:
-                    v = th.find('p').text.strip()
-                else:
-                    v = th.text.strip()
-                v = v.replace('2022 NCSEF ', '')
-                for shortname in ['Research Paper', 'Abstract', 'Quad Chart', 'Lab Notebook ',
-                                  'Project Presentation Slides', '1 minute video', '1C', '7']:
-                    if shortname.lower() in v.lower():
-                        v = shortname
-                th_labels.append(v.strip())  # remove stray whitespace in th text
-            body = soup.find('tbody')
-            for row in body.find_all('tr'):
-                studentdata = {'studentid': None, 'files': {}}
-                for header in th_labels[5:]:
-                    studentdata['files'][header] = {'url': [], 'remote_filename': [],
-                                                    'local_filename': [], 'local_lastmod': []}
-                for n, td in enumerate(row.find_all('td')):
-                    if n < 5:
-                        studentdata[th_labels[n]] = td.text.strip().replace(" \n\n", ', ')
-                        a = td.find('a')
-                        if a:
-                            l = a['href']
-                            atoms = l.split('/')
-                            studentid = atoms[-2]
-                            studentdata['studentid'] = studentid
-                    else:
-                        a = td.find('a')
-                        if a:
-                            studentdata['files'][th_labels[n]]['url'].append(a['href'])
-                        else:
-                            studentdata['files'][th_labels[n]]['remote_filename'].append(td.text)
-                data[studentid] = studentdata
-        return data
+        return self._map_categories('file', 'judges materials')
 
     def getProjectInfo(self):
-        if not self.authenticated:
-            self.authenticated = self.login()
+        return self._map_categories('project', 'project')
 
-        data = {}
-        headers['X-CSRF-TOKEN'] = self.csrf
-        for category_id, category_title in tqdm(categories.items(), desc='project'):
-            url = f'{self.url_base}/fairadmin/getstudentCustomMilestoneDetailView'
-            params = f'page=1&category_select={category_id}&child_fair_select=&searchhere=&orderby=&sortby=&division=&class_id=&per_page=999&student_completion_status=undefined&admin_status=undefined&student_checkin_status=&student_milestone_status=&st_stmile_id=1335&grade_select=&student_activation_status=1'
-            r = self.session.post(f"{url}?{params}", headers=headers)
-            fp = open(f'/tmp/project.html', 'w')
-            fp.write(r.text)
-            fp.close()
-            soup = BeautifulSoup(r.text, 'lxml')
-            head = soup.find('thead')
-            if head is None:
-                print(r.status_code)
-                print(r.text)
-                raise ValueError(
-                    f'no table head found on project tab for {category_title} of getstudentCustomMilestoneDetailView ')
-            th_labels = []
-            for th in head.find_all('th'):
-                hasp = th.find('p')
-                if hasp:
-                    v = th.find('p').text.strip()
-                else:
-                    v = th.text.strip()
-                v = v.replace('2022 NCSEF ', '')
-                for shortname in ['Research Paper', 'Abstract', 'Quad Chart', 'Lab Notebook ',
-                                  'Project Presentation Slides', '1 minute video', '1C', '7']:
-                    if shortname.lower() in v.lower():
-                        v = shortname
-                th_labels.append(v)
-            body = soup.find('tbody')
-            for row in body.find_all('tr'):
-                studentid = row['id'].replace('updatedStudentDiv_', '')
-                data[studentid] = {}
-                for n, td in enumerate(row.find_all('td')):
-                    divs = td.find_all('div')
-                    if divs and th_labels[n] != 'Project Name':
-                        data[studentid][th_labels[n]] = []
-                        for div in divs:
-                            data[studentid][th_labels[n]].append(div.text.strip())
-                    elif th_labels[n] == 'Project Name':
-                        p = td.find('p')
-                        if p:
-                            data[studentid][th_labels[n]] = p.text.strip()
-                        else:
-                            data[studentid][th_labels[n]] = td.text.strip()
-                    else:
-                        data[studentid][th_labels[n]] = td.text.strip()
-        return data
-
-    def download_from_s3(self, url, local_filename):
+    def iter_students(self, tab, category_id, session=None):
+        '''
+        streams one category of a milestone tab, per_page rows at a time, yielding each student as soon as its
+        row is parsed.  Pages are requested until the total the page shows has been read, or, when it shows none,
+        until one comes back empty, since the server may return fewer than per_page rows.  From the second page on
+        the following page is requested in the background while the current one is parsed.
+        :param tab: project, form or file
+        :param category_id: key from categories, an empty string fetches every category at once
+        :param session: session to use, defaults to the shared session
+        :return: generator of (student id, student data)
+        '''
+        session = session or self.session
+        category_title = categories.get(category_id, category_id)
+        with ThreadPoolExecutor(max_workers=1) as prefetch:
+            page = 1
+            pending = prefetch.submit(self._milestone_post, session, tab, category_id, page)
+            first_studentid = None
+            seen = 0
+            total = None
+            n = 0
+            repeated = False
+            while pending is not None:
+                r = pending.result()
+                pending = None
+                page_size = n  # rows the server returned on the previous page
+                with r:
+                    n = 0
+                    for studentid, studentdata in self._parsed(
+                            r, tab, lambda: iter_page_rows(tab, r.iter_content(chunk_size=64 * 1024), category_title,
+                                                           encoding=r.encoding)):
+                        if studentid is None:
+                            total = studentdata
+                            continue
+                        if n == 0:
+                            if page > 1 and studentid == first_studentid:
+                                self.logger.warning(f"page {page} of {tab} {category_title} repeats page {page - 1}")
+                                repeated = True
+                                break
+                            first_studentid = studentid
+                            if page > 1 and more_pages(seen + page_size, page_size, total):
+                                # overlap the next request with parsing this one
+                                pending = prefetch.submit(self._milestone_post, session, tab, category_id, page + 1)
+                        n += 1
+                        yield studentid, studentdata
+                seen += n
+                if page == 1 and total is not None and n < min(total, self.per_page):
+                    self.logger.warning(f"{tab} pages hold {n} rows, not the {self.per_page} requested")
+                if repeated or not more_pages(seen, n, total):
+                    if pending is not None:
+                        pending.result().close()
+                    break
+                if pending is None:
+                    pending = prefetch.submit(self._milestone_post, session, tab, category_id, page + 1)
+                page += 1
+
+    def _milestone_post(self, session, tab, category_id, page=1):
+        params, payload = milestone_request(tab, category_id, page=page, per_page=self.per_page)
+        url = f'{self.url_base}{milestone_path}'
+        if params is not None:
+            url = f"{url}?{params}"
+        return session.post(url, data=payload, headers=self.request_headers(), stream=True)
+
+    def download_from_s3(self, url, local_filename, session=None, progress=None, force=False):
         # self.logger.debug(f"DownloadFileFromS3Bucket: downloading {url} to {local_dir} as {local_filename} from S3")
-        r = self.session.get(url)
+        session = session or self.session
 
-        if r.status_code >= 300:
-            self.logger.error(f"status code {r.status_code} on post to {url}")
-            return
+        def fetch(extra_headers):
+            return session.get(url, stream=True, headers=extra_headers)
 
-        return self._download_to_local_file_path(local_filename, r)
+        return self._download_to_local_file_path(local_filename, fetch, progress=progress, force=force,
+                                                 blob_source=self._blob_source('s3', url))
 
     def download_from_stemwizard(self, filename_remote, local_file_path, remotedir='images/milestone_uploads',
-                                 referer='FilesAndForms'):
+                                 referer='FilesAndForms', session=None, progress=None, force=False):
         # self.logger.debug(f"downloading {filename_remote}")
         self.get_csrf_token()
-        headers['X-CSRF-TOKEN'] = self.csrf
-        headers['Referer'] = f'{self.url_base}f/fairadmin/{referer}'
         url = f'{self.url_base}/fairadmin/fileDownload'
+        session = session or self.session
 
         payload = {'_token': self.token,
                    'download_filen_path': '/EBS-Stem/stemwizard/webroot/stemwizard/public/assets/images/milestone_uploads',
                    'download_hideData': filename_remote,
                    }
 
-        rf = self.session.post(url, data=payload, headers=headers)
-        if rf.status_code >= 300:
-            self.logger.error(f"status code {rf.status_code} on post to {url}")
-            return
-        return self._download_to_local_file_path(local_file_path, rf)
+        def fetch(extra_headers):
+            return session.post(url, data=payload, stream=True,
+                                headers=self.request_headers(referer=f'{self.url_base}f/fairadmin/{referer}') |
+                                extra_headers)
+
+        return self._download_to_local_file_path(local_file_path, fetch, progress=progress, force=force,
+                                                 blob_source=self._blob_source('stemwizard', filename_remote))
 
-    def _download_to_local_file_path(self, full_pathname, r):
+    def _download_to_local_file_path(self, full_pathname, fetch, progress=None, max_resumes=5, force=False,
+                                     blob_source=None):
+        '''
+        streams a file to files/<region domain> by way of a .part file, which is renamed into place only once as many
+        bytes as the server promised have arrived.  An interrupted transfer is resumed with a Range request, straight
+        away and by any later run that finds the .part file.  Servers that ignore Range restart from the beginning.
+        :param full_pathname: path relative to files/<region domain>
+        :param fetch: called with extra request headers (the Range header when resuming), returns a streamed response
+        :param progress: called with the size of each chunk written
+        :param max_resumes: resume attempts before giving up, the .part file is kept for the next run
+        :param force: download even if the local copy looks current.  Otherwise, while download_em runs, an existing
+                      file is requested conditionally on the validators in self.download_records and kept if unchanged
+        :param blob_source: key the file is indexed under in self.blob_store, while download_em runs with one
+        :return: True if downloaded, False if the local copy was current, None if STEM Wizard served a page instead
+        '''
         atoms = full_pathname.split('/')
         dir = f"files/{self.region_domain}"
         for ele in atoms[:-1]:
             dir += f"/{ele}"
             os.makedirs(dir, exist_ok=True)
+        local_path = f"files/{self.region_domain}/{full_pathname}"
+        part_path = f"{local_path}.part"
+        records = self.download_records
+        record = records.get(full_pathname) if records is not None else None
+        check = not force and records is not None and os.path.exists(local_path)
 
-        if r.status_code >= 300:
-            raise Exception(f'{r.status_code}')
-        if r.headers['Content-Type'] == 'text/html':
-            self.logger.error(f"failed to download {full_pathname}")
-        else:
-            f = open(f"files/{self.region_domain}/{full_pathname}", 'wb')
-            for chunk in r.iter_content(chunk_size=512 * 1024):
-                if chunk:  # filter out keep-alive new chunks
-                    f.write(chunk)
-            f.close()
+        def discard_part():
+            try:
+                os.remove(part_path)
+            except FileNotFoundError:  # another worker got there first
+                pass
+
+        for attempt in range(max_resumes + 1):
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            if offset:
+                extra_headers = {'Range': f'bytes={offset}-'}
+            elif check:
+                extra_headers = records.conditional_headers(record)
+            else:
+                extra_headers = {}
+            with fetch(extra_headers) as r:
+                if r.status_code == 304:
+                    self._store_blob(local_path, blob_source, adopt=True)
+                    return False
+                if r.status_code == 416 and offset:  # nothing past offset, the .part file can't be trusted
+                    discard_part()
+                    continue
+                if r.status_code >= 300:
+                    self.logger.error(f"status code {r.status_code} downloading {full_pathname}")
+                    raise Exception(f'{r.status_code}')
+                if r.headers.get('Content-Type') == 'text/html':  # an error or login page, not the file
+                    self.logger.error(f"failed to download {full_pathname}")
+                    raise IOError(f"received a web page instead of {full_pathname}")
+                if check and not offset and records.unchanged(record, r.headers, os.path.getsize(local_path)):
+                    records.set(full_pathname, r.headers)  # first check of a file downloaded before records were kept
+                    self._store_blob(local_path, blob_source, adopt=True)
+                    return False  # closes the response without reading the body
+                if r.status_code == 206:
+                    # Content-Range: bytes 1000-4999/5000
+                    first, total = r.headers['Content-Range'].split(' ')[-1].split('/')
+                    if int(first.split('-')[0]) != offset:
+                        discard_part()
+                        continue
+                    expected = None if total == '*' else int(total)
+                    mode = 'ab'
+                else:
+                    offset = 0
+                    expected = None
+                    if 'Content-Length' in r.headers and 'Content-Encoding' not in r.headers:
+                        expected = int(r.headers['Content-Length'])
+                    mode = 'wb'
+                validators = r.headers  # a 206 carries the ETag and Last-Modified of the whole file too
+                try:
+                    with open(part_path, mode) as f:
+                        for chunk in r.iter_content(chunk_size=512 * 1024):
+                            if chunk:  # filter out keep-alive new chunks
+                                f.write(chunk)
+                                if progress is not None:
+                                    progress(len(chunk))
+                except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                        requests.exceptions.Timeout) as e:
+                    self.logger.warning(f"download of {full_pathname} interrupted at "
+                                        f"{os.path.getsize(part_path)} bytes, resuming: {e}")
+                    continue
+            size = os.path.getsize(part_path)
+            if expected is not None and size < expected:
+                self.logger.warning(f"download of {full_pathname} ended at {size} of {expected} bytes, resuming")
+                continue
+            if expected is not None and size > expected:
+                os.remove(part_path)
+                raise IOError(f"downloaded {size} bytes for {full_pathname}, expected {expected}")
+            os.replace(part_path, local_path)
+            self._store_blob(local_path, blob_source)
+            if records is not None:
+                records.set(full_pathname, validators, content_length=size)
             self.logger.info(f"download_to_local_file_path: downloaded to {full_pathname}")
+            return True
+        raise IOError(f"gave up downloading {full_pathname} after {max_resumes} resumes, partial file kept")
+
+    def _store_blob(self, local_path, blob_source, adopt=False):
+        # swaps a file for a link into the blob store when download_em is deduplicating
+        if self.blob_store is None:
+            return
+        if adopt:
+            self.blob_store.adopt(local_path, source=blob_source)
+        else:
+            self.blob_store.ingest(local_path, source=blob_source)
 
     def _student_file_detail(self, studentId, info_id):
         self.get_csrf_token()
-        url = f'{self.url_base}/filesAndForms/studentFormsAndFilesDetailedView'
+        url = f'{self.url_base}{file_detail_path}'
         payload = {'studentId': studentId, 'info_id': info_id}
 
-        headers['X-CSRF-TOKEN'] = self.csrf
-        headers['Referer'] = f'{self.url_base}/filesAndForms'
-        headers['X-Requested-With'] = 'XMLHttpRequest'
-        rfaf = self.session.post(url, data=payload, headers=headers)
-        if rfaf.status_code >= 300:
-            self.logger.error(f"status code {rfaf.status_code} on post to {url}")
-            return
-        if info_id is None:
-            self.logger.debug(f"getting student info ids for  {studentId}")
-            # fp = open('foo.html', 'w')
-            # fp.write(rfaf.text)
-            # fp.close()
-            soup = BeautifulSoup(rfaf.text, 'html.parser')
-            # <li class="student_tab" id="64585">
-            students = soup.find_all('li', {'class': 'student_tab'})
-            data = {}
-            for student in students:
-                infoid = student['id']
-                if infoid is not None:
-                    data[f"{studentId} {infoid}"] = self._student_file_detail(studentId, infoid)
-        else:
-            self.logger.debug(f"getting file info for {studentId} {info_id}")
-            data = []
-            soup = BeautifulSoup(rfaf.text, 'html.parser')
-            # <table class="table table-striped table-bordered table-hover dataTable" style="width:100%;position: relative;border:1px solid #e4e4e4">
-            thetable = soup.find('table', {'class': "table table-striped table-bordered table-hover dataTable"})
-            # thead = thetable.find('thead')
-            th_labels = []
-            for th in thetable.find_all('th'):
-                th_labels.append(th.text)
-            # tbody = thetable.find('tbody')
-            for tr in thetable.find_all('tr'):
-                row = {}
-                for label, td in zip(th_labels, tr.find_all('td')):
-                    l = td.find('a')
-                    if l is not None:
-                        # <a href="#" title="Download" downloadprojfile="McMichael Student Checklist.jpg" downloadprojfilename="McMichael Student Checklist_67263_164437473362.jpg" uploaddocname="https://stem-s3-2021.s3.us-west-1.amazonaws.com/2021/production/project_files/McMichael Student Checklist_67263_164437473362.jpg" class="downloadProjStudent" id="downloadProjStudent" style="text-decoration:none">                            McMichael Student Checklist.jpg</a>
-                        if l.has_attr('uploaddocname'):
-                            # downloadable from s3 bucket
-                            row[label] = {'url': l['uploaddocname'], 'remote_filename': l['downloadprojfilename']}
-                        else:
-                            # downloadable from STEM Wizard site
-                            row[label] = {'remote_filename': l['uploaded_file_name']}
-
-                    else:
-                        contents = td.text
-                        if label == 'FILE TYPE':
-                            # normalize file types
-                            contents = contents.replace('2022 NCSEF ', '')
-                            contents = contents.replace('Abstract Form', 'Abstract')
-                            contents = contents.replace('ISEF ', 'ISEF-')
-                            if 'Research Plan' in contents:
-                                contents = 'Research Plan'
-                        row[label] = contents.strip()
-                if len(row):
-                    data.append(row)
+        with self.session.post(url, data=payload, stream=True,
+                               headers=self.request_headers(referer=f'{self.url_base}/filesAndForms',
+                                                            ajax=True)) as rfaf:
+            if rfaf.status_code >= 300:
+                self.logger.error(f"status code {rfaf.status_code} on post to {url}")
+                return
+            chunks = rfaf.iter_content(chunk_size=64 * 1024)
+            if info_id is None:
+                self.logger.debug(f"getting student info ids for  {studentId}")
+                infoids = self._parsed(rfaf, 'info_ids',
+                                       lambda: parse_student_info_ids(chunks, encoding=rfaf.encoding))
+            else:
+                self.logger.debug(f"getting file info for {studentId} {info_id}")
+                return self._parsed(rfaf, 'file_detail',
+                                    lambda: parse_student_file_detail(chunks, encoding=rfaf.encoding))
+        data = {}
+        for infoid in infoids:
+            data[f"{studentId} {infoid}"] = self._student_file_detail(studentId, infoid)
         return data
@@ -0,0 +1,290 @@
+import asyncio
+import os
+
+import aiohttp
+
+from .categories import categories
+from .logstuff import get_logger
+from .milestones import milestone_request, milestone_path, file_detail_path, order_by_category, iter_page_rows, \
+    more_pages, parse_student_info_ids, parse_student_file_detail
+from .utils import headers, parse_region_info, parse_csrf_token
+
+
+def _form(payload):
+    # requests silently drops None values from form data, aiohttp would send the string 'None'
+    if payload is None:
+        return None
+    return {k: str(v) for k, v in payload.items() if v is not None}
+
+
+class AsyncSTEMWizardAPI(object):
+    '''
+    asyncio counterpart to STEMWizardAPI.  All requests share one aiohttp session whose connector pools
+    connections, so every category, detail and file request can be in flight at once on a single event loop.
+    Imported from STEMWizard.async_api, not the package, so only its users need aiohttp.  Use as an async context
+    manager:
+
+        from STEMWizard.async_api import AsyncSTEMWizardAPI
+
+        async with AsyncSTEMWizardAPI(configfile) as sw:
+            data = await sw.getProjectInfo()
+    '''
+    from .utils import read_config, set_region_info, request_headers
+
+    def __init__(self, configfile='stemwizardapi.yaml', max_connections=20):
+        '''
+        reads credentials from the specified configuration file, the session is opened by open() or async with
+        :param configfile: configfile: (default to stemwizardapi.yaml)
+        :param max_connections: size of the connection pool, requests beyond this wait for a free connection
+        '''
+        self.authenticated = None
+        self.session = None
+        self.max_connections = max_connections
+        self.region_domain = 'unknown'
+        self.region_id = None
+        self.token = None
+        self.csrf = None
+        self.username = None
+        self.password = None
+        self.read_config(configfile)
+        self.logger = get_logger(self.domain)
+        if self.username is None or len(self.username) < 6:
+            raise ValueError(f'did not find a valid username in {configfile}')
+        if self.password is None or len(self.password) < 6:
+            raise ValueError(f'did not find a valid password in {configfile}')
+        self.url_base = f'https://{self.domain}.stemwizard.com'
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def open(self, login_stemwizard=True):
+        '''
+        creates the pooled session, gathers region info and optionally authenticates
+        '''
+        connector = aiohttp.TCPConnector(limit=self.max_connections)
+        self.session = aiohttp.ClientSession(connector=connector, headers=headers)
+        await self.get_region_info()
+        if login_stemwizard:
+            self.authenticated = await self.login()
+        if self.region_domain != self.domain:
+            raise ValueError(
+                f'STEM Wizard returned a region domain of {self.region_domain}, which varies from the {self.domain} value in the config file')
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+            self.logger.info(f"destroyed session with {self.domain}")
+
+    async def get_region_info(self):
+        url = f'{self.url_base}/admin/login'
+        async with self.session.get(url, allow_redirects=True) as r:
+            if r.status >= 300:
+                self.logger.error(f"status code {r.status} on post to {url}")
+                return
+            html = await r.text()
+        self.set_region_info(*parse_region_info(html))
+
+    async def get_csrf_token(self):
+        if self.csrf is None:
+            url = f'{self.url_base}/filesAndForms'
+            async with self.session.get(url) as r:
+                if r.status >= 300:
+                    self.logger.error(f"status code {r.status} on post to {url}")
+                    return
+                html = await r.text()
+            csrf = parse_csrf_token(html)
+            if csrf is not None:
+                self.csrf = csrf
+            self.logger.info(f"gathered CSRF token {self.csrf}")
+
+    async def login(self):
+        if self.region_id is None:
+            await self.get_region_info()
+
+        payload = {'region_domain': self.domain,
+                   'region_id': self.region_id,
+                   'region': self.region_domain,
+                   '_token': self.token,
+                   'username': self.username,
+                   'password': self.password}
+
+        url_login = f'{self.url_base}/admin/authenticate'
+        async with self.session.post(url_login, data=_form(payload), headers=self.request_headers(),
+                                     allow_redirects=True) as rp:
+            if rp.status >= 300:
+                self.logger.error(f"status code {rp.status} on post to {url_login}")
+                return
+            authenticated = rp.status == 200
+        if authenticated:
+            self.logger.info(f"authenticated to {self.domain}")
+        else:
+            self.logger.error(f"failed to authenticate to {self.domain}")
+
+        await self.get_csrf_token()
+
+        return authenticated
+
+    async def _milestone_post(self, tab, category_id, page=1):
+        params, payload = milestone_request(tab, category_id, page=page, per_page=self.per_page)
+        url = f'{self.url_base}{milestone_path}'
+        if params is not None:
+            url = f"{url}?{params}"
+        async with self.session.post(url, data=_form(payload), headers=self.request_headers()) as r:
+            return await r.read(), r.get_encoding()
+
+    async def _fetch_category(self, tab, category_id):
+        '''
+        fetches every page of one category of a milestone tab, parsing off the event loop
+        :return: list of (student id, student data) in page order
+        '''
+        category_title = categories.get(category_id, category_id)
+        students = []
+        total = None
+        page = 1
+        while True:
+            body, encoding = await self._milestone_post(tab, category_id, page=page)
+            page_students = await asyncio.to_thread(
+                lambda: list(iter_page_rows(tab, [body], category_title, encoding=encoding)))
+            if page_students and page_students[-1][0] is None:
+                total = page_students.pop()[1]
+            if page > 1 and page_students and page_students[0][0] == students[-len(previous)][0]:
+                self.logger.warning(f"page {page} of {tab} {category_title} repeats page {page - 1}")
+                break
+            students.extend(page_students)
+            if not more_pages(len(students), len(page_students), total):
+                break
+            previous = page_students
+            page += 1
+        return students
+
+    async def _map_categories(self, tab):
+        '''
+        fetches every category of a milestone tab concurrently, results are merged in the order categories are listed
+        '''
+        if not self.authenticated:
+            self.authenticated = await self.login()
+        if self.fetch_mode == 'bulk':
+            return dict(order_by_category(await self._fetch_category(tab, '')))
+
+        data = {}
+        for students in await asyncio.gather(*[self._fetch_category(tab, category_id)
+                                               for category_id in categories.keys()]):
+            data.update(students)
+        return data
+
+    async def getProjectInfo(self):
+        return await self._map_categories('project')
+
+    async def get_files_and_forms(self):
+        return await self._map_categories('form')
+
+    async def getJudgesMaterials(self):
+        return await self._map_categories('file')
+
+    async def _student_file_detail(self, studentId, info_id):
+        await self.get_csrf_token()
+        url = f'{self.url_base}{file_detail_path}'
+        payload = {'studentId': studentId, 'info_id': info_id}
+        async with self.session.post(url, data=_form(payload),
+                                     headers=self.request_headers(referer=f'{self.url_base}/filesAndForms',
+                                                                  ajax=True)) as rfaf:
+            if rfaf.status >= 300:
+                self.logger.error(f"status code {rfaf.status} on post to {url}")
+                return
+            body, encoding = await rfaf.read(), rfaf.get_encoding()
+        if info_id is None:
+            self.logger.debug(f"getting student info ids for  {studentId}")
+            infoids = parse_student_info_ids([body], encoding=encoding)
+            details = await asyncio.gather(*[self._student_file_detail(studentId, infoid) for infoid in infoids])
+            data = {f"{studentId} {infoid}": detail for infoid, detail in zip(infoids, details)}
+        else:
+            self.logger.debug(f"getting file info for {studentId} {info_id}")
+            data = parse_student_file_detail([body], encoding=encoding)
+        return data
+
+    async def download_em(self, data):
+        '''
+        same selection rules as STEMWizardAPI.download_em, downloads run concurrently up to download_limits per host
+        '''
+        limits = {host: asyncio.Semaphore(limit) for host, limit in self.download_limits.items()}
+
+        async def limited(host, download):
+            async with limits[host]:
+                return await download
+
+        downloads = []
+        for id, v in data.items():
+            for filetype, filedata in v['files'].items():
+                if filetype in ['Abstract Form', '1C', '7']:  # duplicated on judge screen
+                    continue
+                if len(filedata['url']) > 0:
+                    for (url, local_filename, local_lastmod) in zip(filedata['url'], filedata['local_filename'],
+                                                                    filedata['local_lastmod']):
+                        if 'amazonaws.com' in url and local_lastmod is None:
+                            downloads.append(limited('s3', self.download_from_s3(url, local_filename)))
+                else:
+                    for (remote_filename, local_filename, local_lastmod) in zip(filedata['remote_filename'],
+                                                                                filedata['local_filename'],
+                                                                                filedata['local_lastmod']):
+                        if len(remote_filename) > 0 and local_lastmod is None:
+                            downloads.append(limited('stemwizard',
+                                                     self.download_from_stemwizard(remote_filename, local_filename)))
+        await asyncio.gather(*downloads)
+
+    async def download_from_s3(self, url, local_filename):
+        async with self.session.get(url) as r:
+            if r.status >= 300:
+                self.logger.error(f"status code {r.status} on post to {url}")
+                return
+            return await self._download_to_local_file_path(local_filename, r)
+
+    async def download_from_stemwizard(self, filename_remote, local_file_path, remotedir='images/milestone_uploads',
+                                       referer='FilesAndForms'):
+        await self.get_csrf_token()
+        url = f'{self.url_base}/fairadmin/fileDownload'
+
+        payload = {'_token': self.token,
+                   'download_filen_path': '/EBS-Stem/stemwizard/webroot/stemwizard/public/assets/images/milestone_uploads',
+                   'download_hideData': filename_remote,
+                   }
+
+        async with self.session.post(url, data=_form(payload),
+                                     headers=self.request_headers(
+                                         referer=f'{self.url_base}f/fairadmin/{referer}')) as rf:
+            if rf.status >= 300:
+                self.logger.error(f"status code {rf.status} on post to {url}")
+                return
+            return await self._download_to_local_file_path(local_file_path, rf)
+
+    async def _download_to_local_file_path(self, full_pathname, r):
+        '''
+        streams a response to disk, with file system calls made on worker threads so the event loop keeps serving
+        other downloads
+        '''
+        dir = os.path.dirname(f"files/{self.region_domain}/{full_pathname}")
+        await asyncio.to_thread(os.makedirs, dir, exist_ok=True)
+
+        if r.status >= 300:
+            raise Exception(f'{r.status}')
+        if r.headers['Content-Type'] == 'text/html':
+            self.logger.error(f"failed to download {full_pathname}")
+        else:
+            # as STEMWizardAPI, the file only appears once every promised byte has arrived
+            local_path = f"files/{self.region_domain}/{full_pathname}"
+            size = 0
+            f = await asyncio.to_thread(open, f"{local_path}.part", 'wb')
+            try:
+                async for chunk in r.content.iter_chunked(512 * 1024):
+                    await asyncio.to_thread(f.write, chunk)
+                    size += len(chunk)
+            finally:
+                await asyncio.to_thread(f.close)
+            if r.content_length is not None and 'Content-Encoding' not in r.headers and size != r.content_length:
+                raise IOError(f"downloaded {size} bytes for {full_pathname}, expected {r.content_length}")
+            await asyncio.to_thread(os.replace, f"{local_path}.part", local_path)
+            self.logger.info(f"download_to_local_file_path: downloaded to {full_pathname}")
@@ -0,0 +1,121 @@
+import hashlib
+import os
+import threading
+
+from .fileutils import read_json_cache, write_json_cache
+from .logstuff import get_logger
+
+logger = get_logger('blobs')
+
+
+class BlobStore(object):
+    '''
+    content addressed store for downloaded files.  Each distinct file is kept once, as blobs/<sha256[:2]>/<sha256>,
+    and the human readable paths under files/ are hard links to it (symbolic links when the filesystem won't
+    hard link).  An index from download source (S3 URL or STEM Wizard filename) to digest lets a file referenced
+    from several places, e.g. team files listed under each participant, be downloaded once and linked everywhere else.
+    '''
+
+    def __init__(self, blob_dir='files/blobs', index_filename='caches/blob_index.json', hasher=None):
+        '''
+        :param hasher: HashingEngine whose cached sha256s spare reading files already hashed, None to always read them
+        '''
+        self.hasher = hasher
+        self.blob_dir = blob_dir
+        self.index_filename = index_filename
+        self.lock = threading.Lock()
+        self.index = read_json_cache(index_filename, max_cache_age=float('inf'))
+        self.changed = False
+
+    def blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+    def lookup(self, source):
+        '''
+        :return: blob path previously stored for a download source, None if unknown or missing
+        '''
+        with self.lock:
+            digest = self.index.get(source)
+        if digest is None or not os.path.exists(self.blob_path(digest)):
+            return None
+        return self.blob_path(digest)
+
+    @staticmethod
+    def digest(path):
+        h = hashlib.sha256()
+        with open(path, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def ingest(self, path, source=None):
+        '''
+        moves a freshly downloaded file into the store, leaving a link to its blob in its place
+        :param path: downloaded file
+        :param source: download source to index the blob under
+        :return: blob path
+        '''
+        digest = self.digest(path) if self.hasher is None else self.hasher.digest(path, 'sha256')
+        blob = self.blob_path(digest)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        if os.path.exists(blob):
+            logger.debug(f"{path} duplicates {blob}")
+            self.link(blob, path)  # seen before, drop the duplicate
+        else:
+            try:
+                os.link(path, blob)
+            except FileExistsError:  # another worker stored the same content since the check
+                self.link(blob, path)
+            except OSError:  # no hard links across devices or on this filesystem, the blob takes the file itself
+                os.replace(path, blob)
+                self.link(blob, path)
+        if source is not None:
+            with self.lock:
+                if self.index.get(source) != digest:
+                    self.index[source] = digest
+                    self.changed = True
+        return blob
+
+    def adopt(self, path, source=None):
+        '''
+        ingests a file already on disk unless it is already linked to the blob indexed for its source
+        :return: blob path
+        '''
+        blob = self.lookup(source) if source is not None else None
+        if blob is not None and os.path.samefile(blob, path):
+            return blob
+        return self.ingest(path, source=source)
+
+    @staticmethod
+    def link(blob, path):
+        '''
+        points path at a blob, atomically replacing whatever was there
+        '''
+        if os.path.exists(path) and os.path.samefile(blob, path):
+            return  # already linked, and rename() between two links to one file would do nothing
+        directory = os.path.dirname(path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        tmp = os.path.join(directory, f".tmp_{os.getpid()}_{threading.get_ident()}_{os.path.basename(path)}")
+        try:
+            os.link(blob, tmp)
+        except OSError:
+            os.symlink(os.path.relpath(blob, directory), tmp)
+        os.replace(tmp, path)
+
+    def save(self):
+        with self.lock:
+            if self.changed:
+                write_json_cache(self.index, self.index_filename)
+                self.changed = False
+
+    def usage(self):
+        '''
+        :return: tuple of (number of blobs, total bytes) held by the store
+        '''
+        count = 0
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(self.blob_dir):
+            for filename in filenames:
+                count += 1
+                total += os.path.getsize(os.path.join(dirpath, filename))
+        return count, total
@@ -0,0 +1,67 @@
+import copy
+import hashlib
+import json
+import os
+
+from .fileutils import read_json_cache, write_json_cache
+from .logstuff import get_logger
+
+# per student snapshots of merged milestone rows, used by studentSync(delta=True) to send only students whose rows
+# changed since the last completed sync through team patching, downloading and uploading.
+#
+# snapshot files map student id to {'hash': sha256 of the merged row, 'patched': the row after team patching}.
+# 'patched' is left out when the rows of the last sync are kept in a StudentStore instead
+
+logger = get_logger('delta')
+
+
+def row_hash(studentdata):
+    '''
+    stable digest of a student's merged milestone row
+    :param studentdata: merged row for one student
+    :return: hex sha256
+    '''
+    return hashlib.sha256(json.dumps(studentdata, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def read_snapshot(snapshot_filename):
+    if not os.path.isfile(snapshot_filename):
+        logger.info(f"no snapshot in {snapshot_filename}, every student will be processed")
+        return {}
+    return read_json_cache(snapshot_filename, max_cache_age=float('inf'))
+
+
+def write_snapshot(snapshot, snapshot_filename):
+    write_json_cache(snapshot, snapshot_filename)
+
+
+def diff_snapshot(data, snapshot, stored=()):
+    '''
+    compares freshly merged rows with the previous snapshot
+    :param data: merged rows keyed by student id
+    :param snapshot: previous snapshot, may be empty
+    :param stored: ids of the students whose rows can be read back from the store rather than the snapshot
+    :return: tuple of (hashes keyed by student id, ids of new or changed students in data order, ids of students
+             no longer present)
+    '''
+    hashes = {studentid: row_hash(studentdata) for studentid, studentdata in data.items()}
+    changed = [studentid for studentid, digest in hashes.items()
+               if studentid not in snapshot or snapshot[studentid].get('hash') != digest
+               or ('patched' not in snapshot[studentid] and studentid not in stored)]
+    removed = [studentid for studentid in snapshot.keys() if studentid not in hashes]
+    logger.info(f"{len(changed)} of {len(hashes)} students new or changed, {len(removed)} removed")
+    return hashes, changed, removed
+
+
+def update_snapshot(hashes, patched=None):
+    '''
+    builds the snapshot to save once a sync completes
+    :param hashes: from diff_snapshot
+    :param patched: team patched rows keyed by student id, copied so later phases can't alter the snapshot.  None
+                    when the rows are kept in a store, the snapshot then only holds hashes
+    :return: snapshot
+    '''
+    if patched is None:
+        return {studentid: {'hash': digest} for studentid, digest in hashes.items()}
+    return {studentid: {'hash': digest, 'patched': copy.deepcopy(patched[studentid])}
+            for studentid, digest in hashes.items()}
@@ -0,0 +1,191 @@
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import requests
+from tqdm import tqdm
+
+from .fileutils import read_json_cache, write_json_cache
+from .logstuff import get_logger
+
+logger = get_logger('downloads')
+
+# concurrent downloads allowed per host.  S3 serves large files happily in parallel, the STEM Wizard host is a
+# single application server shared with everyone using the fair
+default_limits = {'s3': 6, 'stemwizard': 2}
+
+
+class DownloadRecords(object):
+    '''
+    validators (ETag, Last-Modified and Content-Length) of every file downloaded, keyed by local filename and kept
+    between runs so a file already on disk can be checked with a conditional request instead of fetched again
+    '''
+
+    def __init__(self, records_filename='caches/download_records.json'):
+        self.records_filename = records_filename
+        self.lock = threading.Lock()
+        self.records = read_json_cache(records_filename, max_cache_age=float('inf'))
+        self.changed = False
+
+    def get(self, local_filename):
+        with self.lock:
+            return self.records.get(local_filename)
+
+    def set(self, local_filename, headers, content_length=None):
+        '''
+        records the validators a response was served with
+        :param content_length: full length of the file, defaults to the Content-Length header
+        '''
+        record = {'etag': headers.get('ETag'),
+                  'last_modified': headers.get('Last-Modified'),
+                  'content_length': str(content_length) if content_length is not None else headers.get(
+                      'Content-Length')}
+        with self.lock:
+            if self.records.get(local_filename) != record:
+                self.records[local_filename] = record
+                self.changed = True
+
+    def save(self):
+        with self.lock:
+            if self.changed:
+                write_json_cache(self.records, self.records_filename)
+                self.changed = False
+
+    @staticmethod
+    def conditional_headers(record):
+        '''
+        :return: If-None-Match and If-Modified-Since headers for a record, empty if it has no validators
+        '''
+        result = {}
+        if record is not None and record.get('etag'):
+            result['If-None-Match'] = record['etag']
+        if record is not None and record.get('last_modified'):
+            result['If-Modified-Since'] = record['last_modified']
+        return result
+
+    @staticmethod
+    def unchanged(record, headers, local_size):
+        '''
+        decides whether a full response describes the file already on disk, for servers that ignore conditional
+        requests.  ETags are compared first, then Last-Modified and length.  Without validators, only the length
+        can be compared with the local copy, and with no length either the local copy is kept: a response that says
+        nothing about the file is no reason to download it again
+        :param record: stored record, may be None
+        :param headers: response headers
+        :param local_size: size of the local copy
+        '''
+        record = record or {}
+        if headers.get('ETag') and record.get('etag'):
+            return headers['ETag'] == record['etag']
+        if headers.get('Last-Modified') and record.get('last_modified'):
+            return headers['Last-Modified'] == record['last_modified'] and \
+                   headers.get('Content-Length') == record.get('content_length')
+        if 'Content-Length' not in headers or 'Content-Encoding' in headers:
+            return True
+        return int(headers['Content-Length']) == local_size
+
+
+class DownloadEngine(object):
+    '''
+    downloads many files at once, with a separate worker pool, and so a separate concurrency limit, per host.
+    Each worker thread keeps its own session so connections are reused from one file to the next.  Workers
+    report progress on a queue which the calling thread turns into a progress bar, a log line per file and a
+    throughput summary.
+    '''
+
+    def __init__(self, sw, limits=None):
+        '''
+        :param sw: STEMWizardAPI whose download_from_s3 and download_from_stemwizard do the transfers
+        :param limits: concurrent downloads per host, keys s3 and stemwizard
+        '''
+        self.sw = sw
+        self.limits = dict(default_limits if limits is None else limits)
+        self.progress = queue.Queue()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.sessions = []
+
+    def _session(self, host):
+        # each host has its own executor, so a thread only ever needs the session for one host
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = requests.Session() if host == 's3' else self.sw._clone_session()
+            self.local.session = session
+            with self.lock:
+                self.sessions.append(session)
+        return session
+
+    def _download(self, host, source, local_filename, force):
+        start = time.perf_counter()
+        session = self._session(host)
+
+        def progress(nbytes):
+            self.progress.put(('bytes', local_filename, nbytes))
+
+        if host == 's3':
+            downloaded = self.sw.download_from_s3(source, local_filename, session=session, progress=progress,
+                                                  force=force)
+        else:
+            downloaded = self.sw.download_from_stemwizard(source, local_filename, session=session, progress=progress,
+                                                          force=force)
+        if downloaded is None:  # neither downloaded (True) nor found unchanged (False)
+            raise IOError(f"nothing downloaded for {local_filename}")
+        self.progress.put(('done' if downloaded else 'fresh', local_filename,
+                           time.perf_counter() - start))
+
+    def run(self, jobs):
+        '''
+        downloads every job, returning once all have finished.  Failures are logged rather than raised
+        :param jobs: list of (host, source, local filename, force), host is s3 (source is a URL) or stemwizard
+                     (source is the remote filename).  Files already present are only fetched if changed, unless
+                     force is set
+        :return: dictionary of files (downloaded), fresh (present and unchanged), bytes, seconds and failed (list
+                 of local filenames)
+        '''
+        executors = {host: ThreadPoolExecutor(max_workers=limit, thread_name_prefix=f'download_{host}')
+                     for host, limit in self.limits.items()}
+        start = time.perf_counter()
+        futures = {executors[host].submit(self._download, host, source, local_filename, force): local_filename
+                   for host, source, local_filename, force in jobs}
+        received = {}
+        total = 0
+        fresh = 0
+        failed = []
+        bar = tqdm(total=len(futures), desc='download', unit='file')
+        pending = set(futures.keys())
+        while True:
+            while True:
+                try:
+                    event, local_filename, value = self.progress.get_nowait()
+                except queue.Empty:
+                    break
+                if event == 'bytes':
+                    received[local_filename] = received.get(local_filename, 0) + value
+                    total += value
+                    bar.set_postfix_str(f"{total / 1024 / 1024 / max(time.perf_counter() - start, 0.001):.1f}MB/s",
+                                        refresh=False)
+                elif event == 'fresh':
+                    fresh += 1
+                    logger.debug(f"{local_filename} unchanged, checked in {value:.1f}s")
+                else:
+                    nbytes = received.pop(local_filename, 0)
+                    logger.info(f"downloaded {local_filename} {nbytes / 1024:.0f}KB in {value:.1f}s")
+            if len(pending) == 0:
+                break
+            done, pending = wait(pending, timeout=0.5)
+            for future in done:
+                bar.update(1)
+                if future.exception() is not None:
+                    failed.append(futures[future])
+                    logger.error(f"failed to download {futures[future]}: {future.exception()}")
+        bar.close()
+        for executor in executors.values():
+            executor.shutdown()
+        for session in self.sessions:
+            session.close()
+        elapsed = time.perf_counter() - start
+        downloaded = len(futures) - len(failed) - fresh
+        logger.info(f"downloaded {downloaded} files, {total / 1024 / 1024:.1f}MB in {elapsed:.1f}s "
+                    f"({total / 1024 / 1024 / max(elapsed, 0.001):.1f}MB/s), {fresh} unchanged, {len(failed)} failed")
+        return {'files': downloaded, 'fresh': fresh, 'bytes': total, 'seconds': elapsed, 'failed': failed}
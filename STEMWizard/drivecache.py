@@ -0,0 +1,206 @@
+import json
+import os
+import threading
+
+from .fileutils import read_json_cache, write_json_cache
+from .logstuff import get_logger
+
+# the Google Drive cache is kept as a snapshot of every node plus a journal of the node changes made since,
+# one JSON record per line:
+#   {"put": record}        node created or updated, see DriveNode.record
+#   {"remove": id}         node trashed or deleted
+#   {"meta": {...}}        listing state (last_updated, last_checked, page_token, root, root_id)
+# Loading replays the journal over the snapshot.  Compaction writes a fresh snapshot in the background, after moving
+# the journal aside so appends carry on into a new one.  Records are idempotent, so replaying a moved journal over
+# the snapshot that already contains it, after a crash mid compaction, does no harm.  A torn last line is ignored.
+
+logger = get_logger('drivecache')
+
+# partial response fields requested for every file, all the sync reads
+file_fields = 'id,title,parents(id),mimeType,modifiedDate,md5Checksum,labels/trashed'
+
+
+class DriveNode(object):
+    '''
+    the parts of a Drive file's metadata the cache keeps, far smaller than pydrive's full metadata
+    '''
+    __slots__ = ('id', 'title', 'parents', 'mimeType', 'modifiedDate', 'trashed', 'md5Checksum', 'fullpath')
+
+    def __init__(self, id, title, parents, mimeType, modifiedDate, trashed=False, md5Checksum=None, fullpath=''):
+        '''
+        :param parents: tuple of parent ids
+        :param md5Checksum: digest of the content, None for folders and Google Docs
+        '''
+        self.id = id
+        self.title = title
+        self.parents = parents
+        self.mimeType = mimeType
+        self.modifiedDate = modifiedDate
+        self.trashed = trashed
+        self.md5Checksum = md5Checksum
+        self.fullpath = fullpath
+
+    def __repr__(self):
+        return f"DriveNode({self.id!r}, {self.fullpath or self.title!r})"
+
+    @classmethod
+    def from_api(cls, fileinfo):
+        '''
+        :param fileinfo: file metadata from the Drive API, or a node cached before nodes were records
+        '''
+        return cls(fileinfo['id'], fileinfo['title'], tuple([parent['id'] for parent in fileinfo.get('parents', [])]),
+                   fileinfo['mimeType'], fileinfo.get('modifiedDate'), fileinfo.get('labels', {}).get('trashed', False),
+                   fileinfo.get('md5Checksum'))
+
+    def record(self):
+        '''
+        :return: the node as a list, as it is kept in the snapshot and journal.  fullpath is left out, it is rebuilt
+                 from the tree on load
+        '''
+        return [self.id, self.title, list(self.parents), self.mimeType, self.modifiedDate, self.trashed,
+                self.md5Checksum]
+
+    @classmethod
+    def from_record(cls, record):
+        if isinstance(record, dict):
+            return cls.from_api(record)
+        return cls(record[0], record[1], tuple(record[2]), *record[3:])
+
+
+def record_id(record):
+    return record['id'] if isinstance(record, dict) else record[0]
+
+
+class DriveCacheJournal(object):
+    '''
+    snapshot plus append-only journal holding NCSEFGoogleDrive's cache
+    '''
+
+    def __init__(self, snapshot_filename='caches/GoogleDriveCache.json', compact_after=2000):
+        '''
+        :param snapshot_filename: snapshot, the journal is kept alongside it with a .journal suffix
+        :param compact_after: journal records after which due() suggests compacting
+        '''
+        self.snapshot_filename = snapshot_filename
+        self.journal_filename = f"{snapshot_filename}.journal"
+        self.old_journal_filename = f"{snapshot_filename}.journal.old"
+        self.compact_after = compact_after
+        self.lock = threading.Lock()
+        self.fp = None
+        self.entries = 0
+        self.compactor = None
+
+    def _replay(self, state, filename):
+        if not os.path.exists(filename):
+            return 0
+        count = 0
+        with open(filename, 'rb') as fp:
+            for line in fp:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.warning(f"ignoring torn record at the end of {filename}")
+                    break
+                if 'put' in record:
+                    state['ids'][record_id(record['put'])] = record['put']
+                elif 'remove' in record:
+                    state['ids'].pop(record['remove'], None)
+                else:
+                    state.update(record['meta'])
+                count += 1
+        return count
+
+    def load(self):
+        '''
+        :return: the cache, snapshot with journal applied, with node records keyed by id in ids.  Empty dictionary if
+                 there is none
+        '''
+        state = read_json_cache(self.snapshot_filename, max_cache_age=float('inf'))
+        if 'nodes' in state:
+            state['ids'] = {record_id(record): record for record in state.pop('nodes')}
+        if not os.path.exists(self.journal_filename) and not os.path.exists(self.old_journal_filename):
+            return state
+        state.setdefault('ids', {})
+        self.entries = self._replay(state, self.old_journal_filename) + self._replay(state, self.journal_filename)
+        logger.debug(f"replayed {self.entries} journal records over {self.snapshot_filename}")
+        return state
+
+    def _append(self, record):
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self.lock:
+            if self.fp is None:
+                self.fp = open(self.journal_filename, 'a')
+            self.fp.write(line)
+            self.fp.flush()
+            self.entries += 1
+
+    def put(self, record):
+        self._append({'put': record})
+
+    def remove(self, nodeid):
+        self._append({'remove': nodeid})
+
+    def meta(self, **kwargs):
+        self._append({'meta': kwargs})
+
+    def due(self):
+        return self.entries >= self.compact_after
+
+    def compact(self, state, wait=False):
+        '''
+        replaces the snapshot with state and starts a new journal.  The snapshot is written on a background thread,
+        unless wait is set, and only one compaction runs at a time, a second one waits for the first to finish
+        :param state: the whole cache, as load returns it.  It must not be modified afterwards
+        '''
+        while True:
+            with self.lock:
+                running = self.compactor
+                if running is None or not running.is_alive():
+                    self._start_compaction(state)
+                    break
+            logger.debug('waiting for the running compaction')
+            running.join()
+        if wait:
+            self.wait()
+
+    def _start_compaction(self, state):
+        '''
+        moves the journal aside and writes the snapshot on a background thread, with the lock held
+        '''
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+        if os.path.exists(self.journal_filename):
+            if os.path.exists(self.old_journal_filename):
+                # left by a compaction that never finished, keep both until this one has
+                with open(self.journal_filename, 'rb') as src, open(self.old_journal_filename, 'ab') as dst:
+                    dst.write(src.read())
+                os.remove(self.journal_filename)
+            else:
+                os.replace(self.journal_filename, self.old_journal_filename)
+        self.entries = 0
+        self.compactor = threading.Thread(target=self._write_snapshot, args=(state,), name='drivecache_compact')
+        self.compactor.start()
+
+    def _write_snapshot(self, state):
+        snapshot = {k: v for k, v in state.items() if k != 'ids'}
+        snapshot['nodes'] = list(state.get('ids', {}).values())  # ids are in the records already
+        write_json_cache(snapshot, self.snapshot_filename)
+        if os.path.exists(self.old_journal_filename):
+            os.remove(self.old_journal_filename)
+        logger.debug(f"compacted {len(state.get('ids', {}))} nodes into {self.snapshot_filename}")
+
+    def wait(self):
+        '''
+        waits for a running compaction to finish
+        '''
+        compactor = self.compactor
+        if compactor is not None:
+            compactor.join()
+
+    def close(self):
+        self.wait()
+        with self.lock:
+            if self.fp is not None:
+                self.fp.close()
+                self.fp = None
@@ -1,54 +1,167 @@
 import json
 import olefile
 import pandas as pd
+import tempfile
 import time
 import os
+from datetime import datetime
 from .logstuff import get_logger
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 headers = {
     'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/96.0.4664.110 Safari/537.36'}
 
 logger = get_logger('cache_json')
 
+# caches are encoded by a codec: json (human readable, standard library), orjson (JSON, several times faster) or
+# msgpack (binary), optionally zstd compressed.  datetimes are tagged on the way out and come back as datetimes.
+# Reads detect the format from the file itself, so changing codec never strands an existing cache.  The codec is
+# json until read_config sets the cache_codec from the yaml file, whatever happens to be installed
+_datetime_tag = '__datetime__'
+_zstd_magic = b'\x28\xb5\x2f\xfd'
+cache_codec = 'json'
+cache_compress = False
+
+
+def set_cache_codec(codec, compress=False):
+    '''
+    selects the format used by write_json_cache
+    :param codec: json, orjson or msgpack
+    :param compress: zstd compress cache files
+    :return: nothing
+    '''
+    global cache_codec, cache_compress
+    if codec not in ['json', 'orjson', 'msgpack']:
+        raise ValueError(f'unknown cache codec {codec}')
+    if codec == 'orjson' and orjson is None or codec == 'msgpack' and msgpack is None:
+        raise ValueError(f'cache codec {codec} is not installed')
+    if compress and zstandard is None:
+        raise ValueError('zstandard is not installed, cache files cannot be compressed')
+    cache_codec = codec
+    cache_compress = compress
+
+
+def _tag(obj):
+    if isinstance(obj, datetime):
+        return {_datetime_tag: obj.isoformat()}
+    return str(obj)
+
+
+def _untag(obj):
+    if len(obj) == 1 and _datetime_tag in obj:
+        return datetime.fromisoformat(obj[_datetime_tag])
+    return obj
+
+
+def _untag_all(obj):
+    # orjson has no object hook, so tags are replaced after parsing
+    if isinstance(obj, dict):
+        if len(obj) == 1 and _datetime_tag in obj:
+            return _untag(obj)
+        for k, v in obj.items():
+            if isinstance(v, (dict, list)):
+                obj[k] = _untag_all(v)
+    elif isinstance(obj, list):
+        for n, v in enumerate(obj):
+            if isinstance(v, (dict, list)):
+                obj[n] = _untag_all(v)
+    return obj
+
+
+def encode_cache(cache, codec=None, compress=None):
+    codec = codec or cache_codec
+    compress = cache_compress if compress is None else compress
+    if codec == 'msgpack':
+        data = msgpack.packb(cache, default=_tag, datetime=False)
+    elif codec == 'orjson':
+        data = orjson.dumps(cache, default=_tag,
+                            option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS)
+    else:
+        data = json.dumps(cache, indent=2, default=_tag).encode()
+    if compress:
+        data = zstandard.ZstdCompressor().compress(data)
+    return data
+
+
+def decode_cache(data):
+    if data[:4] == _zstd_magic:
+        if zstandard is None:
+            raise ValueError('cache is zstd compressed and zstandard is not installed')
+        data = zstandard.ZstdDecompressor().decompress(data)
+    if data.lstrip()[:1] in (b'{', b'[', b'"'):
+        if orjson is not None:
+            cache = orjson.loads(data)
+            return _untag_all(cache) if _datetime_tag.encode() in data else cache
+        return json.loads(data, object_hook=_untag)
+    if msgpack is None:
+        raise ValueError('cache is msgpack encoded and msgpack is not installed')
+    return msgpack.unpackb(data, object_hook=_untag, strict_map_key=False)
+
+
+def atomic_write(filename, data):
+    '''
+    writes bytes to a temporary file in the same directory and renames it over filename, so readers only ever
+    see the old or the new contents
+    '''
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename) or '.', prefix='.tmp_')
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp, filename)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
 
 def write_json_cache(cache, cache_filename):
     '''
-    writes object to human readable JSON cache, forces to STR when necessary to seamlessly handle date objects
+    writes object to cache with the configured codec (see set_cache_codec), atomically
     :param cache: object to cache
     :param cache_filename: filename to use
     :return: nothing
     '''
-    fp = open(cache_filename, 'w')
-    json.dump(cache, fp, indent=2, default=str)
-    fp.close()
+    atomic_write(cache_filename, encode_cache(cache))
     logger.debug(f"wrote to {cache_filename}")
 
 
 def read_json_cache(cache_filename, max_cache_age=600):
     '''
-    reads from specified filename, returns empty dictionary if the file is too old
-    :param cache_filename: json filename
+    reads from specified filename, returns empty dictionary if the file is too old.  A cache that can't be decoded is
+    logged and renamed with a .corrupt suffix
+    :param cache_filename: cache filename, in any format write_json_cache has produced
     :param max_cache_age: maximum age in seconds
     :return: object (usually a dictionary) read from cache, empty dictionary if file is not found or too old
     '''
     try:
-        if os.path.isfile(cache_filename):
-            st = os.stat(cache_filename)
-            age = (time.time() - st.st_mtime)
-        else:
-            logger.debug(f"could not read a {cache_filename}")
-            age = 999999999999999
-        if age < max_cache_age:
-            fp = open(cache_filename, 'r')
-            cache = json.loads(fp.read())
-            fp.close()
-            logger.debug(f"read {round(age,1)} min old {cache_filename}")
-        else:
-            logger.debug(f"{round(age,1)} min old {cache_filename} needs to be recreated")
-            cache = {}
+        st = os.stat(cache_filename)
+        age = (time.time() - st.st_mtime)
+    except FileNotFoundError:
+        logger.debug(f"could not read a {cache_filename}")
+        return {}
+    if age >= max_cache_age:
+        logger.debug(f"{round(age,1)} min old {cache_filename} needs to be recreated")
+        return {}
+    try:
+        with open(cache_filename, 'rb') as fp:
+            cache = decode_cache(fp.read())
+        logger.debug(f"read {round(age,1)} min old {cache_filename}")
     except Exception as e:
-        print(e)
-        logger.error(e)
+        logger.error(f"corrupt cache {cache_filename}, moved to {cache_filename}.corrupt: {e}")
+        os.replace(cache_filename, f"{cache_filename}.corrupt")
         cache = {}
     return cache
 
@@ -1,15 +1,21 @@
 from STEMWizard.logstuff import get_logger
 import json
 import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from datetime import datetime, timezone
-from pprint import pprint
 
-import pytz
 from dateutil import parser
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaFileUpload
 from pydrive2.auth import GoogleAuth, ServiceAccountCredentials
 from pydrive2.drive import GoogleDrive
 from tqdm import tqdm
 
+from STEMWizard.drivecache import DriveCacheJournal, DriveNode, file_fields
+from STEMWizard.fileutils import read_json_cache, write_json_cache
+from STEMWizard.hashing import HashingEngine
 from STEMWizard.logstuff import get_logger
 
 logger = get_logger('google')
@@ -41,287 +47,764 @@ class NCSEFGoogleDrive(object):
 
                          }
 
-    def __init__(self, cache_file_name = 'caches/GoogleDriveCache.json'):
-        ''' instantiate object'''
+    def __init__(self, cache_file_name='caches/GoogleDriveCache.json', uploads_file_name='caches/google_uploads.json',
+                 chunksize=8 * 1024 * 1024, resumable_threshold=5 * 1024 * 1024, num_retries=3, root=None,
+                 list_workers=8, hasher=None):
+        '''
+        instantiate object
+        :param root: path of the folder to cache, e.g. /Automation, which is listed folder by folder and is all the
+                     cache holds.  None lists, and caches, everything the account can see
+        :param list_workers: folder listings in flight at once when listing a root
+        :param uploads_file_name: where the session URIs of unfinished resumable uploads are kept between runs
+        :param chunksize: bytes sent per request by resumable uploads, a multiple of 256KB
+        :param resumable_threshold: files larger than this are sent with a resumable upload, smaller ones in one request
+        :param num_retries: retries, with exponential backoff, of each request that fails with a 5xx or 429
+        :param hasher: HashingEngine giving the md5s of local files, to compare with Drive's before uploading
+        '''
         self.cache_file_name = cache_file_name
+        self.cache = DriveCacheJournal(cache_file_name)
+        self.uploads_file_name = uploads_file_name
+        self.chunksize = chunksize
+        self.resumable_threshold = resumable_threshold
+        self.num_retries = num_retries
+        self.root = root.rstrip('/') if root is not None else None
+        self.root_id = None
+        self.list_workers = list_workers
+        self.lock = threading.RLock()  # guards ids and the caches, shared by upload workers
+        self.folder_lock = threading.Lock()
+        self.local = threading.local()
+        self.uploads = read_json_cache(uploads_file_name, max_cache_age=float('inf'))
+        self.hasher = hasher if hasher is not None else HashingEngine()
         self.drive = self._auth()
-        self.ids = None
+        self.ids = None  # id -> DriveNode
+        self.paths = {}  # fullpath -> id
+        self.children = {}  # id -> set of child ids
         self.last_updated = None
         self.last_checked = None
+        self.page_token = None  # changes feed position, see list_all
         self.list_all()
-    #
-    # def __str__(self, indent_character=' ', show_emoji=True, root=None):
-    #     '''output object as a string'''
-    #     indent = 0
-    #     response = ""
-    #     for id, node in self.ids.items():
-    #         if node['labels']['trashed']:
-    #             continue  # ignore trash, we shouldn't be working with it from the API anyway
-    #         elif root is not None:
-    #             if node['fullpath'] == root:
-    #                 response += self._node_output(node, root=root, indent_character=indent_character,
-    #                                               show_emoji=show_emoji)
-    #         elif len(node['parents']) == 0:
-    #             response += self._node_output(node)
-    #     return response
-    #
-    # def dump(self, root, indent_character=' ', show_emoji=True, ):
-    #     return (self.__str__(root=root, indent_character=indent_character, show_emoji=show_emoji))
-    #
-    # def _auth(self):
-    #     ''' authenticate with Google Drive API '''
-    #     gauth = GoogleAuth()
-    #     scope = ['https://www.googleapis.com/auth/drive']
-    #     gauth.credentials = ServiceAccountCredentials.from_json_keyfile_name('client_secrets.json', scope)
-    #     drive = GoogleDrive(gauth)
-    #     return drive
-    #
-    # def _node_output(self, node, indent=0, indent_character=" ", show_emoji=True, root=None):
-    #     response = ''
-    #     if root is None or node['fullpath'].startswith(root):
-    #         mt = ''
-    #         if show_emoji:
-    #             if 'folder' in node['mimeType']:
-    #                 emoji = '📁'
-    #             elif 'zip' in node['mimeType'] or 'tar' in node['mimeType']:
-    #                 emoji = '🗜️'
-    #             elif 'image' in node['mimeType']:
-    #                 emoji = '🖼️'
-    #             elif 'pdf' in node['mimeType']:
-    #                 emoji = '🅿️'
-    #             elif 'sheet' in node['mimeType']:
-    #                 emoji = '🔢'
-    #             elif 'text' in node['mimeType']:
-    #                 emoji = '📄'
-    #             else:
-    #                 emoji = '📄'
-    #         response = (f"{indent_character * indent}{emoji}{node['fullpath']}\n")
-    #         for child in set(node['children']):
-    #             response += self._node_output(self.ids[child], indent=indent + 1, indent_character=indent_character)
-    #     return response
-    #
-    # def _buildpath(self, node, path):
-    #     node['fullpath'] = f"{path}/{node['title']}"
-    #     for child in set(node['children']):
-    #         if child in self.ids.keys():
-    #             self._buildpath(self.ids[child], node['fullpath'])
-    #         else:
-    #             raise ValueError(f"{child} id not found under {node['title']}")
-    #
-    # def _write_cache(self):
-    #     fp = open(self.cache_file_name, 'w')
-    #     json.dump({'ids': self.ids,
-    #                'last_updated': self.last_updated,
-    #                'last_checked': self.last_checked}, fp, indent=2)
-    #     fp.close()
-    #
-    # def _find_file(self, fullpath, refresh=False):
-    #     found = False
-    #     isafolder = False
-    #     elements = fullpath.split('/')
-    #     parentpath = '/'.join(elements[:-1])
-    #     title = None
-    #     parentid = None
-    #     nodeid = None
-    #     nodedata = None
-    #
-    #     for id, data in self.ids.items():
-    #         if data['fullpath'] == parentpath:
-    #             parentid = id
-    #         if data['fullpath'] == fullpath:
-    #             found = True
-    #             nodeid = id
-    #             title = data['title']
-    #             nodedata = data
-    #             isafolder = data['mimeType'] == NCSEFGoogleDrive.FOLDER_MIME_TYPE
-    #     if not found and refresh:
-    #         self.list_all(force=True)
-    #         nodeid, parentid, parentpath, title, isafolder = self._find_file(fullpath, refresh=False)
-    #     return nodeid, parentid, parentpath, title, isafolder
-    #
-    # def list_all(self, id=None, cache_checked_ttl=300, cache_update_ttl=21600, force=False):
-    #     try:
-    #         fp = open(self.cache_file_name, 'r')
-    #         cache = json.loads(fp.read())
-    #         fp.close()
-    #         cache_by_id = cache['ids']
-    #         last_updated = cache['last_updated']
-    #         last_checked = cache['last_checked']
-    #     except Exception as e:
-    #         print(f'error {e}')
-    #         cache_by_id = {}
-    #         cache_by_tree = {}
-    #         last_updated = '1970-01-01T00:00:00.000Z'
-    #         last_checked = '1970-01-01T00:00:00.000Z'
-    #     utcnow = datetime.utcnow().replace(tzinfo=timezone.utc)
-    #     checked_delta = utcnow - parser.isoparse(last_checked)
-    #     updated_delta = utcnow - parser.isoparse(last_updated)
-    #
-    #     if force or checked_delta.total_seconds() > cache_checked_ttl or updated_delta.total_seconds() > cache_update_ttl:
-    #         logger.info(f'refetching file info, last checked {checked_delta.total_seconds() / 60:.1f} minutes ago')
-    #         last_checked = utcnow.isoformat()
-    #         for file_list in self.drive.ListFile({'q': 'trashed=false', 'maxResults': 500}):
-    #             for fileinfo in file_list:
-    #                 # if fileinfo['mimeType'] == NCSEFGoogleDrive.FOLDER_MIME_TYPE:
-    #                 #     pass
-    #                 # elif 'shortcut' in fileinfo['mimeType']:
-    #                 #     continue
-    #                 cache_by_id[fileinfo['id']] = fileinfo
-    #                 cache_by_id[fileinfo['id']]['children'] = []
-    #                 cache_by_id[fileinfo['id']]['fullpath'] = ''
-    #     else:
-    #         logger.debug(f'using cached file info, last checked {checked_delta.total_seconds() / 60:.1f} minutes ago')
-    #
-    #     for id, data in cache_by_id.items():
-    #         if data['modifiedDate'] > last_updated:
-    #             last_updated = data['modifiedDate']
-    #
-    #         for parent in data['parents']:
-    #             if parent['id'] not in cache_by_id.keys():
-    #                 continue  # likely in trash
-    #             cache_by_id[parent['id']]['children'].append(id)
-    #
-    #     self.ids = cache_by_id
-    #     self.last_updated = last_updated
-    #     self.last_checked = last_checked
-    #
-    #     # add full path to all nodes, de-dupe children
-    #     for id, data in cache_by_id.items():
-    #         if len(data['parents']) == 0:
-    #             self._buildpath(data, '')
-    #         data['children'] = list(set(data['children']))
-    #
-    #     self._write_cache()
-    #
-    # def create_shortcut(self, fullpath_link_to, folder_to_put_link_in, title):
-    #     shortcut, _, _, _, _ = self._find_file(f"{folder_to_put_link_in}/{title}", refresh=False)
-    #     if not shortcut:
-    #         id_to_link_to, _, _, _, _ = self._find_file(fullpath_link_to)
-    #         id_to_create_link_in, _, _, _, _ = self._find_file(folder_to_put_link_in)
-    #
-    #         shortcut_metadata = {
-    #             "title": title,
-    #             'mimeType': 'application/vnd.google-apps.shortcut',
-    #             "parents": [{"id": id_to_create_link_in}],
-    #             "shortcutDetails": {"targetId": id_to_link_to,
-    #                                 "targetMimeType": 'application/vnd.google-apps.folder'}
-    #         }
-    #         shortcut = self.drive.CreateFile(shortcut_metadata)
-    #         try:
-    #             shortcut.Upload()
-    #         except Exception as e:
-    #             logger.error(f"error creating link to  {fullpath_link_to} in {folder_to_put_link_in} as {title}")
-    #
-    #     return shortcut
-    #
-    # def create_file(self, localpath, remotepath, mimeType='application/vnd.google-apps.file', update_on='newer'):
-    #     nodeid, parentid, parentpath, title, isafolder = self._find_file(remotepath)
-    #     upload = None
-    #     if nodeid and update_on == 'newer':
-    #         remotemtime = parser.parse(self.ids[nodeid]['modifiedDate'])
-    #         # OS returns timezone unaware in the local timezone, gotta make it aware for comparison
-    #         localmtime = datetime.fromtimestamp(os.path.getmtime(localpath))
-    #         localmtime = localmtime.replace(tzinfo=pytz.timezone('America/New_York'))
-    #         upload = update_on == 'newer' and localmtime > remotemtime
-    #     else:
-    #         upload = True
-    #
-    #     if upload:
-    #         elements = remotepath.split('/')
-    #         title = elements[-1]
-    #         if not parentid:
-    #             logger.debug(f'creating {parentpath}')
-    #             parentitem = self.create_folder(parentpath)
-    #             parentid = parentitem['id']
-    #         if nodeid:
-    #             item = self.drive.CreateFile({'id': nodeid})
-    #             item.SetContentFile(localpath)
-    #             item.Upload()
-    #             logger.info(f'updated {remotepath} {nodeid} from {localpath}')
-    #         else:
-    #             for ext, mtype in NCSEFGoogleDrive.common_mime_types.items():
-    #                 if localpath.endswith(f'.{ext}'):
-    #                     mimeType = mtype
-    #             metadata = {"title": title, "parents": [{"id": parentid}], "mimeType": mimeType}
-    #             item = self.drive.CreateFile(metadata)
-    #             item.SetContentFile(localpath)
-    #             try:
-    #                 item.Upload()
-    #             except:
-    #                 print(localpath)
-    #                 pprint(metadata)
-    #             logger.info(f'created {remotepath}')
-    #     elif update_on == 'newer' and localmtime < remotemtime:
-    #         logger.info(f'no update needed for {remotepath}')
-    #     else:
-    #         logger.error('create_file unknown error')
-    #
-    # def create_folder(self, full_remote_path, expectedroot='Automation', refresh=True):
-    #     item = {}
-    #     nodeid, parentid, parentpath, title, isafolder = self._find_file(full_remote_path)
-    #     if nodeid and not isafolder:
-    #         logger.error(f"{full_remote_path} already exists as a non-folder")
-    #     elif nodeid:
-    #         metadata = {"title": title, "parents": [{"id": parentid}], 'id': id}
-    #         return metadata
-    #     else:
-    #         elements = full_remote_path.split('/')
-    #         parentpath = '/'.join(elements[:-1])
-    #         title = elements[-1]
-    #         if parentid is None:
-    #             raise ValueError(f'parent folder {parentpath} not found')
-    #         metadata = {"title": title, "parents": [{"id": parentid}],
-    #                     "mimeType": NCSEFGoogleDrive.FOLDER_MIME_TYPE}
-    #         item = self.drive.CreateFile(metadata)
-    #         item.Upload()
-    #
-    #         # update local cache
-    #         item['fullpath'] = full_remote_path
-    #         item['children'] = []
-    #         self.ids[item['id']] = item
-    #         self._write_cache()
-    #
-    #         parentid = item['id']
-    #         logger.info(f"created {title} in {parentpath} {item['id']}")
-    #
-    #         if refresh:
-    #             self.list_all(cache_update_ttl=0)
-    #     return item
-    #
-    # def clean_empty_dirs(self, parentid='1wiIOz_ZdPHoOBNjJcb1HX-L2NqX5urQx'):
-    #     ids = set()
-    #     for id, data in self.ids.items():
-    #         if 'folder' not in data['mimeType']:
-    #             continue
-    #         if len(data['parents']) == 0:
-    #             continue
-    #         if data['parents'][0]['id'] != parentid:
-    #             continue
-    #         if len(data['children']) > 0:
-    #             continue
-    #         ids.add(id)
-    #     for id in tqdm(ids):
-    #         item = self.drive.CreateFile({'id': data['id']})
-    #         item.Trash()
-    #
-    # def clean_single_file_dirs(self, parentid='1wiIOz_ZdPHoOBNjJcb1HX-L2NqX5urQx'):
-    #     idstopurge = set()
-    #     for id, data in tqdm(self.ids.items()):
-    #         if 'folder' not in data['mimeType']:
-    #             continue
-    #         if len(data['parents']) == 0:
-    #             continue
-    #         if data['parents'][0]['id'] != parentid:
-    #             continue
-    #         if len(data['children']) > 1:
-    #             continue
-    #         print(id, data['title'])
-    #         idstopurge.add(id)
-    #     for id in tqdm(idstopurge):
-    #         if id == parentid:
-    #             raise ValueError('no not this one')
-    #         item = self.drive.CreateFile({'id': data['id']})
-    #         item.Trash()
+
+
+    def __str__(self, indent_character=' ', show_emoji=True, root=None):
+        '''output object as a string'''
+        indent = 0
+        response = ""
+        for id, node in self.ids.items():
+            if node.trashed:
+                continue  # ignore trash, we shouldn't be working with it from the API anyway
+            elif root is not None:
+                if node.fullpath == root:
+                    response += self._node_output(node, root=root, indent_character=indent_character,
+                                                  show_emoji=show_emoji)
+            elif len(node.parents) == 0:
+                response += self._node_output(node)
+        return response
+
+    def dump(self, root, indent_character=' ', show_emoji=True, ):
+        return (self.__str__(root=root, indent_character=indent_character, show_emoji=show_emoji))
+
+    def _auth(self):
+        ''' authenticate with Google Drive API '''
+        gauth = GoogleAuth()
+        scope = ['https://www.googleapis.com/auth/drive']
+        gauth.credentials = ServiceAccountCredentials.from_json_keyfile_name('client_secrets.json', scope)
+        drive = GoogleDrive(gauth)
+        return drive
+
+    def _node_output(self, node, indent=0, indent_character=" ", show_emoji=True, root=None):
+        response = ''
+        if root is None or node.fullpath.startswith(root):
+            mt = ''
+            if show_emoji:
+                if 'folder' in node.mimeType:
+                    emoji = '📁'
+                elif 'zip' in node.mimeType or 'tar' in node.mimeType:
+                    emoji = '🗜️'
+                elif 'image' in node.mimeType:
+                    emoji = '🖼️'
+                elif 'pdf' in node.mimeType:
+                    emoji = '🅿️'
+                elif 'sheet' in node.mimeType:
+                    emoji = '🔢'
+                elif 'text' in node.mimeType:
+                    emoji = '📄'
+                else:
+                    emoji = '📄'
+            response = (f"{indent_character * indent}{emoji}{node.fullpath}\n")
+            for child in self.children.get(node.id, ()):
+                response += self._node_output(self.ids[child], indent=indent + 1, indent_character=indent_character)
+        return response
+
+    def _buildpath(self, node, path):
+        node.fullpath = f"{path}/{node.title}"
+        self.paths[node.fullpath] = node.id
+        for child in self.children.get(node.id, ()):
+            if child in self.ids.keys():
+                self._buildpath(self.ids[child], node.fullpath)
+            else:
+                raise ValueError(f"{child} id not found under {node.title}")
+
+    def _index(self):
+        '''
+        rebuilds the parent -> children and fullpath -> id indexes from self.ids
+        '''
+        with self.lock:
+            self.children = {id: set() for id in self.ids.keys()}
+            for id, data in self.ids.items():
+                for parent in data.parents:
+                    if parent not in self.children:
+                        continue  # likely in trash
+                    self.children[parent].add(id)
+            self.paths = {}
+            for id, data in self.ids.items():
+                data.fullpath = ''
+            for id, data in self.ids.items():
+                if len(data.parents) == 0:
+                    self._buildpath(data, '')
+            if self.root_id in self.ids:
+                self._buildpath(self.ids[self.root_id], self.root.rsplit('/', 1)[0])
+
+    def _state(self):
+        # records are copies, so a snapshot written in the background isn't changed under it
+        return {'ids': {id: node.record() for id, node in self.ids.items()},
+                'last_updated': self.last_updated,
+                'last_checked': self.last_checked,
+                'page_token': self.page_token,
+                'root': self.root,
+                'root_id': self.root_id,
+                'fields': file_fields}
+
+    def _write_cache(self, snapshot=False):
+        '''
+        nodes are journaled as they change, this records the listing state alongside them and, after a full listing
+        or once the journal has grown long, compacts everything into a new snapshot in the background
+        :param snapshot: compact now
+        '''
+        with self.lock:
+            if snapshot or self.cache.due():
+                self.cache.compact(self._state())
+            else:
+                self.cache.meta(last_updated=self.last_updated, last_checked=self.last_checked,
+                                page_token=self.page_token, root=self.root, root_id=self.root_id)
+
+    def close(self):
+        '''
+        waits for the cache to be written
+        '''
+        self.cache.close()
+
+    def _find_file(self, fullpath, refresh=False):
+        isafolder = False
+        elements = fullpath.split('/')
+        parentpath = '/'.join(elements[:-1])
+        title = None
+        with self.lock:
+            parentid = self.paths.get(parentpath)
+            nodeid = self.paths.get(fullpath)
+            if nodeid is not None:
+                title = self.ids[nodeid].title
+                isafolder = self.ids[nodeid].mimeType == NCSEFGoogleDrive.FOLDER_MIME_TYPE
+        if nodeid is None and refresh:
+            self.list_all(force=True)
+            nodeid, parentid, parentpath, title, isafolder = self._find_file(fullpath, refresh=False)
+        return nodeid, parentid, parentpath, title, isafolder
+
+    def list_all(self, id=None, cache_checked_ttl=300, cache_update_ttl=21600, force=False, full=False):
+        '''
+        refreshes the cached tree once it is older than the TTLs.  The first refresh lists the whole drive, later ones
+        apply only the Drive changes feed since the previous refresh
+        :param force: refresh regardless of the TTLs
+        :param full: list the whole drive again rather than applying changes
+        '''
+        if self.ids is None:
+            try:
+                cache = self.cache.load()
+                if 'ids' not in cache:
+                    raise ValueError(f'nothing cached in {self.cache_file_name}')
+                cache_by_id = {id: DriveNode.from_record(record) for id, record in cache['ids'].items()}
+                last_updated = cache['last_updated']
+                last_checked = cache['last_checked']
+                page_token = cache.get('page_token')
+                if cache.get('root') != self.root:
+                    raise ValueError(f"cache holds {cache.get('root') or 'the whole drive'}, not {self.root}")
+                if cache.get('fields') != file_fields:
+                    raise ValueError(f"cache was listed with {cache.get('fields')}, not {file_fields}")
+                root_id = cache.get('root_id')
+            except Exception as e:
+                print(f'error {e}')
+                cache_by_id = {}
+                last_updated = '1970-01-01T00:00:00.000Z'
+                last_checked = '1970-01-01T00:00:00.000Z'
+                page_token = None
+                root_id = None
+            with self.lock:
+                self.ids = cache_by_id
+                self.last_updated = last_updated
+                self.last_checked = last_checked
+                self.page_token = page_token
+                self.root_id = root_id
+                self._index()
+        utcnow = datetime.utcnow().replace(tzinfo=timezone.utc)
+        checked_delta = utcnow - parser.isoparse(self.last_checked)
+        updated_delta = utcnow - parser.isoparse(self.last_updated)
+
+        if force or full or checked_delta.total_seconds() > cache_checked_ttl or \
+                updated_delta.total_seconds() > cache_update_ttl:
+            self.last_checked = utcnow.isoformat()
+            if self.page_token is not None and not full:
+                logger.info(f'fetching changes, last checked {checked_delta.total_seconds() / 60:.1f} minutes ago')
+                try:
+                    self._apply_changes()
+                except HttpError as e:
+                    logger.warning(f'could not fetch changes, listing everything: {e}')
+                    full = True
+            full = self.page_token is None or full
+            if full:
+                self._list_everything()
+            self._write_cache(snapshot=full)
+        else:
+            logger.debug(f'using cached file info, last checked {checked_delta.total_seconds() / 60:.1f} minutes ago')
+
+    def _list_everything(self):
+        logger.info('listing every file')
+        service = self._service()
+        # the token is taken first so that nothing changed during the listing is missed
+        page_token = service.changes().getStartPageToken(supportsAllDrives=True).execute(http=self._http())[
+            'startPageToken']
+        cache_by_id = {}  # a full listing, anything missing from it has gone
+        root_id = None
+        if self.root is not None:
+            rootinfo = self._find_root()
+            root_id = rootinfo.id
+            cache_by_id[root_id] = rootinfo
+            cache_by_id.update(self._walk([root_id]))
+        else:
+            for file_list in self.drive.ListFile({'q': 'trashed=false', 'maxResults': 500,
+                                                 'fields': f'nextPageToken,items({file_fields})'}):
+                for fileinfo in file_list:
+                    # if fileinfo['mimeType'] == NCSEFGoogleDrive.FOLDER_MIME_TYPE:
+                    #     pass
+                    # elif 'shortcut' in fileinfo['mimeType']:
+                    #     continue
+                    cache_by_id[fileinfo['id']] = DriveNode.from_api(fileinfo)
+        last_updated = max([fileinfo.modifiedDate for fileinfo in cache_by_id.values()] +
+                           ['1970-01-01T00:00:00.000Z'])
+        with self.lock:
+            self.ids = cache_by_id
+            self.last_updated = last_updated
+            self.page_token = page_token
+            self.root_id = root_id
+            self._index()
+
+    def _query(self, q, fields=file_fields):
+        '''
+        every file matching a Drive search, through this thread's connection
+        :param fields: metadata wanted for each file
+        '''
+        service = self._service()
+        http = self._http()
+        token = None
+        while True:
+            response = service.files().list(q=q, maxResults=1000, pageToken=token, supportsAllDrives=True,
+                                            includeItemsFromAllDrives=True,
+                                            fields=f'nextPageToken,items({fields})').execute(http=http)
+            for fileinfo in response.get('items', []):
+                yield fileinfo
+            token = response.get('nextPageToken')
+            if token is None:
+                break
+
+    @staticmethod
+    def _quote(title):
+        return title.replace('\\', '\\\\').replace("'", "\\'")
+
+    def _find_root(self):
+        '''
+        looks up the root folder one path element at a time
+        :return: its DriveNode
+        '''
+        node = None
+        for title in self.root.strip('/').split('/'):
+            q = f"title = '{self._quote(title)}' and mimeType = '{NCSEFGoogleDrive.FOLDER_MIME_TYPE}' and " \
+                f"trashed = false"
+            if node is None:
+                # top level folders either have no parents we can see (shared with us) or are in our My Drive
+                fields = file_fields.replace('parents(id)', 'parents(id,isRoot)')
+                candidates = [fileinfo for fileinfo in self._query(q, fields=fields)
+                              if len(fileinfo['parents']) == 0 or
+                              any([parent.get('isRoot') for parent in fileinfo['parents']])]
+            else:
+                candidates = list(self._query(f"'{node.id}' in parents and {q}"))
+            if len(candidates) == 0:
+                raise ValueError(f'root folder {self.root} not found')
+            node = DriveNode.from_api(candidates[0])
+        return node
+
+    def _walk(self, folder_ids, batch=20):
+        '''
+        lists everything under some folders, querying for the children of up to batch folders at a time, with
+        list_workers queries in flight.  Each response's subfolders are queried as soon as it arrives
+        :return: DriveNodes keyed by id
+        '''
+        found = {}
+        with ThreadPoolExecutor(max_workers=self.list_workers, thread_name_prefix='list') as executor:
+            pending = set()
+
+            def submit(ids):
+                for n in range(0, len(ids), batch):
+                    q = ' or '.join([f"'{id}' in parents" for id in ids[n:n + batch]])
+                    pending.add(executor.submit(lambda q: list(self._query(f'({q}) and trashed = false')), q))
+
+            submit(list(folder_ids))
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                folders = []
+                for future in done:
+                    for fileinfo in future.result():
+                        if fileinfo['id'] in found:
+                            continue
+                        found[fileinfo['id']] = DriveNode.from_api(fileinfo)
+                        if fileinfo['mimeType'] == NCSEFGoogleDrive.FOLDER_MIME_TYPE:
+                            folders.append(fileinfo['id'])
+                submit(folders)
+        logger.debug(f'listed {len(found)} files under {len(folder_ids)} folders')
+        return found
+
+    def _apply_changes(self):
+        '''
+        applies the changes feed since self.page_token to the cached tree.  Trashed and deleted files are dropped with
+        everything under them, renamed and moved ones have their paths, and their contents' paths, rebuilt
+        :return: number of files changed
+        '''
+        service = self._service()
+        http = self._http()
+        changed = {}
+        removed = set()
+        token = self.page_token
+        while token is not None:
+            response = service.changes().list(
+                pageToken=token, includeDeleted=True, maxResults=1000, supportsAllDrives=True,
+                includeItemsFromAllDrives=True,
+                fields=f'nextPageToken,newStartPageToken,items(fileId,deleted,file({file_fields}))').execute(http=http)
+            for change in response.get('items', []):
+                fileinfo = change.get('file')
+                if change.get('deleted') or fileinfo is None or fileinfo.get('labels', {}).get('trashed'):
+                    removed.add(change['fileId'])
+                    changed.pop(change['fileId'], None)
+                else:
+                    changed[change['fileId']] = DriveNode.from_api(fileinfo)
+                    removed.discard(change['fileId'])
+            token = response.get('nextPageToken')
+            new_token = response.get('newStartPageToken')
+        if self.root_id is not None:
+            self._scope_changes(changed, removed)
+        with self.lock:
+            for fileid in removed:
+                self._remove_node(fileid)
+            moved = []
+            for fileid, node in changed.items():
+                old = self.ids.get(fileid)
+                node.fullpath = '' if old is None else old.fullpath
+                if old is None or old.title != node.title or old.parents != node.parents:
+                    if old is not None:
+                        for parent in old.parents:
+                            self.children.get(parent, set()).discard(fileid)
+                    moved.append(fileid)
+                self.ids[fileid] = node
+                self.cache.put(node.record())
+                self.children.setdefault(fileid, set())
+                if node.modifiedDate > self.last_updated:
+                    self.last_updated = node.modifiedDate
+            for fileid in moved:
+                for parent in self.ids[fileid].parents:
+                    if parent in self.children:
+                        self.children[parent].add(fileid)
+            for fileid in moved:
+                self._repath(fileid)
+            self.page_token = new_token
+        logger.info(f'applied {len(changed)} changed and {len(removed)} removed files')
+        return len(changed) + len(removed)
+
+    def _scope_changes(self, changed, removed):
+        '''
+        the changes feed covers the whole drive.  When caching a root, drops changes outside it, turns moves out of
+        it into removals and lists the contents of folders moved into it
+        '''
+        with self.lock:
+            inside = set([fileid for fileid in self.ids.keys() if fileid not in changed and fileid not in removed])
+            kept = set([self.root_id]) & set(changed.keys())
+            grew = True
+            while grew:
+                grew = False
+                for fileid, node in changed.items():
+                    if fileid not in kept and any([parent in kept or parent in inside for parent in node.parents]):
+                        kept.add(fileid)
+                        grew = True
+            for fileid in list(changed.keys()):
+                if fileid not in kept:
+                    del changed[fileid]
+                    if fileid in self.ids:
+                        removed.add(fileid)
+            arrived = [fileid for fileid in kept if fileid not in self.ids and
+                       changed[fileid].mimeType == NCSEFGoogleDrive.FOLDER_MIME_TYPE]
+        if arrived:
+            for fileid, node in self._walk(arrived).items():
+                changed.setdefault(fileid, node)
+
+    def _unpath(self, nodeid):
+        node = self.ids[nodeid]
+        if self.paths.get(node.fullpath) == nodeid:
+            del self.paths[node.fullpath]
+        node.fullpath = ''
+        for child in self.children.get(nodeid, ()):
+            self._unpath(child)
+
+    def _repath(self, nodeid):
+        '''
+        rebuilds the paths of a renamed or moved node and everything under it
+        '''
+        node = self.ids[nodeid]
+        self._unpath(nodeid)
+        if nodeid == self.root_id:
+            self._buildpath(node, self.root.rsplit('/', 1)[0])
+            return
+        if len(node.parents) == 0:
+            self._buildpath(node, '')
+        for parent in node.parents:
+            if parent in self.ids and self.ids[parent].fullpath:
+                self._buildpath(node, self.ids[parent].fullpath)
+                break
+
+    def create_shortcut(self, fullpath_link_to, folder_to_put_link_in, title):
+        shortcut, _, _, _, _ = self._find_file(f"{folder_to_put_link_in}/{title}", refresh=False)
+        if not shortcut:
+            id_to_link_to, _, _, _, _ = self._find_file(fullpath_link_to)
+            id_to_create_link_in, _, _, _, _ = self._find_file(folder_to_put_link_in)
+
+            shortcut_metadata = {
+                "title": title,
+                'mimeType': 'application/vnd.google-apps.shortcut',
+                "parents": [{"id": id_to_create_link_in}],
+                "shortcutDetails": {"targetId": id_to_link_to,
+                                    "targetMimeType": 'application/vnd.google-apps.folder'}
+            }
+            shortcut = self.drive.CreateFile(shortcut_metadata)
+            try:
+                shortcut.Upload()
+            except Exception as e:
+                logger.error(f"error creating link to  {fullpath_link_to} in {folder_to_put_link_in} as {title}")
+
+        return shortcut
+
+    def _mime_type(self, localpath, default='application/vnd.google-apps.file'):
+        mimeType = default
+        for ext, mtype in NCSEFGoogleDrive.common_mime_types.items():
+            if localpath.endswith(f'.{ext}'):
+                mimeType = mtype
+        return mimeType
+
+    def _needs_upload(self, localpath, nodeid, update_on='changed'):
+        '''
+        :param update_on: changed uploads a file already on Drive only if its content differs, compared by md5,
+                          always uploads it regardless
+        '''
+        if not nodeid or update_on == 'always':
+            return True
+        remotemd5 = self.ids[nodeid].md5Checksum
+        if remotemd5 is None:
+            return True  # Google Docs have no checksum
+        return self.hasher.digest(localpath) != remotemd5
+
+    def _http(self):
+        # httplib2 connections can't be shared between threads, so each worker authorizes its own
+        http = getattr(self.local, 'http', None)
+        if http is None:
+            http = self.drive.auth.Get_Http_Object()
+            self.local.http = http
+        return http
+
+    def _service(self):
+        if self.drive.auth.service is None:
+            self.drive.auth.Authorize()
+        return self.drive.auth.service
+
+    @staticmethod
+    def committed_bytes(range_header):
+        '''
+        :param range_header: Range header of a 308 reply to a resumable upload, e.g. bytes=0-1048575
+        :return: number of bytes the server has already received
+        '''
+        if not range_header:
+            return 0
+        return int(range_header.split('-')[-1]) + 1
+
+    def _save_uploads(self):
+        with self.lock:
+            write_json_cache(self.uploads, self.uploads_file_name)
+
+    def _resume(self, request, http, remotepath, st):
+        '''
+        points a resumable request at the session left by an earlier, interrupted upload of the same file, if the
+        server still has it
+        :return: file metadata if the earlier upload had in fact completed, otherwise None
+        '''
+        with self.lock:
+            record = self.uploads.get(remotepath)
+        if record is None:
+            return None
+        if record['size'] != st.st_size or record['mtime'] != st.st_mtime:
+            logger.debug(f'{remotepath} changed since its upload was interrupted, starting again')
+            return None
+        resp, content = http.request(record['uri'], 'PUT',
+                                     headers={'Content-Range': f'bytes */{st.st_size}', 'Content-Length': '0'})
+        if resp.status in (200, 201):
+            return json.loads(content)
+        if resp.status != 308:
+            logger.debug(f'upload session for {remotepath} expired ({resp.status}), starting again')
+            return None
+        request.resumable_uri = record['uri']
+        request.resumable_progress = NCSEFGoogleDrive.committed_bytes(resp.get('range'))
+        logger.info(f'resuming upload of {remotepath} at {request.resumable_progress / 1024 / 1024:.1f}MB')
+        return None
+
+    def _upload(self, localpath, remotepath, parentid, nodeid=None, mimeType=None, progress=None):
+        '''
+        sends a file to Drive, creating it under parentid or replacing the content of nodeid.  Files larger than
+        resumable_threshold use Drive's resumable protocol, chunksize bytes at a time, and the session is remembered
+        in uploads_file_name so an upload cut short continues where it stopped on the next run
+        :param progress: called with the number of bytes sent by each chunk
+        :return: metadata of the uploaded file
+        '''
+        http = self._http()
+        st = os.stat(localpath)
+        mimeType = mimeType or self._mime_type(localpath)
+        resumable = st.st_size > self.resumable_threshold
+        media = MediaFileUpload(localpath, mimetype=mimeType, chunksize=self.chunksize, resumable=resumable)
+        files = self._service().files()
+        if nodeid:
+            request = files.update(fileId=nodeid, media_body=media, supportsAllDrives=True, fields=file_fields)
+        else:
+            metadata = {'title': remotepath.split('/')[-1], 'parents': [{'id': parentid}], 'mimeType': mimeType}
+            request = files.insert(body=metadata, media_body=media, supportsAllDrives=True, fields=file_fields)
+        try:
+            if not resumable:
+                item = request.execute(http=http, num_retries=self.num_retries)
+                if progress is not None:
+                    progress(st.st_size)
+                return item
+            item = self._resume(request, http, remotepath, st)
+            sent = request.resumable_progress
+            while item is None:
+                status, item = request.next_chunk(http=http, num_retries=self.num_retries)
+                record = {'uri': request.resumable_uri, 'size': st.st_size, 'mtime': st.st_mtime}
+                with self.lock:  # replaces the record of a session that had expired, or of an older file
+                    started = request.resumable_uri is not None and self.uploads.get(remotepath) != record
+                    if started:
+                        self.uploads[remotepath] = record
+                if started:
+                    self._save_uploads()
+                if progress is not None:
+                    progress(request.resumable_progress - sent if item is None else st.st_size - sent)
+                sent = request.resumable_progress
+            with self.lock:
+                finished = self.uploads.pop(remotepath, None) is not None
+            if finished:
+                self._save_uploads()
+            return item
+        finally:
+            media.stream().close()
+
+    def _add_node(self, item, fullpath):
+        '''
+        puts a created or updated file in the cache and its indexes
+        :param item: metadata from the Drive API
+        :return: DriveNode
+        '''
+        with self.lock:
+            node = DriveNode.from_api(item)
+            self.cache.put(node.record())
+            node.fullpath = fullpath
+            self.ids[node.id] = node
+            self.paths[fullpath] = node.id
+            self.children.setdefault(node.id, set())
+            for parent in node.parents:
+                if parent in self.children:
+                    self.children[parent].add(node.id)
+        return node
+
+    def _remove_node(self, nodeid):
+        '''
+        drops a trashed file, and everything under it, from the cache and its indexes
+        '''
+        with self.lock:
+            node = self.ids.pop(nodeid, None)
+            if node is None:
+                return
+            self.cache.remove(nodeid)
+            if self.paths.get(node.fullpath) == nodeid:
+                del self.paths[node.fullpath]
+            for parent in node.parents:
+                self.children.get(parent, set()).discard(nodeid)
+            for child in self.children.pop(nodeid, set()):
+                self._remove_node(child)
+
+    def trash(self, nodeid):
+        '''
+        moves a file or folder to the trash
+        '''
+        item = self.drive.CreateFile({'id': nodeid})
+        item.Trash()
+        self._remove_node(nodeid)
+
+    def create_file(self, localpath, remotepath, mimeType='application/vnd.google-apps.file', update_on='changed',
+                    progress=None):
+        nodeid, parentid, parentpath, title, isafolder = self._find_file(remotepath)
+        if not self._needs_upload(localpath, nodeid, update_on=update_on):
+            logger.info(f'no update needed for {remotepath}')
+            return None
+        if not parentid:
+            logger.debug(f'creating {parentpath}')
+            parentid = self.makedirs(parentpath).id
+        mimeType = self._mime_type(localpath, default=mimeType)
+        try:
+            item = self._upload(localpath, remotepath, parentid, nodeid=nodeid, mimeType=mimeType, progress=progress)
+        except Exception:
+            logger.error(f'failed to upload {localpath} to {remotepath}')
+            raise
+        if nodeid:
+            logger.info(f'updated {remotepath} {nodeid} from {localpath}')
+        else:
+            logger.info(f'created {remotepath}')
+        return self._add_node(item, remotepath)
+
+    def upload_files(self, jobs, max_workers=4, update_on='changed'):
+        '''
+        uploads many files at once.  Missing parent folders are created first, one at a time, and the local files
+        already on Drive are hashed in parallel, then the files that differ are sent by a pool of workers, each with
+        its own authorized connection.  Failures are logged rather than raised
+        :param jobs: list of (local path, remote path)
+        :param max_workers: concurrent uploads
+        :param update_on: changed or always, see _needs_upload
+        :return: dictionary of files (uploaded), skipped (up to date), bytes, seconds and failed (list of local paths)
+        '''
+        start = time.perf_counter()
+        self._service()
+        missing = set()  # folders that couldn't be made, the files to go in them fail
+        for parentpath in sorted(set(remotepath.rsplit('/', 1)[0] for _, remotepath in jobs)):
+            try:
+                self.makedirs(parentpath)
+            except Exception as e:
+                missing.add(parentpath)
+                logger.error(f"failed to create {parentpath}: {e}")
+        total = len(jobs)
+        failed = [localpath for localpath, remotepath in jobs if remotepath.rsplit('/', 1)[0] in missing]
+        jobs = [(localpath, remotepath) for localpath, remotepath in jobs
+                if remotepath.rsplit('/', 1)[0] not in missing]
+        if update_on == 'changed':
+            self.hasher.digest_many([localpath for localpath, remotepath in jobs
+                                     if self._find_file(remotepath)[0] is not None])
+
+        sent = [0]
+        bar = tqdm(total=len(jobs), desc='upload', unit='file')
+
+        def progress(nbytes):
+            with self.lock:
+                sent[0] += nbytes
+                bar.set_postfix_str(f"{sent[0] / 1024 / 1024 / max(time.perf_counter() - start, 0.001):.1f}MB/s",
+                                    refresh=False)
+
+        uploaded = 0
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='upload') as executor:
+            futures = {executor.submit(self.create_file, localpath, remotepath, update_on=update_on,
+                                       progress=progress): localpath
+                       for localpath, remotepath in jobs}
+            for future in as_completed(futures):
+                bar.update(1)
+                if future.exception() is not None:
+                    failed.append(futures[future])
+                    logger.error(f"failed to upload {futures[future]}: {future.exception()}")
+                elif future.result() is not None:
+                    uploaded += 1
+        bar.close()
+        self._write_cache()
+        self.hasher.save()
+        elapsed = time.perf_counter() - start
+        skipped = total - uploaded - len(failed)
+        logger.info(f"uploaded {uploaded} files, {sent[0] / 1024 / 1024:.1f}MB in {elapsed:.1f}s "
+                    f"({sent[0] / 1024 / 1024 / max(elapsed, 0.001):.1f}MB/s), {skipped} up to date, "
+                    f"{len(failed)} failed")
+        return {'files': uploaded, 'skipped': skipped, 'bytes': sent[0], 'seconds': elapsed, 'failed': failed}
+
+    def makedirs(self, full_remote_path):
+        '''
+        creates a folder and any of its parents that are missing, adding each to the cache as it is created
+        :return: DriveNode of the folder
+        '''
+        with self.folder_lock:  # so concurrent uploads can't create the same folder twice
+            elements = full_remote_path.rstrip('/').split('/')
+            with self.lock:
+                # deepest existing ancestor
+                n = len(elements)
+                while n > 1 and '/'.join(elements[:n]) not in self.paths:
+                    n -= 1
+                if n == 1:
+                    raise ValueError(f'no parent folder of {full_remote_path} found')
+                node = self.ids[self.paths['/'.join(elements[:n])]]
+            if node.mimeType != NCSEFGoogleDrive.FOLDER_MIME_TYPE:
+                raise ValueError(f"{node.fullpath} already exists as a non-folder")
+            for title in elements[n:]:
+                metadata = {"title": title, "parents": [{"id": node.id}],
+                            "mimeType": NCSEFGoogleDrive.FOLDER_MIME_TYPE}
+                item = self._service().files().insert(body=metadata, supportsAllDrives=True,
+                                                      fields=file_fields).execute(http=self._http(),
+                                                                                  num_retries=self.num_retries)
+                node = self._add_node(item, f"{node.fullpath}/{title}")
+                logger.info(f"created {node.fullpath} {node.id}")
+        return node
+
+    def create_folder(self, full_remote_path, expectedroot='Automation', refresh=True):
+        '''
+        creates a folder, and any missing parents, see makedirs.  The cache is updated as folders are created, so
+        refresh is no longer needed and is ignored
+        '''
+        return self.makedirs(full_remote_path)
+
+    def clean_empty_dirs(self, parentid='1wiIOz_ZdPHoOBNjJcb1HX-L2NqX5urQx'):
+        ids = set()
+        for id, data in self.ids.items():
+            if 'folder' not in data.mimeType:
+                continue
+            if len(data.parents) == 0:
+                continue
+            if data.parents[0] != parentid:
+                continue
+            if len(self.children[id]) > 0:
+                continue
+            ids.add(id)
+        for id in tqdm(ids):
+            self.trash(id)
+        self._write_cache()
+
+    def clean_single_file_dirs(self, parentid='1wiIOz_ZdPHoOBNjJcb1HX-L2NqX5urQx'):
+        idstopurge = set()
+        for id, data in tqdm(self.ids.items()):
+            if 'folder' not in data.mimeType:
+                continue
+            if len(data.parents) == 0:
+                continue
+            if data.parents[0] != parentid:
+                continue
+            if len(self.children[id]) > 1:
+                continue
+            print(id, data.title)
+            idstopurge.add(id)
+        for id in tqdm(idstopurge):
+            if id == parentid:
+                raise ValueError('no not this one')
+            self.trash(id)
+        self._write_cache()
+
+
 #
 #
 # def get_sheet(sheetname):
@@ -0,0 +1,105 @@
+import hashlib
+import mmap
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .fileutils import read_json_cache, write_json_cache
+from .logstuff import get_logger
+
+logger = get_logger('hashing')
+
+
+class HashingEngine(object):
+    '''
+    digests of local files, computed on a pool of threads (hashlib releases the GIL while it hashes) and kept between
+    runs keyed by device and inode.  A digest is reused while the file's size and mtime are unchanged, so a file is
+    only read again once it has been rewritten, and every hard link to a file, e.g. the paths a BlobStore links to
+    one blob, shares a single entry.  Several algorithms are computed in one pass over a file, and files of at least
+    mmap_threshold bytes are hashed from a memory map rather than read into buffers
+    '''
+
+    def __init__(self, cache_filename='caches/file_digests.json', max_workers=None, mmap_threshold=16 * 1024 * 1024):
+        '''
+        :param max_workers: files hashed at once by digest_many, defaults to the number of CPUs
+        :param mmap_threshold: size in bytes from which files are memory mapped
+        '''
+        self.cache_filename = cache_filename
+        self.max_workers = max_workers or min(8, os.cpu_count() or 1)
+        self.mmap_threshold = mmap_threshold
+        self.lock = threading.Lock()
+        self.digests = read_json_cache(cache_filename, max_cache_age=float('inf'))
+        self.changed = False
+
+    @staticmethod
+    def key(st):
+        return f"{st.st_dev}:{st.st_ino}"
+
+    def hash_file(self, path, algorithms=('md5',)):
+        '''
+        reads a file once, whatever the number of algorithms
+        :return: dictionary of hex digests keyed by algorithm
+        '''
+        hashes = [hashlib.new(algorithm) for algorithm in algorithms]
+        with open(path, 'rb') as fp:
+            size = os.fstat(fp.fileno()).st_size
+            if size >= self.mmap_threshold:
+                with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    for h in hashes:
+                        h.update(mm)
+            else:
+                for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+                    for h in hashes:
+                        h.update(chunk)
+        return {algorithm: h.hexdigest() for algorithm, h in zip(algorithms, hashes)}
+
+    def digests_of(self, path, algorithms=('md5',)):
+        '''
+        :return: dictionary of hex digests of a local file keyed by algorithm, computing only those not cached for
+                 its current size and mtime
+        '''
+        st = os.stat(path)
+        key = self.key(st)
+        with self.lock:
+            record = self.digests.get(key)
+            if record is None or record['size'] != st.st_size or record['mtime'] != st.st_mtime_ns:
+                record = {'size': st.st_size, 'mtime': st.st_mtime_ns}
+            missing = [algorithm for algorithm in algorithms if algorithm not in record]
+        if missing:
+            computed = self.hash_file(path, missing)
+            logger.debug(f"hashed {path} {computed}")
+            with self.lock:
+                record = dict(record, **computed)
+                self.digests[key] = record
+                self.changed = True
+        return {algorithm: record[algorithm] for algorithm in algorithms}
+
+    def digest(self, path, algorithm='md5'):
+        '''
+        :return: hex digest of a local file
+        '''
+        return self.digests_of(path, (algorithm,))[algorithm]
+
+    def digest_many(self, paths, algorithms=('md5',)):
+        '''
+        digests many files at once, max_workers at a time.  Files that can't be read are logged and left out
+        :return: dictionary of digests_of results keyed by path
+        '''
+        start = time.perf_counter()
+        hashed = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='hash') as executor:
+            futures = {path: executor.submit(self.digests_of, path, algorithms) for path in set(paths)}
+            for path, future in futures.items():
+                try:
+                    hashed[path] = future.result()
+                except OSError as e:
+                    logger.warning(f"could not hash {path}: {e}")
+        logger.info(f"digested {len(hashed)} files in {time.perf_counter() - start:.1f}s")
+        return hashed
+
+    def save(self):
+        with self.lock:
+            if self.changed:
+                write_json_cache(self.digests, self.cache_filename)
+                self.changed = False
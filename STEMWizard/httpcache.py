@@ -0,0 +1,195 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from .fileutils import atomic_write
+from .logstuff import get_logger
+
+logger = get_logger('http_cache')
+
+# seconds a response stays fresh, by endpoint path.  Anything not listed here is never cached
+default_ttls = {'/fairadmin/getstudentCustomMilestoneDetailView': 3600,
+                '/filesAndForms/studentFormsAndFilesDetailedView': 3600,
+                }
+
+
+class ResponseCache(object):
+    '''
+    on disk cache of response bodies keyed by method, URL and POST payload, with a freshness TTL per endpoint and
+    least recently used eviction once the directory grows past max_bytes.  Each body is stored with its sha256 so
+    results parsed from a body can be memoized: a page that comes back unchanged is never parsed twice.
+    '''
+
+    def __init__(self, cache_dir='caches/http', max_bytes=256 * 1024 * 1024, ttls=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttls = dict(default_ttls if ttls is None else ttls)
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(cache_dir, 'parsed'), exist_ok=True)
+        self.size = sum(size for _, size, _ in self._entries())
+
+    def ttl(self, url):
+        return self.ttls.get(urlparse(url).path, 0)
+
+    @staticmethod
+    def key(method, url, data=None):
+        payload = json.dumps(data, sort_keys=True, default=str)
+        return hashlib.sha256(f"{method.upper()} {url} {payload}".encode()).hexdigest()
+
+    def _path(self, key, ext):
+        return os.path.join(self.cache_dir, f"{key}.{ext}")
+
+    def get(self, key, ttl):
+        '''
+        :return: (meta, body) for a fresh entry, None if missing or older than ttl seconds
+        '''
+        try:
+            with open(self._path(key, 'json'), 'r') as fp:
+                meta = json.load(fp)
+            if time.time() - meta['stored'] > ttl:
+                return None
+            with open(self._path(key, 'body'), 'rb') as fp:
+                body = fp.read()
+        except (OSError, ValueError, KeyError):
+            return None
+        if hashlib.sha256(body).hexdigest() != meta['sha256']:
+            logger.error(f"discarding corrupt cache entry for {meta['url']}")
+            return None
+        self._touch(self._path(key, 'body'))
+        return meta, body
+
+    def put(self, key, r):
+        '''
+        stores a response, reading its body if it hasn't been already
+        :return: sha256 of the body
+        '''
+        body = r.content
+        meta = {'url': r.url,
+                'status': r.status_code,
+                'headers': dict(r.headers),
+                'encoding': r.encoding,
+                'stored': time.time(),
+                'sha256': hashlib.sha256(body).hexdigest()}
+        encoded = json.dumps(meta).encode()
+        atomic_write(self._path(key, 'body'), body)
+        atomic_write(self._path(key, 'json'), encoded)
+        self._grew(len(body) + len(encoded))
+        return meta['sha256']
+
+    def memoize(self, content_hash, name, parse):
+        '''
+        returns the result previously parsed from an identical body, calling parse() only the first time
+        :param content_hash: sha256 of the response body
+        :param name: distinguishes parsers applied to the same body
+        :param parse: function returning a JSON serializable result
+        '''
+        path = os.path.join(self.cache_dir, 'parsed', f"{content_hash}_{name}.json")
+        try:
+            with open(path, 'r') as fp:
+                result = json.load(fp)
+            self._touch(path)
+            return result
+        except (OSError, ValueError):
+            pass
+        result = parse()
+        data = json.dumps(result, default=str).encode()
+        atomic_write(path, data)
+        self._grew(len(data))
+        return result
+
+    @staticmethod
+    def _touch(path):
+        # mtime doubles as last used time for LRU eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _entries(self):
+        for directory in [self.cache_dir, os.path.join(self.cache_dir, 'parsed')]:
+            for entry in os.scandir(directory):
+                if entry.is_file() and not entry.name.startswith('.tmp_'):
+                    st = entry.stat()
+                    yield entry.path, st.st_size, st.st_mtime
+
+    def _grew(self, nbytes):
+        with self.lock:
+            self.size += nbytes
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        '''
+        removes least recently used entries, a body together with its meta, and parsed results until the cache is
+        under 90% of max_bytes.  An entry is as recently used as its body, the only file get() touches
+        '''
+        groups = {}  # paths of one entry, their size and last used time
+        for path, size, mtime in self._entries():
+            stem, ext = os.path.splitext(path)
+            group = groups.setdefault(stem if ext in ('.body', '.json') else path, [[], 0, mtime])
+            group[0].append(path)
+            group[1] += size
+            if ext == '.body' or len(group[0]) == 1:
+                group[2] = mtime
+        ranked = sorted(groups.values(), key=lambda group: group[2])
+        self.size = sum(size for _, size, _ in ranked)
+        for paths, size, _ in ranked:
+            if self.size <= self.max_bytes * 0.9:
+                break
+            for path in paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self.size -= size
+        logger.info(f"evicted http cache entries, {self.size / 1024 / 1024:.1f}MB remain")
+
+
+class CachedSession(requests.Session):
+    '''
+    requests session that answers from a ResponseCache for endpoints with a TTL.  Responses carry
+    content_hash (sha256 of the body, None when not cacheable) and from_cache attributes.  Responses to be cached
+    are read whole before they are returned, and those answered from the cache never reach response hooks
+    '''
+
+    def __init__(self, cache):
+        super().__init__()
+        self.cache = cache
+
+    def request(self, method, url, data=None, **kwargs):
+        ttl = self.cache.ttl(url)
+        if ttl <= 0:
+            r = super().request(method, url, data=data, **kwargs)
+            r.content_hash = None
+            r.from_cache = False
+            return r
+        key = self.cache.key(method, url, data)
+        hit = self.cache.get(key, ttl)
+        if hit is not None:
+            return self._from_cache(*hit)
+        r = super().request(method, url, data=data, **kwargs)
+        r.from_cache = False
+        r.content_hash = None
+        if r.status_code == 200 and len(r.history) == 0:  # a redirect here is usually to the login page
+            r.content_hash = self.cache.put(key, r)
+        return r
+
+    @staticmethod
+    def _from_cache(meta, body):
+        r = requests.Response()
+        r.status_code = meta['status']
+        r.reason = 'OK'
+        r.headers = CaseInsensitiveDict(meta['headers'])
+        r.encoding = meta['encoding']
+        r.url = meta['url']
+        r._content = body
+        r._content_consumed = True
+        r.content_hash = meta['sha256']
+        r.from_cache = True
+        return r
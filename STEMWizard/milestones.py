@@ -0,0 +1,295 @@
+import re
+import uuid
+
+from .categories import categories
+from .tables import iter_table, iter_elements
+
+# request parameters and table parsers for the tabs of the fairadmin milestones page, kept free of any
+# HTTP client so the same code serves STEMWizardAPI and AsyncSTEMWizardAPI
+
+milestone_path = '/fairadmin/getstudentCustomMilestoneDetailView'
+file_detail_path = '/filesAndForms/studentFormsAndFilesDetailedView'
+
+
+def milestone_request(tab, category_id, page=1, per_page=999):
+    '''
+    builds the query string and form payload STEM Wizard expects for one page of one category of a milestone tab
+    :param tab: project, form or file
+    :param category_id: key from categories
+    :param page: page number, starting at 1
+    :param per_page: rows per page
+    :return: tuple of (query string, form payload), either may be None
+    '''
+    if tab == 'project':
+        params = f'page={page}&category_select={category_id}&child_fair_select=&searchhere=&orderby=&sortby=&division=&class_id=&per_page={per_page}&student_completion_status=undefined&admin_status=undefined&student_checkin_status=&student_milestone_status=&st_stmile_id=1335&grade_select=&student_activation_status=1'
+        return params, None
+    elif tab == 'form':
+        payload = {'page': page,
+                   'per_page': per_page,
+                   'st_stmile_id': 1337,
+                   'mileName': 'Files and Forms',
+                   'division': 0,
+                   'category_select': category_id,
+                   'student_activation_status': 1,
+                   }
+        return None, payload
+    elif tab == 'file':
+        params = f'page={page}&category_select={category_id}&per_page={per_page}&st_stmile_id=3153&student_activation_status=1'
+        return params, None
+    raise ValueError(f'unhandled milestone tab {tab}')
+
+
+def _shortname_labels(head):
+    th_labels = []
+    for th in head:
+        if th['p'] is not None:
+            v = th['p'].strip()
+        else:
+            v = th['text'].strip()
+        v = v.replace('2022 NCSEF ', '')
+        for shortname in ['Research Paper', 'Abstract', 'Quad Chart', 'Lab Notebook ',
+                          'Project Presentation Slides', '1 minute video', '1C', '7']:
+            if shortname.lower() in v.lower():
+                v = shortname
+        th_labels.append(v)
+    return th_labels
+
+
+def iter_project_rows(chunks, category_title, encoding=None):
+    '''
+    parses the project tab of the milestones page
+    :param chunks: response body for a single page of a category, as an iterable of chunks
+    :param category_title: used in error messages
+    :param encoding: character encoding of the chunks
+    :return: generator of (student id, project metadata), one per table row
+    '''
+    th_labels = None
+    for kind, record in iter_table(chunks, encoding=encoding):
+        if kind == 'head':
+            th_labels = _shortname_labels(record)
+            if len(th_labels) == 0:
+                break
+            continue
+        studentid = record['id'].replace('updatedStudentDiv_', '')
+        studentdata = {}
+        for n, td in enumerate(record['cells']):
+            if td['divs'] and th_labels[n] != 'Project Name':
+                studentdata[th_labels[n]] = [div.strip() for div in td['divs']]
+            elif th_labels[n] == 'Project Name':
+                if td['p'] is not None:
+                    studentdata[th_labels[n]] = td['p'].strip()
+                else:
+                    studentdata[th_labels[n]] = td['text'].strip()
+            else:
+                studentdata[th_labels[n]] = td['text'].strip()
+        yield studentid, studentdata
+    if not th_labels:
+        raise ValueError(
+            f'no table head found on project tab for {category_title} of getstudentCustomMilestoneDetailView ')
+
+
+def iter_files_and_forms_rows(chunks, category_title=None, encoding=None):
+    '''
+    parses the files and forms tab of the milestones page
+    :param chunks: response body for a single page of a category, as an iterable of chunks
+    :param category_title: used in error messages
+    :param encoding: character encoding of the chunks
+    :return: generator of (student id, student file info), one per table row
+    '''
+    th_labels = None
+    for kind, record in iter_table(chunks, encoding=encoding):
+        if kind == 'head':
+            th_labels = []
+            for th in record:
+                v = th['text'].strip()
+                v = v.replace('2022 NCSEF ', '')
+                if 'Research' in v:
+                    v = 'Research Plan'
+                if len(v) <= 2:
+                    v = f"ISEF-{v.lower()}"
+                th_labels.append(v)
+            continue
+        studentid = f"unknown_{uuid.uuid4()}"
+        studentdata = {'studentid': None, 'files': {}}
+        for header in th_labels[6:]:
+            studentdata['files'][header] = {'url': [], 'remote_filename': [], 'local_filename': [],
+                                            'local_lastmod': []}
+        for n, td in enumerate(record['cells']):
+            if n < 5:
+                studentdata[th_labels[n]] = td['text'].strip().replace(" \n\n", ', ')
+                if td['links']:
+                    atoms = td['links'][0]['href'].split('/')
+                    studentid = atoms[-2]
+                    studentdata['studentid'] = studentid
+            else:
+                for link in td['links']:
+                    atoms = link['href'].split('/')
+                    studentdata['files'][th_labels[n]]['url'].append(link['href'])
+                    studentdata['files'][th_labels[n]]['remote_filename'].append(atoms[-1])
+        yield studentid, studentdata
+    if th_labels is None:
+        raise ValueError(f'no table head found on files and forms tab for {category_title}')
+
+
+def iter_judges_materials_rows(chunks, category_title=None, encoding=None):
+    '''
+    parses the files for judges tab of the milestones page
+    :param chunks: response body for a single page of a category, as an iterable of chunks
+    :param category_title: used in error messages
+    :param encoding: character encoding of the chunks
+    :return: generator of (student id, student file info), one per table row
+    '''
+    th_labels = None
+    studentid = None
+    for kind, record in iter_table(chunks, encoding=encoding):
+        if kind == 'head':
+            th_labels = [label.strip() for label in _shortname_labels(record)]  # remove stray whitespace in th text
+            continue
+        studentdata = {'studentid': None, 'files': {}}
+        for header in th_labels[5:]:
+            studentdata['files'][header] = {'url': [], 'remote_filename': [],
+                                            'local_filename': [], 'local_lastmod': []}
+        for n, td in enumerate(record['cells']):
+            if n < 5:
+                studentdata[th_labels[n]] = td['text'].strip().replace(" \n\n", ', ')
+                if td['links']:
+                    atoms = td['links'][0]['href'].split('/')
+                    studentid = atoms[-2]
+                    studentdata['studentid'] = studentid
+            else:
+                if td['links']:
+                    studentdata['files'][th_labels[n]]['url'].append(td['links'][0]['href'])
+                else:
+                    studentdata['files'][th_labels[n]]['remote_filename'].append(td['text'])
+        yield studentid, studentdata
+    if th_labels is None:
+        raise ValueError(f'no table head found on files for judges tab for {category_title}')
+
+
+# row parser for each milestone tab
+milestone_rows = {'project': iter_project_rows,
+                  'form': iter_files_and_forms_rows,
+                  'file': iter_judges_materials_rows}
+
+# Showing 1 to 100 of 345 entries, below the table
+_total_pattern = re.compile(rb'Showing\s+[\d,]+\s+to\s+[\d,]+\s+of\s+([\d,]+)\s+entries')
+
+
+def _scan_total(chunks, found):
+    tail = b''
+    for chunk in chunks:
+        if 'total' not in found:
+            m = _total_pattern.search(tail + chunk)
+            if m:
+                found['total'] = int(m.group(1).replace(b',', b''))
+            tail = (tail + chunk)[-100:]  # a count split across chunks
+        yield chunk
+
+
+def iter_page_rows(tab, chunks, category_title, encoding=None):
+    '''
+    parses one page of a milestone tab, reading past the table for the number of students in all
+    :param tab: project, form or file
+    :param chunks: response body for a single page of a category, as an iterable of byte chunks
+    :param category_title: used in error messages
+    :param encoding: character encoding of the chunks
+    :return: generator of (student id, student data), one per table row, followed by (None, total) when the page
+             shows how many students there are across all pages
+    '''
+    found = {}
+    chunks = _scan_total(chunks, found)
+    yield from milestone_rows[tab](chunks, category_title, encoding=encoding)
+    for _ in chunks:  # the count follows the table
+        pass
+    if 'total' in found:
+        yield None, found['total']
+
+
+def more_pages(seen, page_rows, total):
+    '''
+    decides whether to request the next page of a category.  Without a total a short page proves nothing, the
+    server may cap per_page, so paging stops at the first empty page
+    :param seen: rows read so far, the last page included
+    :param page_rows: rows on the last page
+    :param total: students across all pages as the page shows it, None if it doesn't
+    :return: True if there are more pages
+    '''
+    if total is not None:
+        return seen < total
+    return page_rows > 0
+
+
+def row_category(studentdata):
+    '''
+    category title named in a row, found under any column with category in its label
+    :param studentdata: student data parsed from one row of a milestone tab
+    :return: category title, 'undefined' if the row doesn't name one
+    '''
+    for label, value in studentdata.items():
+        if 'category' in label.lower() and type(value) == str and len(value) > 0:
+            return value
+    return 'undefined'
+
+
+def order_by_category(students):
+    '''
+    orders students fetched for the whole fair the way a category by category fetch would, using the category
+    named in each row.  Rows from unknown categories, or tabs without a category column, keep their order at the end
+    :param students: iterable of (student id, student data)
+    :return: list of (student id, student data)
+    '''
+    order = {title: n for n, title in enumerate(categories.values())}
+    return sorted(students, key=lambda student: order.get(row_category(student[1]), len(order)))
+
+
+def parse_student_info_ids(chunks, encoding=None):
+    '''
+    finds the per team member info ids on the forms and files detail view
+    :param chunks: response body of studentFormsAndFilesDetailedView without an info_id
+    :param encoding: character encoding of the chunks
+    :return: list of info ids
+    '''
+    # <li class="student_tab" id="64585">
+    return [li['id'] for li in iter_elements(chunks, 'li', 'student_tab', encoding=encoding) if 'id' in li]
+
+
+def parse_student_file_detail(chunks, encoding=None):
+    '''
+    parses the file table on the forms and files detail view for a single team member
+    :param chunks: response body of studentFormsAndFilesDetailedView for an info_id
+    :param encoding: character encoding of the chunks
+    :return: list of rows, each a dictionary keyed by column label
+    '''
+    data = []
+    th_labels = []
+    # <table class="table table-striped table-bordered table-hover dataTable" style="width:100%;position: relative;border:1px solid #e4e4e4">
+    for kind, record in iter_table(chunks, table_class="table table-striped table-bordered table-hover dataTable",
+                                   encoding=encoding):
+        if kind == 'head':
+            th_labels = [th['text'] for th in record]
+            continue
+        row = {}
+        for label, td in zip(th_labels, record['cells']):
+            if td['links']:
+                l = td['links'][0]
+                # <a href="#" title="Download" downloadprojfile="McMichael Student Checklist.jpg" downloadprojfilename="McMichael Student Checklist_67263_164437473362.jpg" uploaddocname="https://stem-s3-2021.s3.us-west-1.amazonaws.com/2021/production/project_files/McMichael Student Checklist_67263_164437473362.jpg" class="downloadProjStudent" id="downloadProjStudent" style="text-decoration:none">                            McMichael Student Checklist.jpg</a>
+                if 'uploaddocname' in l:
+                    # downloadable from s3 bucket
+                    row[label] = {'url': l['uploaddocname'], 'remote_filename': l['downloadprojfilename']}
+                else:
+                    # downloadable from STEM Wizard site
+                    row[label] = {'remote_filename': l['uploaded_file_name']}
+
+            else:
+                contents = td['text']
+                if label == 'FILE TYPE':
+                    # normalize file types
+                    contents = contents.replace('2022 NCSEF ', '')
+                    contents = contents.replace('Abstract Form', 'Abstract')
+                    contents = contents.replace('ISEF ', 'ISEF-')
+                    if 'Research Plan' in contents:
+                        contents = 'Research Plan'
+                row[label] = contents.strip()
+        if len(row):
+            data.append(row)
+    return data
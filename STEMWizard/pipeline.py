@@ -0,0 +1,66 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .logstuff import get_logger
+
+logger = get_logger('pipeline')
+
+
+class PhaseScheduler(object):
+    '''
+    runs a small graph of named phases on a thread pool.  A phase starts as soon as every phase it depends on
+    has finished, so independent phases (e.g. the milestone tab scrapes) overlap while dependent ones
+    (merge, patch, analyze) wait only for their own inputs.
+    '''
+
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self.phases = {}
+        self.results = {}
+        self.timings = {}
+
+    def add(self, name, function, depends=()):
+        '''
+        registers a phase
+        :param name: unique phase name, also the key its return value is stored under in results
+        :param function: called with the results dictionary, only phases listed in depends are guaranteed present
+        :param depends: names of phases which must complete before this one starts
+        :return: nothing
+        '''
+        if name in self.phases:
+            raise ValueError(f'phase {name} already defined')
+        for dependency in depends:
+            if dependency not in self.phases:
+                raise ValueError(f'phase {name} depends on undefined phase {dependency}')
+        self.phases[name] = {'function': function, 'depends': set(depends)}
+
+    def _timed(self, name):
+        start = time.perf_counter()
+        try:
+            return self.phases[name]['function'](self.results)
+        finally:
+            self.timings[name] = time.perf_counter() - start
+            logger.info(f"phase {name} took {self.timings[name]:.1f}s")
+
+    def run(self):
+        '''
+        runs all phases, raising the first exception encountered after letting running phases finish
+        :return: dictionary of phase results keyed by phase name
+        '''
+        start = time.perf_counter()
+        pending = dict(self.phases)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                for name in [n for n, phase in pending.items() if phase['depends'].issubset(self.results.keys())]:
+                    running[executor.submit(self._timed, name)] = name
+                    del pending[name]
+                if not running:
+                    raise ValueError(f"unable to schedule phases {', '.join(pending.keys())}")
+                done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    self.results[name] = future.result()
+        self.timings['total'] = time.perf_counter() - start
+        logger.info(f"{len(self.phases)} phases took {self.timings['total']:.1f}s")
+        return self.results
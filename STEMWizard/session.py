@@ -0,0 +1,273 @@
+import os
+import random
+import stat
+import threading
+import time
+from urllib.parse import parse_qsl, urljoin, urlparse
+
+from requests.adapters import HTTPAdapter
+from requests.cookies import get_cookie_header
+
+from .fileutils import read_json_cache, write_json_cache
+from .logstuff import get_logger
+
+logger = get_logger('session')
+
+login_path = '/admin/login'
+auth_paths = (login_path, '/admin/authenticate')
+
+
+class SessionStore(object):
+    '''
+    the authenticated STEM Wizard session, its cookies, login token, CSRF token and region info, kept on disk between
+    runs so a run can skip the login round trips while the session is still good.  The file is created readable by
+    its owner only (write_json_cache writes through mkstemp, which creates files 0600) and is ignored if anyone else
+    can read it.  Passwords are never stored
+    '''
+
+    def __init__(self, filename='caches/stemwizard_session.json', max_age=3600):
+        '''
+        :param max_age: seconds after it was saved that a session is no longer tried
+        '''
+        self.filename = filename
+        self.max_age = max_age
+
+    def load(self, domain, username):
+        '''
+        :return: the saved session for this fair and user, None if there is none, it has expired or it is for
+                 someone else
+        '''
+        try:
+            mode = os.stat(self.filename).st_mode
+        except FileNotFoundError:
+            return None
+        if mode & (stat.S_IRWXG | stat.S_IRWXO):
+            logger.warning(f"ignoring {self.filename}, it can be read by other users")
+            return None
+        state = read_json_cache(self.filename, max_cache_age=self.max_age)
+        if state.get('domain') != domain or state.get('username') != username:
+            return None
+        now = time.time()
+        state['cookies'] = [cookie for cookie in state.get('cookies', [])
+                            if cookie['expires'] is None or cookie['expires'] > now]
+        if len(state['cookies']) == 0:
+            return None
+        return state
+
+    def save(self, domain, username, cookies, **state):
+        '''
+        :param cookies: the session's cookie jar
+        :param state: token, csrf, region_id and region_domain
+        '''
+        records = [{'name': cookie.name, 'value': cookie.value, 'domain': cookie.domain, 'path': cookie.path,
+                    'expires': cookie.expires, 'secure': cookie.secure} for cookie in cookies]
+        write_json_cache(dict(state, domain=domain, username=username, cookies=records), self.filename)
+        logger.debug(f"saved session for {username} on {domain}")
+
+    def clear(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    @staticmethod
+    def restore_cookies(jar, records):
+        for record in records:
+            jar.set(record['name'], record['value'], domain=record['domain'], path=record['path'],
+                    expires=record['expires'], secure=record['secure'])
+
+
+def login_required(r):
+    '''
+    :return: True if a response shows the session has expired, a 419 (CSRF token mismatch) or a redirect to the
+             login page.  Responses to the login requests themselves never are
+    '''
+    if urlparse(r.request.url).path in auth_paths:
+        return False
+    if r.status_code == 419:
+        return True
+    if r.is_redirect:
+        return urlparse(urljoin(r.url, r.headers['Location'])).path == login_path
+    return urlparse(r.url).path == login_path
+
+
+def cookies_changed(request, cookies):
+    '''
+    :return: True if the cookies a request was sent with are no longer those the cookie jar would send
+    '''
+    probe = request.copy()
+    sent = probe.headers.pop('Cookie', None)
+    return get_cookie_header(cookies, probe) != sent
+
+
+def refreshed_request(request, cookies, token, csrf):
+    '''
+    a copy of a prepared request, made with the cookies, login token and CSRF token of a new login
+    :param request: PreparedRequest sent with the expired session
+    :param cookies: cookie jar holding the new session
+    '''
+    retry = request.copy()
+    if csrf is not None:  # also when it was sent without, having been made while the login was under way
+        retry.headers['X-CSRF-TOKEN'] = csrf
+    if retry.body and 'x-www-form-urlencoded' in retry.headers.get('Content-Type', ''):
+        body = retry.body.decode() if isinstance(retry.body, bytes) else retry.body
+        fields = parse_qsl(body, keep_blank_values=True)
+        if any(k == '_token' for k, v in fields):
+            retry.prepare_body([(k, token if k == '_token' else v) for k, v in fields], None)
+    retry.headers.pop('Cookie', None)
+    retry.prepare_cookies(cookies)
+    return retry
+
+
+class TokenBucket(object):
+    '''
+    limits the rate requests are started at, allowing bursts of up to burst requests
+    '''
+
+    def __init__(self, rate, burst=None):
+        '''
+        :param rate: requests per second
+        :param burst: tokens the bucket holds, defaults to one second's worth
+        '''
+        self.rate = rate
+        self.capacity = burst or max(1, rate)
+        self.tokens = self.capacity
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def acquire(self):
+        '''
+        waits for a token
+        '''
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        '''
+        holds every request back for a while, e.g. for the Retry-After of a 429
+        '''
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+class ConcurrencyController(object):
+    '''
+    AIMD limit on the requests in flight.  The limit grows by one for each limit's worth of healthy responses and is
+    halved, at most once per typical response time, on a 429, a 5xx, a failed request or when response times rise.
+    Response times are followed with a fast and a slow moving average, and have risen when the fast one exceeds the
+    slow one by latency_tolerance, so a server that is steadily slower is not mistaken for one becoming overloaded
+    '''
+
+    def __init__(self, initial=2, minimum=1, maximum=8, latency_tolerance=2.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_tolerance = latency_tolerance
+        self.active = 0
+        self.fast = None  # moving averages of response time, seconds
+        self.slow = None
+        self.last_decrease = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.active >= int(self.limit):
+                self.condition.wait()
+            self.active += 1
+
+    def release(self, latency, overloaded=False):
+        '''
+        :param latency: seconds until the response headers arrived
+        :param overloaded: the server refused, failed or throttled the request
+        '''
+        with self.condition:
+            self.active -= 1
+            if self.fast is None:
+                self.fast = self.slow = latency
+            self.fast += 0.3 * (latency - self.fast)
+            self.slow += 0.05 * (latency - self.slow)
+            if overloaded or self.fast > self.slow * self.latency_tolerance:
+                now = time.monotonic()
+                if now - self.last_decrease > self.slow:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self.last_decrease = now
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+class Throttle(object):
+    '''
+    the rate limit, concurrency controller and retry policy shared by all the sessions of a STEMWizardAPI
+    '''
+
+    def __init__(self, rate=10, burst=None, max_concurrency=8, max_retries=4, backoff_base=0.5, backoff_cap=30):
+        '''
+        :param rate: requests started per second
+        :param max_concurrency: most requests the controller will allow in flight
+        :param max_retries: retries of a request answered with a 429 or 5xx
+        :param backoff_base: seconds, doubled on each retry
+        :param backoff_cap: longest wait between retries, seconds
+        '''
+        self.bucket = TokenBucket(rate, burst)
+        self.controller = ConcurrencyController(initial=min(2, max_concurrency), maximum=max_concurrency)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+
+    def backoff(self, attempt, retry_after=None):
+        '''
+        :param attempt: retries so far
+        :param retry_after: Retry-After header, in seconds, honoured when longer than the backoff
+        :return: seconds to wait, full jitter exponential backoff
+        '''
+        delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+        if retry_after is not None and retry_after.strip().isdigit():
+            delay = max(delay, min(self.backoff_cap, int(retry_after)))
+        return delay
+
+
+class ThrottledAdapter(HTTPAdapter):
+    '''
+    transport adapter that starts requests no faster than the throttle allows and retries those the server answers
+    with a 429 or 5xx after a backoff.  Response times are measured to the arrival of the headers, so streamed bodies
+    don't count against the server
+    '''
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, throttle, **kwargs):
+        super().__init__(**kwargs)
+        self.throttle = throttle
+
+    def send(self, request, **kwargs):
+        throttle = self.throttle
+        for attempt in range(throttle.max_retries + 1):
+            throttle.bucket.acquire()
+            throttle.controller.acquire()
+            start = time.perf_counter()
+            overloaded = True
+            try:
+                r = super().send(request, **kwargs)
+                overloaded = r.status_code in ThrottledAdapter.retry_statuses
+            finally:
+                throttle.controller.release(time.perf_counter() - start, overloaded=overloaded)
+            if not overloaded or attempt == throttle.max_retries:
+                return r
+            delay = throttle.backoff(attempt, r.headers.get('Retry-After'))
+            logger.warning(f"{r.status_code} from {request.url}, retrying in {delay:.1f}s "
+                           f"({int(throttle.controller.limit)} requests in flight allowed)")
+            r.close()
+            if r.status_code == 429:
+                throttle.bucket.pause(delay)  # holds back every session, this request included
+            else:
+                time.sleep(delay)
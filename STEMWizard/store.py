@@ -0,0 +1,219 @@
+import json
+import sqlite3
+import threading
+from datetime import datetime
+
+from .logstuff import get_logger
+from .milestones import row_category
+
+# SQLite store for the student data built by studentSync, one row per student, per team member and per file so
+# lookups by project number, division or category use an index instead of walking the nested dictionaries.
+#
+# students.data holds the student's row without its files, so dictionaries read back match the ones stored.
+# files rows hold the n'th entry of each of the parallel url, remote_filename, local_filename and local_lastmod
+# lists for a file type, NULL past the end of a list.  A local_lastmod of '' is a None entry.
+
+logger = get_logger('store')
+
+file_attributes = ['url', 'remote_filename', 'local_filename', 'local_lastmod']
+
+schema = '''
+CREATE TABLE IF NOT EXISTS students (
+    studentid TEXT PRIMARY KEY,
+    project_number TEXT,
+    division TEXT,
+    category TEXT,
+    has_files INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS participants (
+    studentid TEXT NOT NULL REFERENCES students(studentid) ON DELETE CASCADE,
+    n INTEGER NOT NULL,
+    last_name TEXT,
+    first_name TEXT,
+    PRIMARY KEY (studentid, n)
+);
+CREATE TABLE IF NOT EXISTS files (
+    studentid TEXT NOT NULL REFERENCES students(studentid) ON DELETE CASCADE,
+    filetype TEXT NOT NULL,
+    n INTEGER NOT NULL,
+    url TEXT,
+    remote_filename TEXT,
+    local_filename TEXT,
+    local_lastmod TEXT,
+    PRIMARY KEY (studentid, filetype, n)
+);
+CREATE INDEX IF NOT EXISTS students_project_number ON students (project_number);
+CREATE INDEX IF NOT EXISTS students_division ON students (division);
+CREATE INDEX IF NOT EXISTS students_category ON students (category);
+CREATE INDEX IF NOT EXISTS participants_name ON participants (last_name, first_name);
+CREATE INDEX IF NOT EXISTS files_local_filename ON files (local_filename);
+'''
+
+
+def _lastmod_in(value):
+    if value is None:
+        return ''
+    return str(value)
+
+
+def _lastmod_out(value):
+    if value == '':
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return value
+
+
+class StudentStore(object):
+    '''
+    student data from studentSync kept in SQLite, read and written as the same dictionaries studentSync returns
+    '''
+
+    def __init__(self, db_filename='caches/students.sqlite'):
+        self.db_filename = db_filename
+        self.lock = threading.Lock()  # one connection shared by the sync phases
+        self.db = sqlite3.connect(db_filename, check_same_thread=False)
+        self.db.execute('PRAGMA foreign_keys = ON')
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.executescript(schema)
+
+    def close(self):
+        self.db.close()
+
+    def _upsert(self, studentid, studentdata):
+        row = {k: v for k, v in studentdata.items() if k != 'files'}
+        project_number = studentdata.get('Project Number')
+        division = studentdata.get('Division')
+        self.db.execute('''INSERT INTO students (studentid, project_number, division, category, has_files, data)
+                           VALUES (?, ?, ?, ?, ?, ?)
+                           ON CONFLICT(studentid) DO UPDATE SET project_number=excluded.project_number,
+                           division=excluded.division, category=excluded.category, has_files=excluded.has_files,
+                           data=excluded.data''',
+                        (studentid, project_number, division, row_category(studentdata),
+                         int('files' in studentdata), json.dumps(row, default=str)))
+        self.db.execute('DELETE FROM participants WHERE studentid = ?', (studentid,))
+        last_names = studentdata.get('Last Name', [])
+        first_names = studentdata.get('First Name', [])
+        if type(last_names) == list and type(first_names) == list:
+            self.db.executemany('INSERT INTO participants (studentid, n, last_name, first_name) VALUES (?, ?, ?, ?)',
+                                [(studentid, n, last_name, first_name)
+                                 for n, (last_name, first_name) in enumerate(zip(last_names, first_names))])
+        self.db.execute('DELETE FROM files WHERE studentid = ?', (studentid,))
+        rows = []
+        for filetype, filedata in studentdata.get('files', {}).items():
+            count = max([len(filedata.get(attr, [])) for attr in file_attributes] + [1])  # keeps empty file types
+            for n in range(count):
+                values = []
+                for attr in file_attributes:
+                    entries = filedata.get(attr, [])
+                    if n >= len(entries):
+                        values.append(None)
+                    elif attr == 'local_lastmod':
+                        values.append(_lastmod_in(entries[n]))
+                    else:
+                        values.append(entries[n])
+                rows.append((studentid, filetype, n, *values))
+        self.db.executemany('''INSERT INTO files (studentid, filetype, n, url, remote_filename, local_filename,
+                               local_lastmod) VALUES (?, ?, ?, ?, ?, ?, ?)''', rows)
+
+    def upsert(self, studentid, studentdata):
+        '''
+        inserts or replaces one student, with their participants and files
+        '''
+        with self.lock, self.db:
+            self._upsert(studentid, studentdata)
+
+    def upsert_many(self, data, prune=False, keep=None):
+        '''
+        inserts or replaces many students in a single transaction
+        :param data: student data keyed by student id, as returned by studentSync
+        :param prune: also remove students not in keep
+        :param keep: ids of the students still on STEM Wizard, defaults to those in data
+        '''
+        with self.lock, self.db:
+            for studentid, studentdata in data.items():
+                self._upsert(studentid, studentdata)
+            if prune:
+                self.db.execute('CREATE TEMP TABLE IF NOT EXISTS keep (studentid TEXT PRIMARY KEY)')
+                self.db.execute('DELETE FROM keep')
+                self.db.executemany('INSERT INTO keep VALUES (?)',
+                                    [(studentid,) for studentid in (data.keys() if keep is None else keep)])
+                removed = self.db.execute('DELETE FROM students WHERE studentid NOT IN (SELECT studentid FROM keep)')
+                if removed.rowcount:
+                    logger.info(f"removed {removed.rowcount} students no longer on STEM Wizard")
+        logger.debug(f"stored {len(data)} students in {self.db_filename}")
+
+    def delete(self, studentid):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM students WHERE studentid = ?', (studentid,))
+
+    def query(self, where='', params=()):
+        '''
+        students matching an SQL condition on the students table
+        :param where: condition, e.g. 'division = ?', empty for every student
+        :param params: values for the condition's placeholders
+        :return: student data keyed by student id, in the order students were first stored
+        '''
+        with self.lock:
+            students = self.db.execute(f"SELECT studentid, has_files, data FROM students "
+                                       f"{'WHERE ' + where if where else ''} ORDER BY rowid", params).fetchall()
+            files = {}
+            if students:
+                self.db.execute('CREATE TEMP TABLE IF NOT EXISTS wanted (studentid TEXT PRIMARY KEY)')
+                self.db.execute('DELETE FROM wanted')
+                self.db.executemany('INSERT INTO wanted VALUES (?)', [(studentid,) for studentid, _, _ in students])
+                for studentid, filetype, url, remote_filename, local_filename, local_lastmod in self.db.execute(
+                        '''SELECT studentid, filetype, url, remote_filename, local_filename, local_lastmod FROM files
+                           WHERE studentid IN (SELECT studentid FROM wanted) ORDER BY rowid'''):
+                    filedata = files.setdefault(studentid, {}).setdefault(
+                        filetype, {attr: [] for attr in file_attributes})
+                    for attr, value in zip(file_attributes, [url, remote_filename, local_filename, local_lastmod]):
+                        if value is not None:
+                            filedata[attr].append(_lastmod_out(value) if attr == 'local_lastmod' else value)
+        data = {}
+        for studentid, has_files, row in students:
+            data[studentid] = json.loads(row)
+            if has_files:
+                data[studentid]['files'] = files.get(studentid, {})
+        return data
+
+    def studentids(self):
+        '''
+        :return: set of the ids of every student stored
+        '''
+        with self.lock:
+            return {studentid for studentid, in self.db.execute('SELECT studentid FROM students')}
+
+    def get_many(self, studentids):
+        '''
+        :return: student data of those of the students that are stored, keyed by student id
+        '''
+        studentids = list(studentids)
+        if len(studentids) == 0:
+            return {}
+        return self.query(f"studentid IN ({','.join('?' * len(studentids))})", studentids)
+
+    def get(self, studentid):
+        '''
+        :return: student data, None if the student isn't stored
+        '''
+        return self.query('studentid = ?', (studentid,)).get(studentid)
+
+    def all(self):
+        return self.query()
+
+    def by_division(self, division):
+        return self.query('division = ?', (division,))
+
+    def by_category(self, category):
+        return self.query('category = ?', (category,))
+
+    def get_internal_id_from_project_no(self, project_no):
+        '''
+        :return: STEM Wizard student id for a project number, None if not found
+        '''
+        with self.lock:
+            row = self.db.execute('SELECT studentid FROM students WHERE project_number = ?', (project_no,)).fetchone()
+        return None if row is None else row[0]
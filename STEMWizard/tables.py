@@ -0,0 +1,95 @@
+from lxml import etree
+
+# event based extraction of HTML tables.  Pages are fed to the parser in chunks as they arrive and each row is
+# handed back as a plain record then discarded, so no full document tree is ever built.
+#
+# cell records are dictionaries:
+#   text   text of the cell and all its descendants (as BeautifulSoup's .text)
+#   links  attribute dictionaries for every <a> in the cell, in document order
+#   divs   text of every <div> in the cell
+#   p      text of the first <p> in the cell, None if there isn't one
+# row records are {'id': id attribute of the <tr>, 'cells': [cell records for each <td>]}
+
+
+def _events(chunks, events, encoding):
+    parser = etree.HTMLPullParser(events=events, encoding=encoding)
+    for chunk in chunks:
+        if chunk:  # filter out keep-alive chunks
+            parser.feed(chunk)
+            yield from parser.read_events()
+    parser.close()
+    yield from parser.read_events()
+
+
+def _text(elem):
+    return ''.join(elem.itertext())
+
+
+def _cell(elem):
+    p = next(elem.iter('p'), None)
+    return {'text': _text(elem),
+            'links': [dict(a.attrib) for a in elem.iter('a')],
+            'divs': [_text(div) for div in elem.iter('div')],
+            'p': None if p is None else _text(p)}
+
+
+def _table_of(tr):
+    parent = tr.getparent()
+    if parent is not None and parent.tag in ('thead', 'tbody', 'tfoot'):
+        parent = parent.getparent()
+    return parent
+
+
+def iter_table(chunks, table_class=None, encoding=None):
+    '''
+    streams a single table out of an HTML document
+    :param chunks: iterable of bytes (or str) making up the document, e.g. response.iter_content()
+    :param table_class: class attribute of the table to extract, when None the table holding the first <thead>
+    :param encoding: character encoding of byte chunks, detected by the parser when None
+    :return: generator yielding ('head', [cell records for each <th>]) once, before any
+             ('row', row record) for each table row with <td> cells.  Nothing is yielded if no table is found.
+    '''
+    table = None
+    head = []
+    head_sent = False
+    for event, elem in _events(chunks, ('start', 'end'), encoding):
+        if event == 'start':
+            if table is None:
+                if table_class is None and elem.tag == 'thead':
+                    table = elem.getparent()
+                elif table_class is not None and elem.tag == 'table' and \
+                        ' '.join(elem.get('class', '').split()) == table_class:
+                    table = elem
+            continue
+        if table is None:
+            continue
+        if elem.tag == 'th' and _table_of(elem.getparent()) is table:
+            head.append(_cell(elem))
+        elif elem.tag == 'tr' and _table_of(elem) is table:
+            cells = [_cell(td) for td in elem if td.tag == 'td']
+            if cells:
+                if not head_sent:
+                    head_sent = True
+                    yield 'head', head
+                yield 'row', {'id': elem.get('id'), 'cells': cells}
+                # done with this row, free it and anything before it
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+        elif elem is table:
+            break
+    if table is not None and not head_sent:
+        yield 'head', head
+
+
+def iter_elements(chunks, tag, class_name, encoding=None):
+    '''
+    streams the attributes of every element with the given tag and class
+    :param chunks: iterable of bytes (or str) making up the document
+    :param tag: element tag, e.g. li
+    :param class_name: one of the element's classes
+    :return: generator of attribute dictionaries
+    '''
+    for event, elem in _events(chunks, ('end',), encoding):
+        if elem.tag == tag and class_name in elem.get('class', '').split():
+            yield dict(elem.attrib)
@@ -1,6 +1,28 @@
+import yaml
 from bs4 import BeautifulSoup
 
+from .downloads import default_limits
+from .fileutils import set_cache_codec
+
 headers = {'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/96.0.4664.110 Safari/537.36'}
+
+
+def request_headers(self, referer=None, ajax=False):
+    '''
+    builds a fresh set of headers for a single request, the module level headers dict is never modified so
+    requests made concurrently from several sessions can't clobber each other's CSRF token or referer
+    :param referer: optional Referer header value
+    :param ajax: adds X-Requested-With header when True
+    :return: dictionary of headers
+    '''
+    result = dict(headers)
+    if self.csrf is not None:
+        result['X-CSRF-TOKEN'] = self.csrf
+    if referer is not None:
+        result['Referer'] = referer
+    if ajax:
+        result['X-Requested-With'] = 'XMLHttpRequest'
+    return result
 #
 #
 # def get_internal_id_from_project_no(self, all_student_data, project_no):
@@ -11,40 +33,99 @@ headers = {'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleW
 #     return result
 #
 #
-def get_region_info(self):
+# optional settings in the yaml file, each read into the attribute of the same name as (conversion, default)
+config_options = {'max_workers': (int, 1),
+                  'per_page': (int, 100),
+                  'fetch_mode': (str, 'category'),
+                  'check_freshness': (bool, False),
+                  'dedupe_files': (bool, True),
+                  'hash_local_files': (bool, True),
+                  'upload_workers': (int, 4),
+                  'google_root': (lambda root: root or None, '/Automation'),
+                  'session_ttl': (int, 3600),
+                  'rate_limit': (float, 10),
+                  'max_concurrency': (int, 8)}
+
+
+def read_config(self, configfile):
+    """
+    reads named yaml configuration file
+    :param configfile: (defaulted to stemwizardapi.yaml above)
+    :return: nothing, updates username, password, token and config_options attributes on the object
+    """
+    fp = open(configfile, 'r')
+    data_loaded = yaml.safe_load(fp)
+    self.domain = data_loaded['domain']
+    self.username = data_loaded['username']
+    self.password = data_loaded['password']
+    for option, (convert, default) in config_options.items():
+        setattr(self, option, convert(data_loaded.get(option, default)))
+    if self.fetch_mode not in ['category', 'bulk']:
+        raise ValueError(f'unhandled fetch_mode {self.fetch_mode} in {configfile}')
+    self.download_limits = dict(default_limits, **data_loaded.get('download_limits', {}))
+    set_cache_codec(data_loaded.get('cache_codec', 'json'), compress=bool(data_loaded.get('cache_compress', False)))
+    fp.close()
+
+
+def parse_region_info(html):
     '''
-    gets admin login page, scrapes region and token info for later use
-    :return: nothing, updates region_id, region_domain, and token parameters on object
+    scrapes the admin login page for the login token and region info
+    :param html: text of the admin login page
+    :return: tuple of (token, region_id, region_domain)
     '''
-    url = f'{self.url_base}/admin/login'
-    r = self.session.get(url, headers=headers, allow_redirects=True)
-    if r.status_code >= 300:
-        self.logger.error(f"status code {r.status_code} on post to {url}")
-        return
-
-    # scrape token
-    soup = BeautifulSoup(r.text, 'html.parser')
+    soup = BeautifulSoup(html, 'html.parser')
     token_ele = soup.find('input', {'name': '_token'})
     token = token_ele.get('value')
-    self.token = token
 
-    # scrape region info
     data = {'region_id': None, 'region_domain': None}
     for x in soup.find_all('input'):
         if 'region' in x.get('name'):
             data[x.get('name')] = x.get('value')
-    if data['region_id'] is not None:
-        self.region_id = data['region_id']
+    return token, data['region_id'], data['region_domain']
+
+
+def parse_csrf_token(html):
+    '''
+    scrapes the CSRF token from the meta tags of an authenticated page
+    :param html: page text
+    :return: token, None if not found
+    '''
+    soup = BeautifulSoup(html, 'lxml')
+    csrf = soup.find('meta', {'name': 'csrf-token'})
+    if csrf is not None:
+        return csrf.get('content')
+
+
+def set_region_info(self, token, region_id, region_domain):
+    '''
+    validates and stores the results of parse_region_info on the object
+    '''
+    self.token = token
+    if region_id is not None:
+        self.region_id = region_id
     else:
         self.logger.error(f"region id not found on login page")
         raise ValueError('region id not found on login page')
-    if data['region_domain'] is not None:
-        self.region_domain = data['region_domain']
+    if region_domain is not None:
+        self.region_domain = region_domain
     else:
         self.logger.error(f"region domain not found on login page")
         raise ValueError('region domain not found on login page')
 
 
+def get_region_info(self):
+    '''
+    gets admin login page, scrapes region and token info for later use
+    :return: nothing, updates region_id, region_domain, and token parameters on object
+    '''
+    url = f'{self.url_base}/admin/login'
+    r = self.session.get(url, headers=headers, allow_redirects=True)
+    if r.status_code >= 300:
+        self.logger.error(f"status code {r.status_code} on post to {url}")
+        return
+    self.set_region_info(*parse_region_info(r.text))
+
+
 # def _getStudentData(self, categoryid):
 #     payload = {'_token': self.token,
 #                'page': 1,
@@ -203,10 +284,9 @@ def get_csrf_token(self):
         if r.status_code >= 300:
             self.logger.error(f"status code {r.status_code} on post to {url}")
             return
-        soup = BeautifulSoup(r.text, 'lxml')
-        csrf = soup.find('meta', {'name': 'csrf-token'})
+        csrf = parse_csrf_token(r.text)
         if csrf is not None:
-            self.csrf = csrf.get('content')
+            self.csrf = csrf
         self.logger.info(f"gathered CSRF token {self.csrf}")
 #
 # # def generate_all_data_report(self, usertype, purge_file=False):
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# compares the per category milestone fetch with the single bulk pass over the whole fair
+
+import argparse
+import time
+
+from STEMWizard import STEMWizardAPI
+
+
+def get_args():
+    global args
+    parser = argparse.ArgumentParser(description='benchmark milestone tab fetch modes against STEM Wizard')
+    parser.add_argument('--configfile', help='STEM Wizard configuration', default='stemwizardapi.yaml')
+    parser.add_argument('--tabs', help='milestone tabs to fetch', nargs='+', default=['project', 'form', 'file'])
+    parser.add_argument('--max_workers', help='concurrent categories for the per category fetch', type=int,
+                        default=1)
+    parser.add_argument('--per_page', help='rows per page request', type=int, default=None)
+    args = parser.parse_args()
+
+
+def count_requests(session, counter):
+    '''
+    :return: the hook appended, to be removed once the run is over
+    '''
+    hook = lambda r, *a, **kw: counter.append(r.elapsed.total_seconds())
+    session.hooks['response'].append(hook)
+    return hook
+
+
+def run(sw, mode, tab):
+    sw.fetch_mode = mode
+    counter = []
+    sessions = [sw.session] + [session for session in list(sw._session_pool().queue) if session is not sw.session]
+    hooks = [(session, count_requests(session, counter)) for session in sessions]
+    start = time.perf_counter()
+    data = sw._map_categories(tab, f'{tab} {mode}')
+    elapsed = time.perf_counter() - start
+    for session, hook in hooks:  # leaves the hooks sessions are made with, e.g. reauthenticate, in place
+        session.hooks['response'].remove(hook)
+    return data, elapsed, counter
+
+
+if __name__ == '__main__':
+    get_args()
+
+    sw = STEMWizardAPI(configfile=args.configfile, login_google=False, max_workers=args.max_workers,
+                       http_cache=False)  # every request reaches the server, and the counting hooks
+    if args.per_page is not None:
+        sw.per_page = args.per_page
+    print(f"{'tab':8} {'mode':9} {'students':>8} {'requests':>8} {'seconds':>8} {'server s':>8}")
+    for tab in args.tabs:
+        results = {}
+        for mode in ['category', 'bulk']:
+            data, elapsed, counter = run(sw, mode, tab)
+            results[mode] = data
+            print(f"{tab:8} {mode:9} {len(data):8} {len(counter):8} {elapsed:8.1f} {sum(counter):8.1f}")
+        missing = set(results['category'].keys()) ^ set(results['bulk'].keys())
+        if tab != 'form' and len(missing):  # files and forms keys rows without a student link by uuid
+            print(f"  {len(missing)} students differ between modes: {', '.join(sorted(missing)[:10])}")
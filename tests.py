@@ -1,10 +1,36 @@
+import asyncio
+import hashlib
+import importlib.util
+import io
+import json
+import logging
 import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+from datetime import datetime
 from pprint import pprint
 
+import requests
+
 from STEMWizard import STEMWizardAPI, google_sync
-from STEMWizard.fileutils import write_json_cache
+from STEMWizard.downloads import DownloadEngine, DownloadRecords
+from STEMWizard.blobs import BlobStore
+from STEMWizard.delta import diff_snapshot, update_snapshot
+from STEMWizard.drivecache import DriveCacheJournal, DriveNode
+from STEMWizard import fileutils
+from STEMWizard.fileutils import write_json_cache, read_json_cache
 from STEMWizard.google_sync import NCSEFGoogleDrive
+from STEMWizard.hashing import HashingEngine
+from STEMWizard.httpcache import ResponseCache
+from STEMWizard.milestones import milestone_rows
+from STEMWizard.pipeline import PhaseScheduler
+from STEMWizard.session import ConcurrencyController, SessionStore, Throttle, ThrottledAdapter, TokenBucket, \
+    login_required, refreshed_request
+from STEMWizard.store import StudentStore
+from STEMWizard.tables import iter_table
 
 configfile = 'stemwizardapi.yaml'
 configfile_prod = 'stemwizardapi_ncsef.yaml'
@@ -25,6 +51,12 @@ class GoogleDriveSyncTestCases(unittest.TestCase):
         uut.create_file(localpath, remotepath)
         # print(uut)
 
+    def destructive_test_upload_files(self):
+        uut = NCSEFGoogleDrive()
+        jobs = [('files/ncsef/judge_list.xls', '/Automation/ncsef/by judge/judge list.xls')]
+        results = uut.upload_files(jobs, max_workers=2)
+        self.assertEqual([], results['failed'])
+
     def test_drive_dump(self):
         uut = NCSEFGoogleDrive()
         str = uut.__str__()
@@ -122,6 +154,767 @@ class GoogleDriveSyncTestCases(unittest.TestCase):
         print(f"targetMimeType: {shortcut.get('targetMimeType')}")
 
 
+class PhaseSchedulerTestCases(unittest.TestCase):
+
+    def test_independent_phases_overlap(self):
+        uut = PhaseScheduler()
+        for name in ['project', 'form', 'file']:
+            uut.add(name, lambda results, name=name: time.sleep(0.2) or name)
+        uut.add('all', lambda results: [results[k] for k in ['project', 'form', 'file']],
+                depends=['project', 'form', 'file'])
+        results = uut.run()
+        self.assertEqual(['project', 'form', 'file'], results['all'])
+        self.assertLess(uut.timings['total'], 0.5)
+        self.assertIn('all', uut.timings)
+
+    def test_undefined_dependency(self):
+        uut = PhaseScheduler()
+        with self.assertRaises(ValueError):
+            uut.add('all', lambda results: None, depends=['project'])
+
+
+class TableExtractorTestCases(unittest.TestCase):
+    html = b'''<html><body><table><tr><td>layout</td></tr></table>
+    <table><thead><tr><th>Last Name</th><th><p>Project Name</p> (edit)</th><th>Files</th></tr></thead>
+    <tbody><tr id="updatedStudentDiv_53240"><td><div>Smith</div><div>Jones</div></td><td><p>Bees</p></td>
+    <td><a href="https://s3/a.pdf">a</a><a href="https://s3/b.pdf">b</a></td></tr>
+    <tr id="updatedStudentDiv_53241"><td>Lee<td>Ants<td></tr></tbody></table></body></html>'''
+
+    def test_iter_table(self):
+        chunks = [self.html[i:i + 16] for i in range(0, len(self.html), 16)]  # rows split across chunks
+        records = list(iter_table(chunks, encoding='utf-8'))
+        self.assertEqual(['head', 'row', 'row'], [kind for kind, record in records])
+        head = records[0][1]
+        self.assertEqual(['Last Name', 'Project Name (edit)', 'Files'], [th['text'] for th in head])
+        self.assertEqual('Project Name', head[1]['p'])
+        row = records[1][1]
+        self.assertEqual('updatedStudentDiv_53240', row['id'])
+        self.assertEqual(['Smith', 'Jones'], row['cells'][0]['divs'])
+        self.assertEqual(['https://s3/a.pdf', 'https://s3/b.pdf'], [a['href'] for a in row['cells'][2]['links']])
+        self.assertEqual(['Lee', 'Ants', ''], [td['text'] for td in records[2][1]['cells']])
+
+    def test_iter_table_missing(self):
+        self.assertEqual([], list(iter_table([b'<html><body><p>session expired</p></body></html>'])))
+
+    def test_rows_missing_table(self):
+        for tab, rows in milestone_rows.items():
+            with self.assertRaises(ValueError, msg=tab):
+                list(rows([b'<html><body><p>session expired</p></body></html>'], 'Biology'))
+
+
+class MilestonePagingTestCases(unittest.TestCase):
+
+    class Response(object):
+        encoding = 'utf-8'
+
+        def __init__(self, body):
+            self.body = body
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+        def close(self):
+            pass
+
+        def iter_content(self, chunk_size):
+            return [self.body[n:n + 16] for n in range(0, len(self.body), 16)]
+
+    class Session(object):
+        def __init__(self, students, cap, show_total):
+            self.students, self.cap, self.show_total = students, cap, show_total
+            self.pages = []
+
+        def close(self):
+            pass
+
+        def post(self, url, data=None, headers=None, stream=False):
+            page = int(url.split('page=')[1].split('&')[0])
+            per_page = min(int(url.split('per_page=')[1].split('&')[0]), self.cap)
+            self.pages.append(page)
+            ids = self.students[(page - 1) * per_page:page * per_page]
+            rows = ''.join(f'<tr id="updatedStudentDiv_{n}"><td>{n}</td></tr>' for n in ids)
+            body = f'<table><thead><tr><th>Last Name</th></tr></thead><tbody>{rows}</tbody></table>'
+            if self.show_total:
+                body += f'<div>Showing {(page - 1) * per_page + 1} to {page * per_page} of {len(self.students)} ' \
+                        f'entries</div>'
+            return MilestonePagingTestCases.Response(body.encode())
+
+    def students(self, count, cap, show_total):
+        uut = STEMWizardAPI.__new__(STEMWizardAPI)
+        uut.session = self.Session(list(range(count)), cap, show_total)
+        uut.sessions, uut.store, uut.domain = None, None, 'pagingtest'
+        uut.per_page, uut.url_base, uut.csrf = 5, 'https://x.stemwizard.com', None
+        uut.logger = logging.getLogger('pagingtest')
+        return [studentid for studentid, studentdata in uut.iter_students('project', '87')], uut.session.pages
+
+    def test_server_capped_page_size(self):
+        for show_total in [True, False]:
+            studentids, pages = self.students(7, 3, show_total)
+            self.assertEqual([str(n) for n in range(7)], studentids)
+            self.assertEqual([1, 2, 3] if show_total else [1, 2, 3, 4], pages)
+
+    def test_exact_multiple(self):
+        self.assertEqual(([str(n) for n in range(10)], [1, 2]), self.students(10, 100, True))
+        self.assertEqual([1, 2, 3], self.students(10, 100, False)[1])
+
+
+class ResponseCacheTestCases(unittest.TestCase):
+
+    class Response(object):
+        def __init__(self, content):
+            self.content = content
+            self.url = 'https://x.stemwizard.com/page'
+            self.status_code = 200
+            self.headers = {'Content-Type': 'text/html'}
+            self.encoding = 'utf-8'
+
+    def test_ttl_and_memoize(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = ResponseCache(cache_dir=cache_dir, ttls={'/page': 60})
+            key = cache.key('POST', 'https://x.stemwizard.com/page', {'page': 1})
+            self.assertNotEqual(key, cache.key('POST', 'https://x.stemwizard.com/page', {'page': 2}))
+            self.assertIsNone(cache.get(key, 60))
+            content_hash = cache.put(key, self.Response(b'<html>1</html>'))
+            meta, body = cache.get(key, 60)
+            self.assertEqual((b'<html>1</html>', 200), (body, meta['status']))
+            self.assertIsNone(cache.get(key, -1))  # stale
+            parses = []
+            for _ in range(2):
+                result = cache.memoize(content_hash, 'test', lambda: parses.append(1) or [['53240', {'a': 1}]])
+                self.assertEqual([['53240', {'a': 1}]], result)
+            self.assertEqual(1, len(parses))
+
+    def test_eviction(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = ResponseCache(cache_dir=cache_dir, max_bytes=10000)
+            for n in range(20):
+                cache.put(cache.key('GET', f'https://x/{n}'), self.Response(bytes(1000)))
+                time.sleep(0.01)  # distinct mtimes
+            self.assertLessEqual(cache.size, 10000)
+            self.assertIsNone(cache.get(cache.key('GET', 'https://x/0'), 60))
+            self.assertIsNotNone(cache.get(cache.key('GET', 'https://x/19'), 60))
+
+    def test_eviction_least_recently_used(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = ResponseCache(cache_dir=cache_dir, max_bytes=12000)
+            keys = [cache.key('GET', f'https://x/{n}') for n in range(10)]
+            for key in keys[:4]:
+                cache.put(key, self.Response(bytes(1000)))
+                time.sleep(0.01)
+            self.assertIsNotNone(cache.get(keys[0], 60))  # now the most recently used
+            for key in keys[4:]:
+                time.sleep(0.01)
+                cache.put(key, self.Response(bytes(1000)))
+            self.assertIsNotNone(cache.get(keys[0], 60))
+            self.assertIsNone(cache.get(keys[1], 60))
+            bodies = {name[:-5] for name in os.listdir(cache_dir) if name.endswith('.body')}
+            metas = {name[:-5] for name in os.listdir(cache_dir) if name.endswith('.json')}
+            self.assertEqual(bodies, metas)  # entries are evicted whole
+
+
+class DeltaSnapshotTestCases(unittest.TestCase):
+
+    def test_diff_snapshot(self):
+        data = {'1': {'Project Number': 'SR-BSA-001', 'files': {}},
+                '2': {'Project Number': 'SR-BSA-002', 'files': {}}}
+        hashes, changed, removed = diff_snapshot(data, {})
+        self.assertEqual(['1', '2'], changed)
+        snapshot = update_snapshot(hashes, data)
+        data['2']['Project Number'] = 'SR-BSA-003'
+        data['3'] = {'Project Number': 'SR-BSA-004', 'files': {}}
+        del data['1']
+        hashes, changed, removed = diff_snapshot(data, snapshot)
+        self.assertEqual(['2', '3'], changed)
+        self.assertEqual(['1'], removed)
+        self.assertEqual('SR-BSA-002', snapshot['2']['patched']['Project Number'])  # snapshot rows are copies
+
+    def test_snapshot_with_store(self):
+        data = {'1': {'Project Number': 'SR-BSA-001', 'files': {}}}
+        hashes, changed, removed = diff_snapshot(data, {})
+        snapshot = update_snapshot(hashes)
+        self.assertEqual({'1': {'hash': hashes['1']}}, snapshot)
+        self.assertEqual(['1'], diff_snapshot(data, snapshot)[1])  # the row can't be carried over
+        self.assertEqual([], diff_snapshot(data, snapshot, stored={'1'})[1])
+
+    def test_students_of(self):
+        data = {'1': {'files': {'ISEF-1': {'local_filename': ['SR/BSA/SR-BSA-001/SR-BSA-001_ISEF-1.pdf']}}},
+                '2': {'files': {'ISEF-1': {'local_filename': []}}}}
+        self.assertEqual({'1'}, STEMWizardAPI._students_of(data, ['SR/BSA/SR-BSA-001/SR-BSA-001_ISEF-1.pdf']))
+        self.assertEqual(set(), STEMWizardAPI._students_of(data, []))
+
+
+class StudentStoreTestCases(unittest.TestCase):
+    data = {'53240': {'Last Name': ['Smith', 'Jones'], 'First Name': ['Ann', 'Bob'], 'Project Number': 'SR-BSA-001',
+                      'Category': 'Biochemistry', 'Division': 'Senior',
+                      'files': {'ISEF-1b': {'url': ['https://s3/a.pdf', 'https://s3/b.pdf'],
+                                            'remote_filename': ['a.pdf', 'b.pdf'],
+                                            'local_filename': ['SR/BSA/SR-BSA-001/SR-BSA-001_ISEF-1b.pdf'],
+                                            'local_lastmod': [None]},
+                                'Quad Chart': {'url': [], 'remote_filename': [], 'local_filename': [],
+                                               'local_lastmod': []}}},
+            '53241': {'Last Name': ['Lee'], 'First Name': ['Cy'], 'Project Number': 'JR-CHEM-002',
+                      'Category': 'Chemistry', 'Division': 'Junior'}}
+
+    def test_roundtrip(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            store = StudentStore(os.path.join(cache_dir, 'students.sqlite'))
+            store.upsert_many(self.data)
+            self.assertEqual(self.data, store.all())
+            self.assertEqual('53241', store.get_internal_id_from_project_no('JR-CHEM-002'))
+            self.assertIsNone(store.get_internal_id_from_project_no('JR-CHEM-003'))
+            self.assertEqual(['53240'], list(store.by_category('Biochemistry').keys()))
+            self.assertEqual(['53241'], list(store.by_division('Junior').keys()))
+            self.assertEqual({'53240', '53241'}, store.studentids())
+            self.assertEqual(['53241'], list(store.get_many(['53241', '1']).keys()))
+            store.upsert_many({'53241': self.data['53241']}, prune=True, keep=['53240', '53241'])
+            self.assertEqual({'53240', '53241'}, store.studentids())
+            store.upsert_many({'53241': self.data['53241']}, prune=True)
+            self.assertEqual(['53241'], list(store.all().keys()))
+            store.close()
+
+
+class CacheCodecTestCases(unittest.TestCase):
+    data = {'53240': {'Project Number': 'SR-BSA-001', 'local_lastmod': [datetime(2022, 3, 1, 12, 30, 5, 120), None]}}
+
+    def tearDown(self):
+        fileutils.set_cache_codec('json')
+
+    def test_codecs_keep_datetimes(self):
+        codecs = [('json', False)]
+        if fileutils.orjson is not None:
+            codecs.append(('orjson', False))
+        if fileutils.msgpack is not None:
+            codecs.append(('msgpack', False))
+        if fileutils.zstandard is not None:
+            codecs.append((codecs[-1][0], True))
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache_filename = os.path.join(cache_dir, 'cache.json')
+            for codec, compress in codecs:
+                fileutils.set_cache_codec(codec, compress=compress)
+                write_json_cache(self.data, cache_filename)
+                self.assertEqual(self.data, read_json_cache(cache_filename), codec)
+            self.assertEqual(['cache.json'], os.listdir(cache_dir))  # no temporary files left behind
+
+    def test_corrupt_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache_filename = os.path.join(cache_dir, 'cache.json')
+            with open(cache_filename, 'w') as fp:
+                fp.write('{"53240": {"Project Num')  # as left by an interrupted write
+            self.assertEqual({}, read_json_cache(cache_filename))
+            self.assertTrue(os.path.exists(f"{cache_filename}.corrupt"))
+            self.assertFalse(os.path.exists(cache_filename))
+
+
+class DownloadEngineTestCases(unittest.TestCase):
+
+    class API(object):
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.active = {'s3': 0, 'stemwizard': 0}
+            self.peak = {'s3': 0, 'stemwizard': 0}
+
+        def _clone_session(self):
+            return requests.Session()
+
+        def _transfer(self, host, local_filename, progress):
+            with self.lock:
+                self.active[host] += 1
+                self.peak[host] = max(self.peak[host], self.active[host])
+            time.sleep(0.02)
+            progress(1000)
+            with self.lock:
+                self.active[host] -= 1
+            if local_filename == 'bad':
+                raise Exception('404')
+
+        def download_from_s3(self, url, local_filename, session=None, progress=None, force=False):
+            self._transfer('s3', local_filename, progress)
+            return None if local_filename == 'page' else True  # None, as for an error page served as text/html
+
+        def download_from_stemwizard(self, filename_remote, local_filename, session=None, progress=None, force=False):
+            self._transfer('stemwizard', local_filename, progress)
+            return True
+
+    def test_freshness(self):
+        record = {'etag': '"abc"', 'last_modified': 'Tue, 01 Mar 2022 12:00:00 GMT', 'content_length': '1000'}
+        self.assertEqual({'If-None-Match': '"abc"', 'If-Modified-Since': 'Tue, 01 Mar 2022 12:00:00 GMT'},
+                         DownloadRecords.conditional_headers(record))
+        self.assertEqual({}, DownloadRecords.conditional_headers(None))
+        self.assertTrue(DownloadRecords.unchanged(record, {'ETag': '"abc"', 'Content-Length': '999'}, 1000))
+        self.assertFalse(DownloadRecords.unchanged(record, {'ETag': '"def"', 'Content-Length': '1000'}, 1000))
+        self.assertTrue(DownloadRecords.unchanged(record, {'Last-Modified': 'Tue, 01 Mar 2022 12:00:00 GMT',
+                                                           'Content-Length': '1000'}, 1000))
+        self.assertFalse(DownloadRecords.unchanged(record, {'Last-Modified': 'Wed, 02 Mar 2022 12:00:00 GMT',
+                                                            'Content-Length': '1000'}, 1000))
+        # no validators, only the length of the local copy to go on
+        self.assertTrue(DownloadRecords.unchanged(None, {'Content-Length': '1000'}, 1000))
+        self.assertFalse(DownloadRecords.unchanged(None, {'Content-Length': '1001'}, 1000))
+        self.assertTrue(DownloadRecords.unchanged(None, {}, 1000))  # nothing to go on, keep the local copy
+
+    def test_host_limits(self):
+        api = self.API()
+        jobs = [('s3', f'https://s3/{n}', f'{n}', False) for n in range(20)] + \
+               [('stemwizard', f'{n}.pdf', f'sw{n}', False) for n in range(6)] + \
+               [('s3', 'https://s3/bad', 'bad', False)]
+        summary = DownloadEngine(api, {'s3': 4, 'stemwizard': 2}).run(jobs)
+        self.assertEqual({'s3': 4, 'stemwizard': 2}, api.peak)
+        self.assertEqual(26, summary['files'])
+        self.assertEqual(27000, summary['bytes'])
+        self.assertEqual(['bad'], summary['failed'])
+
+    def test_nothing_downloaded_fails(self):
+        summary = DownloadEngine(self.API(), {'s3': 2, 'stemwizard': 1}).run([('s3', 'https://s3/page', 'page', False),
+                                                                             ('s3', 'https://s3/1', '1', False)])
+        self.assertEqual(['page'], summary['failed'])
+        self.assertEqual(1, summary['files'])
+
+
+class ResumableDownloadTestCases(unittest.TestCase):
+    body = bytes(range(256)) * 4096  # 1MB, two chunks
+
+    class Response(object):
+        def __init__(self, status_code, headers, content, fail_after=None):
+            self.status_code = status_code
+            self.headers = headers
+            self.content = content
+            self.fail_after = fail_after
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+        def iter_content(self, chunk_size):
+            for n in range(0, len(self.content), chunk_size):
+                if self.fail_after is not None and n >= self.fail_after:
+                    raise requests.exceptions.ChunkedEncodingError('connection broken')
+                yield self.content[n:n + chunk_size]
+
+    def fetch(self, extra_headers):
+        self.ranges.append(extra_headers.get('Range'))
+        if 'Range' in extra_headers:
+            start = int(extra_headers['Range'].split('=')[1].rstrip('-'))
+            return self.Response(206, {'Content-Type': 'video/mp4',
+                                       'Content-Range': f'bytes {start}-{len(self.body) - 1}/{len(self.body)}'},
+                                 self.body[start:])
+        return self.Response(200, {'Content-Type': 'video/mp4', 'Content-Length': str(len(self.body))}, self.body,
+                             fail_after=512 * 1024)
+
+    def test_resume(self):
+        self.ranges = []
+        uut = STEMWizardAPI.__new__(STEMWizardAPI)
+        uut.domain = uut.region_domain = 'resumetest'
+        uut.session, uut.sessions, uut.store = requests.Session(), None, None
+        uut.download_records = uut.blob_store = None
+        uut.logger = logging.getLogger('resumetest')
+        local_dir = os.path.join('files', 'resumetest', 'SR')
+        try:
+            uut._download_to_local_file_path('SR/video.mp4', self.fetch)
+            with open(os.path.join(local_dir, 'video.mp4'), 'rb') as fp:
+                self.assertEqual(self.body, fp.read())
+            self.assertEqual([None, f'bytes={512 * 1024}-'], self.ranges)
+            self.assertEqual(['video.mp4'], os.listdir(local_dir))
+        finally:
+            shutil.rmtree(os.path.join('files', 'resumetest'), ignore_errors=True)
+
+    def test_range_not_satisfiable(self):
+        self.ranges = []
+        uut = STEMWizardAPI.__new__(STEMWizardAPI)
+        uut.domain = uut.region_domain = 'resumetest'
+        uut.session, uut.sessions, uut.store = requests.Session(), None, None
+        uut.download_records = uut.blob_store = None
+        uut.logger = logging.getLogger('resumetest')
+        local_dir = os.path.join('files', 'resumetest', 'SR')
+
+        def fetch(extra_headers):
+            if 'Range' in extra_headers:
+                self.ranges.append(extra_headers['Range'])
+                return self.Response(416, {'Content-Type': 'text/html'}, b'')
+            return self.Response(200, {'Content-Type': 'video/mp4'}, self.body)
+        try:
+            os.makedirs(local_dir)
+            with open(os.path.join(local_dir, 'video.mp4.part'), 'wb') as fp:
+                fp.write(self.body + b'stale')
+            uut._download_to_local_file_path('SR/video.mp4', fetch)  # a .part past the end starts over
+            self.assertEqual([f'bytes={len(self.body) + 5}-'], self.ranges)
+            self.assertEqual(['video.mp4'], os.listdir(local_dir))
+            with self.assertRaisesRegex(Exception, '416'):  # without a .part a 416 is an error, not a resume
+                uut._download_to_local_file_path('SR/video.mp4', lambda extra_headers: self.Response(416, {}, b''))
+        finally:
+            shutil.rmtree(os.path.join('files', 'resumetest'), ignore_errors=True)
+
+
+class BlobStoreTestCases(unittest.TestCase):
+
+    def test_dedupe(self):
+        with tempfile.TemporaryDirectory() as files_dir:
+            store = BlobStore(blob_dir=os.path.join(files_dir, 'blobs'),
+                              index_filename=os.path.join(files_dir, 'index.json'))
+            paths = [os.path.join(files_dir, 'SR', name) for name in ['a.pdf', 'b.pdf']]
+            os.makedirs(os.path.dirname(paths[0]))
+            for path in paths:
+                with open(path, 'wb') as fp:
+                    fp.write(b'identical uploads')
+            blob = store.ingest(paths[0], source='https://s3/a.pdf')
+            self.assertEqual(blob, store.ingest(paths[1], source='https://s3/b.pdf'))
+            self.assertTrue(os.path.samefile(paths[0], paths[1]))
+            self.assertEqual((1, 17), store.usage())
+            copy = os.path.join(files_dir, 'JR', 'a.pdf')
+            store.link(store.lookup('https://s3/a.pdf'), copy)
+            store.link(store.lookup('https://s3/a.pdf'), copy)  # relinking is harmless
+            self.assertEqual(['a.pdf'], os.listdir(os.path.dirname(copy)))
+            store.save()
+            self.assertEqual(blob, BlobStore(blob_dir=os.path.join(files_dir, 'blobs'),
+                                             index_filename=os.path.join(files_dir, 'index.json')).lookup(
+                'https://s3/b.pdf'))
+
+    def test_concurrent_ingest(self):
+        with tempfile.TemporaryDirectory() as files_dir:
+            paths = [os.path.join(files_dir, 'SR', name) for name in ['a.pdf', 'b.pdf']]
+            os.makedirs(os.path.dirname(paths[0]))
+            for path in paths:
+                with open(path, 'wb') as fp:
+                    fp.write(b'identical uploads')
+
+            class Hasher(object):  # another worker stores a.pdf between hashing b.pdf and linking it
+                def digest(self, path, algorithm):
+                    digest = BlobStore.digest(path)
+                    other = store.blob_path(digest)
+                    os.makedirs(os.path.dirname(other), exist_ok=True)
+                    os.link(paths[0], other)
+                    return digest
+            store = BlobStore(blob_dir=os.path.join(files_dir, 'blobs'),
+                              index_filename=os.path.join(files_dir, 'index.json'), hasher=Hasher())
+            blob = store.ingest(paths[1])
+            self.assertTrue(os.path.samefile(blob, paths[0]))
+            self.assertTrue(os.path.samefile(blob, paths[1]))
+            self.assertEqual(3, os.stat(blob).st_nlink)
+
+
+class DriveUploadTestCases(unittest.TestCase):
+
+    def test_committed_bytes(self):
+        self.assertEqual(0, NCSEFGoogleDrive.committed_bytes(None))
+        self.assertEqual(1048576, NCSEFGoogleDrive.committed_bytes('bytes=0-1048575'))
+
+
+class DriveIndexTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.uut = NCSEFGoogleDrive.__new__(NCSEFGoogleDrive)
+        self.uut.lock = threading.RLock()
+        self.uut.root = None
+        self.uut.root_id = None
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.uut.cache = DriveCacheJournal(os.path.join(self.cache_dir.name, 'cache.json'))
+        folder = NCSEFGoogleDrive.FOLDER_MIME_TYPE
+        self.uut.ids = {'a': DriveNode('a', 'Automation', (), folder, None),
+                        'b': DriveNode('b', 'ncsef', ('a',), folder, None),
+                        'c': DriveNode('c', 'x.pdf', ('b',), 'application/pdf', None)}
+        self.uut._index()
+
+    def tearDown(self):
+        self.uut.close()
+        self.cache_dir.cleanup()
+
+    def test_find_file(self):
+        self.assertEqual(('c', 'b', '/Automation/ncsef', 'x.pdf', False), self.uut._find_file('/Automation/ncsef/x.pdf'))
+        self.assertEqual((None, 'b', '/Automation/ncsef', None, False), self.uut._find_file('/Automation/ncsef/y.pdf'))
+
+    def test_find_root(self):
+        masks = []
+
+        def query(q, fields=None):
+            masks.append(fields)
+            yield {'id': 'a', 'title': 'Automation', 'mimeType': NCSEFGoogleDrive.FOLDER_MIME_TYPE,
+                   'parents': [{'id': 'r', 'isRoot': True}]}
+
+        self.uut.root = '/Automation'
+        self.uut._query = query
+        self.assertEqual('a', self.uut._find_root().id)
+        self.assertEqual(1, masks[0].count('parents'))  # one selector, asking for isRoot too
+
+    def test_add_remove(self):
+        self.uut._add_node({'id': 'd', 'title': 'y.pdf', 'mimeType': 'application/pdf', 'parents': [{'id': 'b'}]},
+                           '/Automation/ncsef/y.pdf')
+        self.assertEqual({'c', 'd'}, self.uut.children['b'])
+        self.assertEqual('d', self.uut._find_file('/Automation/ncsef/y.pdf')[0])
+        self.uut._remove_node('b')
+        self.assertEqual({'a'}, set(self.uut.ids.keys()))
+        self.assertEqual({'/Automation': 'a'}, self.uut.paths)
+        self.assertEqual(set(), self.uut.children['a'])
+
+    def test_makedirs(self):
+        created = []
+
+        class Files(object):
+            def insert(self, body=None, **kwargs):
+                self.body = dict(body, id=f'new{len(created)}')
+                created.append(self.body['title'])
+                return self
+
+            def execute(self, http=None, num_retries=0):
+                return self.body
+
+        class Service(object):
+            def files(self):
+                return Files()
+
+        self.uut.folder_lock = threading.Lock()
+        self.uut.num_retries = 0
+        self.uut._service = lambda: Service()
+        self.uut._http = lambda: None
+        node = self.uut.makedirs('/Automation/ncsef/by project/1234')
+        self.assertEqual(['by project', '1234'], created)
+        self.assertEqual('/Automation/ncsef/by project/1234', node.fullpath)
+        self.assertEqual(node.id, self.uut._find_file('/Automation/ncsef/by project/1234')[0])
+        self.assertEqual(node, self.uut.makedirs('/Automation/ncsef/by project/1234'))
+        self.assertEqual(2, len(created))
+        self.assertRaises(ValueError, self.uut.makedirs, '/Automation/ncsef/x.pdf/y')
+
+    def test_upload_files_folder_fails(self):
+        def makedirs(path):
+            if path.endswith('x.pdf'):
+                raise ValueError(f'{path} is a file')
+
+        self.uut._service = lambda: None
+        self.uut._write_cache = lambda: None
+        self.uut.makedirs = makedirs
+        self.uut.create_file = lambda localpath, remotepath, **kwargs: {'id': remotepath}
+        self.uut.hasher = HashingEngine(os.path.join(self.cache_dir.name, 'digests.json'))
+        summary = self.uut.upload_files([('a.pdf', '/Automation/ncsef/x.pdf/a.pdf'),
+                                         ('a.pdf', '/Automation/ncsef/a.pdf')], update_on='always')
+        self.assertEqual(['a.pdf'], summary['failed'])
+        self.assertEqual(1, summary['files'])
+
+    def test_records(self):
+        node = DriveNode.from_api({'id': 'd', 'title': 'y.pdf', 'mimeType': 'application/pdf',
+                                   'parents': [{'id': 'b'}], 'modifiedDate': '2022-03-01T00:00:00.000Z',
+                                   'labels': {'trashed': False}})
+        self.assertEqual(('b',), node.parents)
+        copy = DriveNode.from_record(json.loads(json.dumps(node.record())))
+        self.assertEqual(node.record(), copy.record())
+        self.uut.last_updated = self.uut.last_checked = self.uut.page_token = None
+        self.uut.cache.compact(self.uut._state(), wait=True)
+        self.assertEqual(self.uut.ids['c'].record(), self.uut.cache.load()['ids']['c'])
+
+    def test_needs_upload(self):
+        localpath = os.path.join(self.cache_dir.name, 'x.pdf')
+        with open(localpath, 'wb') as fp:
+            fp.write(b'project')
+        self.uut.hasher = HashingEngine(os.path.join(self.cache_dir.name, 'digests.json'))
+        self.uut.ids['c'].md5Checksum = hashlib.md5(b'project').hexdigest()
+        self.assertFalse(self.uut._needs_upload(localpath, 'c'))
+        self.assertTrue(self.uut._needs_upload(localpath, 'c', update_on='always'))
+        self.assertTrue(self.uut._needs_upload(localpath, None))
+        with open(localpath, 'wb') as fp:
+            fp.write(b'project, revised')
+        self.assertTrue(self.uut._needs_upload(localpath, 'c'))
+
+    def test_root_index(self):
+        del self.uut.ids['a']
+        self.uut.root = '/Automation/ncsef'
+        self.uut.root_id = 'b'
+        self.uut._index()
+        self.assertEqual({'/Automation/ncsef': 'b', '/Automation/ncsef/x.pdf': 'c'}, self.uut.paths)
+
+    def test_apply_changes(self):
+        class Changes(object):
+            def list(self, **kwargs):
+                return self
+
+            def execute(self, http=None):
+                folder = NCSEFGoogleDrive.FOLDER_MIME_TYPE
+                return {'items': [{'fileId': 'b', 'file': {'id': 'b', 'title': 'renamed', 'mimeType': folder,
+                                                          'parents': [{'id': 'a'}], 'labels': {'trashed': False},
+                                                          'modifiedDate': '2022-03-01T00:00:00.000Z'}}],
+                        'newStartPageToken': '2'}
+
+        class Service(object):
+            def changes(self):
+                return Changes()
+
+        self.uut.page_token = '1'
+        self.uut.last_updated = '2022-01-01T00:00:00.000Z'
+        self.uut._service = lambda: Service()
+        self.uut._http = lambda: None
+        self.assertEqual(1, self.uut._apply_changes())
+        self.assertEqual('2', self.uut.page_token)
+        self.assertEqual('c', self.uut._find_file('/Automation/renamed/x.pdf')[0])
+        self.assertIsNone(self.uut._find_file('/Automation/ncsef/x.pdf')[0])
+
+
+class HashingEngineTestCases(unittest.TestCase):
+
+    def test_digest(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            localpath = os.path.join(cache_dir, 'x.pdf')
+            with open(localpath, 'wb') as fp:
+                fp.write(b'project')
+            uut = HashingEngine(os.path.join(cache_dir, 'digests.json'))
+            self.assertEqual(hashlib.md5(b'project').hexdigest(), uut.digest(localpath))
+            uut.save()
+            uut = HashingEngine(os.path.join(cache_dir, 'digests.json'))
+            uut.hash_file = None  # unchanged, so it must come from the cache
+            self.assertEqual(hashlib.md5(b'project').hexdigest(), uut.digest(localpath))
+            os.link(localpath, os.path.join(cache_dir, 'y.pdf'))  # same inode
+            self.assertEqual(hashlib.md5(b'project').hexdigest(), uut.digest(os.path.join(cache_dir, 'y.pdf')))
+
+    def test_digest_many(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            paths = []
+            for n in range(10):
+                paths.append(os.path.join(cache_dir, f'{n}.pdf'))
+                with open(paths[-1], 'wb') as fp:
+                    fp.write(bytes([n]) * 1000 * n)
+            uut = HashingEngine(os.path.join(cache_dir, 'digests.json'), max_workers=4, mmap_threshold=5000)
+            hashed = uut.digest_many(paths + [os.path.join(cache_dir, 'missing.pdf')], algorithms=('md5', 'sha256'))
+            self.assertEqual(set(paths), set(hashed.keys()))
+            for n, path in enumerate(paths):
+                self.assertEqual(hashlib.md5(bytes([n]) * 1000 * n).hexdigest(), hashed[path]['md5'])
+                self.assertEqual(hashlib.sha256(bytes([n]) * 1000 * n).hexdigest(), hashed[path]['sha256'])
+
+
+class SessionStoreTestCases(unittest.TestCase):
+
+    def test_save_load(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            uut = SessionStore(os.path.join(cache_dir, 'session.json'))
+            self.assertIsNone(uut.load('ncsef', 'admin'))
+            jar = requests.cookies.RequestsCookieJar()
+            jar.set('laravel_session', 'abc', domain='ncsef.stemwizard.com', path='/')
+            jar.set('gone', 'x', domain='ncsef.stemwizard.com', path='/', expires=int(time.time()) - 60)
+            uut.save('ncsef', 'admin', jar, token='t', csrf='c', region_id='4001', region_domain='ncsef')
+            self.assertEqual(0o600, os.stat(uut.filename).st_mode & 0o777)
+            self.assertIsNone(uut.load('ncsef', 'someone else'))
+            state = uut.load('ncsef', 'admin')
+            self.assertEqual(('t', 'c', '4001'), (state['token'], state['csrf'], state['region_id']))
+            restored = requests.cookies.RequestsCookieJar()
+            SessionStore.restore_cookies(restored, state['cookies'])
+            self.assertEqual({'laravel_session': 'abc'}, restored.get_dict())
+            os.chmod(uut.filename, 0o644)
+            self.assertIsNone(uut.load('ncsef', 'admin'))
+
+    def test_reauthenticate(self):
+        url_base = 'https://ncsef.stemwizard.com'
+        request = requests.Request('POST', f'{url_base}/fairadmin/fileDownload', data={'_token': 'old', 'x': '1'},
+                                   headers={'X-CSRF-TOKEN': 'old'}, cookies={'laravel_session': 'old'}).prepare()
+        r = requests.Response()
+        r.request, r.url, r.status_code = request, request.url, 419
+        self.assertTrue(login_required(r))
+        r.status_code, r.headers['Location'] = 302, '/admin/login'
+        self.assertTrue(login_required(r))
+        r.headers['Location'] = '/fairadmin/dashboard'
+        self.assertFalse(login_required(r))
+        jar = requests.cookies.RequestsCookieJar()
+        jar.set('laravel_session', 'new', domain='ncsef.stemwizard.com', path='/')
+        retry = refreshed_request(request, jar, 'new token', 'new csrf')
+        self.assertEqual('_token=new+token&x=1', retry.body)
+        self.assertEqual('new csrf', retry.headers['X-CSRF-TOKEN'])
+        self.assertEqual('laravel_session=new', retry.headers['Cookie'])
+        self.assertEqual(str(len(retry.body)), retry.headers['Content-Length'])
+
+
+class ThrottleTestCases(unittest.TestCase):
+
+    def test_token_bucket(self):
+        uut = TokenBucket(100, burst=5)
+        start = time.perf_counter()
+        for _ in range(25):
+            uut.acquire()
+        self.assertGreater(time.perf_counter() - start, 0.19)  # 5 at once, then 20 at 100 a second
+
+    def test_aimd(self):
+        uut = ConcurrencyController(initial=2, maximum=4)
+        for _ in range(20):
+            uut.acquire()
+            uut.release(0.01)
+        self.assertEqual(4, uut.limit)
+        uut.acquire()
+        uut.release(0.01, overloaded=True)
+        self.assertEqual(2, uut.limit)
+        uut.acquire()
+        uut.release(0.01, overloaded=True)  # same burst of failures, no further decrease
+        self.assertEqual(2, uut.limit)
+        uut.last_decrease = 0
+        for _ in range(5):
+            uut.acquire()
+            uut.release(0.5)  # response times risen well past the usual
+        self.assertEqual(1, uut.limit)
+
+    def test_backoff(self):
+        uut = Throttle(backoff_base=0.5, backoff_cap=4)
+        self.assertTrue(all(0 <= uut.backoff(attempt) <= 4 for attempt in range(10)))
+        self.assertEqual(3, uut.backoff(0, retry_after='3'))
+
+    def test_retry(self):
+        statuses = [503, 429, 200]
+
+        class Upstream(requests.adapters.HTTPAdapter):
+            def send(self, request, **kwargs):
+                r = requests.Response()
+                r.status_code = statuses.pop(0)
+                r.headers['Retry-After'] = '0'
+                r.raw = io.BytesIO(b'')
+                return r
+
+        class Adapter(ThrottledAdapter, Upstream):
+            pass
+
+        throttle = Throttle(rate=1000, backoff_base=0.01)
+        session = requests.Session()
+        session.mount('https://ncsef.stemwizard.com', Adapter(throttle))
+        self.assertEqual(200, session.get('https://ncsef.stemwizard.com/filesAndForms').status_code)
+        self.assertEqual([], statuses)
+        self.assertEqual(0, throttle.controller.active)
+
+
+class DriveCacheJournalTestCases(unittest.TestCase):
+
+    def test_replay_and_compact(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            filename = os.path.join(cache_dir, 'cache.json')
+            journal = DriveCacheJournal(filename)
+            self.assertEqual({}, journal.load())
+            journal.compact({'ids': {'a': {'id': 'a'}, 'b': {'id': 'b'}}, 'page_token': '1'}, wait=True)
+            journal.put({'id': 'c'})
+            journal.remove('a')
+            journal.meta(page_token='2')
+            journal.close()
+            with open(journal.journal_filename, 'a') as fp:
+                fp.write('{"put": {"id"')  # torn by a crash
+            expected = {'ids': {'b': {'id': 'b'}, 'c': {'id': 'c'}}, 'page_token': '2'}
+            journal = DriveCacheJournal(filename)
+            self.assertEqual(expected, journal.load())
+            self.assertEqual(3, journal.entries)
+            journal.compact(expected, wait=True)
+            self.assertFalse(os.path.exists(journal.journal_filename))
+            self.assertEqual(expected, DriveCacheJournal(filename).load())
+
+    def test_compact_while_compacting(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            filename = os.path.join(cache_dir, 'cache.json')
+            release = threading.Event()
+
+            class SlowJournal(DriveCacheJournal):
+                def _write_snapshot(self, state):
+                    release.wait()
+                    super()._write_snapshot(state)
+            journal = SlowJournal(filename)
+            journal.compact({'ids': {'a': {'id': 'a'}}, 'page_token': '1'})
+            second = threading.Thread(target=journal.compact, args=({'ids': {'b': {'id': 'b'}}, 'page_token': '2'},))
+            second.start()
+            second.join(0.2)  # waiting for the first
+            release.set()
+            second.join()
+            journal.close()
+            self.assertEqual({'ids': {'b': {'id': 'b'}}, 'page_token': '2'}, DriveCacheJournal(filename).load())
+
+
 class NCSEF_prod_TestCases_operation(unittest.TestCase):
 
     def dtest_01_setcolumns(self):
@@ -194,6 +987,40 @@ class devtest(unittest.TestCase):
         pprint(data)
         write_json_cache(data, 'caches/foo.json')
 
+    def test_getProjectInfo_concurrent(self):
+        serial = STEMWizardAPI(configfile=configfile_prod, login_stemwizard=True, login_google=False, http_cache=False)
+        concurrent = STEMWizardAPI(configfile=configfile_prod, login_stemwizard=True, login_google=False,
+                                   max_workers=6, http_cache=False)
+        data = concurrent.getProjectInfo()
+        self.assertEqual(serial.getProjectInfo(), data)
+        self.assertEqual(list(serial.getProjectInfo().keys()), list(data.keys()))  # same merge order
+
+    def test_iter_students_paged(self):
+        uut = STEMWizardAPI(configfile=configfile_prod, login_stemwizard=True, login_google=False, http_cache=False)
+        uut.per_page = 5
+        paged = dict(uut.iter_students('project', '15870'))
+        uut.per_page = 999
+        self.assertEqual(dict(uut.iter_students('project', '15870')), paged)
+
+    def test_bulk_fetch_mode(self):
+        uut = STEMWizardAPI(configfile=configfile_prod, login_stemwizard=True, login_google=False, http_cache=False)
+        by_category = uut.getJudgesMaterials()
+        uut.fetch_mode = 'bulk'
+        self.assertEqual(by_category, uut.getJudgesMaterials())
+
+    @unittest.skipIf(importlib.util.find_spec('aiohttp') is None, 'AsyncSTEMWizardAPI needs aiohttp')
+    def test_async_getProjectInfo(self):
+        from STEMWizard.async_api import AsyncSTEMWizardAPI
+
+        async def fetch():
+            async with AsyncSTEMWizardAPI(configfile=configfile_prod) as uut:
+                self.assertTrue(uut.authenticated)
+                return await uut.getProjectInfo()
+
+        data = asyncio.run(fetch())
+        uut = STEMWizardAPI(configfile=configfile_prod, login_stemwizard=True, login_google=False, http_cache=False)
+        self.assertEqual(uut.getProjectInfo(), data)
+
     def test_studentSync(self):
         uut = STEMWizardAPI(configfile=configfile_prod, login_stemwizard=True, login_google=False)
         data = uut.studentSync(download=False, upload=False)